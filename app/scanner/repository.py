@@ -19,6 +19,11 @@ class UnknownFile(Exception):
        in a given repository """
    pass
 
+class HistoryUnavailable(Exception):
+   """ Exception raised when the CVSROOT/history file of a repository
+       is missing or has been rotated since the last scan. """
+   pass
+
 def previousRev(rev):
    assert(len(rev) % 2 == 0)
    assert(len(rev) >= 2)
@@ -37,16 +42,19 @@ def previousRev(rev):
 
 class RevisionList:
    """ Represents a list of all revisions of a given file in a repository. """
-   def __init__(self, repo, file):
+   def __init__(self, repo, file, since=None):
+      """ If since is given, log messages and diffstats are only read
+          for revisions newer than that revision. """
       self.cur = 0
+      options = {'cvs_newer_than': since}
       try:
-         self.revs = repo.itemlog([file], None, {})
+         self.revs = repo.itemlog([file], None, options)
       except vclib.ItemNotFound:
          # retry file in the Attic
          (dir, fname) = os.path.split(file)
          attic = os.path.join(dir, 'Attic', fname)
          try:
-            self.revs = repo.itemlog([attic], None, {})
+            self.revs = repo.itemlog([attic], None, options)
          except vclib.ItemNotFound:
             raise UnknownFile(file)
 
@@ -86,10 +94,54 @@ class RevisionList:
          raise UnknownRevision()
       return [rev for rev in self.revs if rev.date > zrev.date]
 
+class ChangeRecord(object):
+   """ A single revision of a file as stored in the database. Contains
+       only plain data so it can be passed between processes. """
+   def __init__(self, rev):
+      self.author = rev.author
+      self.date = datetime.fromtimestamp(rev.date)
+      self.rev_old = previousRev(rev.number)
+      self.rev_new = rev.string
+      self.log = rev.log
+      self.diffstat = rev.changed or 'new'
+      # the lines of the first revision of a file, all of them added
+      self.lines = getattr(rev, 'lines', 0)
+      # shared by the files of a commit, with CVS 1.12 and later only
+      self.commitid = getattr(rev, 'commitid', None)
+
+class FileScan(object):
+   """ Result of scanning a single file: its timestamp, its newest
+       revision and the changes added since the last scan. """
+   def __init__(self, filename, timestamp, newest, changes):
+      self.filename = filename
+      self.timestamp = timestamp
+      self.newest = newest
+      self.changes = changes
+
+def scanFiles(task):
+   """ Scans a chunk of files of a repository. The task is a tuple of
+       a key passed back to the caller, the repository path, the RCS
+       cache (or None) and a list of (filename, last_change, last_rev)
+       tuples. Used as the worker function when scanning in several
+       processes. """
+   (key, path, cache, files) = task
+   repo = RepositoryAccess(path, cache)
+   ret = []
+   for (filename, last_change, last_rev) in files:
+      try:
+         scan = repo.scanFile(filename, last_change, last_rev)
+      except UnknownFile:
+         continue
+      if scan:
+         ret.append(scan)
+   return (key, ret)
+
 class RepositoryAccess(object):
-   def __init__(self, path):
+   def __init__(self, path, cache=None):
+      """ cache is an optional RCSCache to keep parsed RCS files in """
       self.path = path
-      self.repo = vclib.ccvs.CCVSRepository("foo", self.path)
+      self.cache = cache
+      self.repo = vclib.ccvs.CCVSRepository("foo", self.path, cache)
 
    def getFilenameList(self, dir="."):
       """ Returns a list of all files in the repository.
@@ -107,8 +159,90 @@ class RepositoryAccess(object):
             pass
       return ret
 
-   def getRevisions(self, filename):
-      return RevisionList(self.repo, filename)
+   def getRevisions(self, filename, since=None):
+      return RevisionList(self.repo, filename, since)
+
+   def getHistoryPath(self):
+      """ Returns the path of the CVSROOT/history file the repository
+          belongs to. The repository path may either be a CVSROOT or
+          a module directory somewhere below it. """
+      path = os.path.realpath(self.path)
+      while True:
+         history = os.path.join(path, 'CVSROOT', 'history')
+         if os.path.isfile(history):
+            return history
+         parent = os.path.dirname(path)
+         if parent == path:
+            raise HistoryUnavailable(self.path)
+         path = parent
+
+   def getHistoryEnd(self):
+      """ Returns the offset just behind the last complete record of
+          the history file. """
+      f = open(self.getHistoryPath(), 'rb')
+      try:
+         f.seek(0, 2)
+         size = f.tell()
+         f.seek(max(0, size - 8192))
+         tail = f.read()
+      finally:
+         f.close()
+      idx = tail.rfind('\n')
+      if idx == -1:
+         return 0
+      return size - len(tail) + idx + 1
+
+   def getChangedFilenames(self, offset):
+      """ Returns a tuple of the files committed to since the given
+          history offset and the offset to continue from next time.
+          Raises HistoryUnavailable if the history file is missing or
+          was rotated, i.e. the offset no longer points to the end of
+          a record. """
+      history = self.getHistoryPath()
+      cvsroot = os.path.dirname(os.path.dirname(history))
+      prefix = os.path.realpath(self.path)[len(cvsroot) + 1:]
+      f = open(history, 'rb')
+      try:
+         if offset > 0:
+            f.seek(offset - 1)
+            if f.read(1) != '\n':
+               raise HistoryUnavailable(self.path)
+         data = f.read()
+      finally:
+         f.close()
+      # a record may be half written, leave it for the next run
+      end = data.rfind('\n') + 1
+      ret = []
+      for line in data[:end].splitlines():
+         fields = line.split('|')
+         # only commits (A)dded, (M)odified and (R)emoved files
+         if len(fields) < 6 or line[:1] not in 'AMR':
+            continue
+         name = os.path.normpath(os.path.join(fields[3], fields[5]))
+         if prefix:
+            if not name.startswith(prefix + os.sep):
+               continue
+            name = name[len(prefix) + 1:]
+         if name.split(os.sep)[0] == 'CVSROOT':
+            continue
+         name = os.path.join('.', name)
+         if name not in ret:
+            ret.append(name)
+      return (ret, offset + end)
+
+   def scanFile(self, filename, last_change=None, last_rev=None):
+      """ Returns a FileScan with all revisions of a file newer than
+          last_rev, or None if the file's timestamp still equals
+          last_change. """
+      timestamp = self.getTimestamp(filename)
+      if timestamp == last_change:
+         return None
+      revlist = self.getRevisions(filename, last_rev)
+      newest = revlist.getNewest().string
+      changes = []
+      if newest != last_rev:
+         changes = [ChangeRecord(rev) for rev in revlist.getSince(last_rev)]
+      return FileScan(filename, timestamp, newest, changes)
 
    def getTimestamp(self, filename):
       statinfo = os.stat(self._fullpath(filename))
@@ -164,6 +298,21 @@ class RepositoryTest(unittest.TestCase):
       self.assert_('1.3' in allrevs)
       self.assert_(len(allrevs) == 3)
 
+   def testRevisionsSince(self):
+      r = RepositoryAccess('test/repo')
+      full = dict([(rev.string, rev) for rev in
+                   r.getRevisions('./module2/gpl.txt')])
+      revs = dict([(rev.string, rev) for rev in
+                   r.getRevisions('./module2/gpl.txt', '1.2')])
+      self.assert_(len(revs) == len(full))
+      self.assert_(revs['1.3'].log == full['1.3'].log)
+      self.assert_(revs['1.3'].changed == full['1.3'].changed)
+      self.assert_(revs['1.3'].changed != None)
+      self.assert_(revs['1.1'].log == None)
+      revs = dict([(rev.string, rev) for rev in
+                   r.getRevisions('./module2/gpl.txt', '1.3')])
+      self.assert_(revs['1.3'].log == None)
+
    def testGetNewest(self):
       r = RepositoryAccess('test/repo')
       revisions = r.getRevisions('./module1/file2.txt')
@@ -218,6 +367,58 @@ class RepositoryTest(unittest.TestCase):
       ts = r.getTimestamp('./module2/timestamp_deleted.txt')
       self.assert_(ts == dt)
 
+   def testScanFile(self):
+      r = RepositoryAccess('test/repo')
+      scan = r.scanFile('./module1/file2.txt')
+      self.assert_(scan.newest == '1.3')
+      self.assert_(len(scan.changes) == 4)
+      scan = r.scanFile('./module1/file2.txt', last_rev='1.2')
+      self.assert_([c.rev_new for c in scan.changes] == ['1.3'])
+      self.assert_(scan.changes[0].rev_old == '1.2')
+      scan = r.scanFile('./module1/file2.txt', last_rev='1.3')
+      self.assert_(len(scan.changes) == 0)
+      self.assert_(r.scanFile('./module1/file2.txt', scan.timestamp) == None)
+
+   def testCommitid(self):
+      r = RepositoryAccess('test/repo')
+      scan = r.scanFile('./module1/file1.txt')
+      self.assert_([c.commitid for c in scan.changes] ==
+                   ['xJdVUZDb1Am3s9Tt'] * len(scan.changes))
+
+   def testScanFiles(self):
+      files = [('./module1/file2.txt', None, '1.2'),
+               ('./module1/nonexistent.txt', None, None)]
+      (key, scans) = scanFiles((42, 'test/repo', None, files))
+      self.assert_(key == 42)
+      self.assert_(len(scans) == 1)
+      self.assert_(scans[0].filename == './module1/file2.txt')
+
+class HistoryTest(unittest.TestCase):
+   def testChangedFiles(self):
+      r = RepositoryAccess('test/repo')
+      (files, offset) = r.getChangedFilenames(0)
+      self.assert_('./module2/gpl.txt' in files)
+      self.assert_('./module2/deleted_file.txt' in files)
+      self.assert_('./module1/file2.txt' in files)
+      self.assert_(offset == r.getHistoryEnd())
+      (files, offset2) = r.getChangedFilenames(offset)
+      self.assert_(len(files) == 0)
+      self.assert_(offset2 == offset)
+
+   def testModulePrefix(self):
+      r = RepositoryAccess('test/repo/module2')
+      (files, offset) = r.getChangedFilenames(0)
+      self.assert_('./gpl.txt' in files)
+      self.assert_('./deleted_file.txt' in files)
+      self.assert_('./module1/file2.txt' not in files)
+      self.assert_('./file2.txt' not in files)
+
+   def testRotated(self):
+      r = RepositoryAccess('test/repo')
+      end = r.getHistoryEnd()
+      self.assertRaises(HistoryUnavailable, r.getChangedFilenames, end + 100)
+      self.assertRaises(HistoryUnavailable, r.getChangedFilenames, end - 1)
+
 class PreviousRevTest(unittest.TestCase):
    def testRevs(self):
       self.assert_(previousRev((1,1)) == "New")
@@ -3,9 +3,16 @@
 # vim:set autoindent smarttab nowrap:
 
 import os
+import re
 import sys
 import unittest
-from datetime import datetime
+from datetime import datetime, timedelta
+
+try:
+   import multiprocessing
+except ImportError:
+   # python < 2.6, scan in a single process
+   multiprocessing = None
 
 sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
 # import the django environment first before using any local modules
@@ -13,33 +20,460 @@ import app.settings
 from django.core.management import setup_environ
 setup_environ(app.settings)
 
-from webreview.models import Repository, File, Change, User
-from repository import RepositoryAccess, RevisionList, previousRev
+from django.conf import settings
+from django.db import connection, transaction, reset_queries
+from django.db.models import AutoField
+from webreview.models import Repository, File, Change, Changeset, User, \
+                             LogMessage, loghash
+from webreview import search
+from webreview.diffcache import DiffCache
+from repository import RepositoryAccess, RevisionList, previousRev, \
+                       UnknownFile, HistoryUnavailable, scanFiles
+import watcher
 
 import vclib.ccvs
+from vclib.ccvs import rcsparse
+from vclib.ccvs.rcscache import RCSCache
+from vclib.ccvs.blamecache import BlameCache
+
+# what reading an RCS file may raise. Filling the caches after a batch
+# must never fail the scan, the files are skipped. The parser gives
+# ValueError and TypeError on some corrupt files.
+READ_ERRORS = (vclib.Error, rcsparse.RCSParseError, RuntimeError,
+               EnvironmentError, ValueError, TypeError)
+
+def rcscache():
+   """ Returns the cache of parsed RCS files, if one is configured """
+   if settings.RCS_CACHE_DIR:
+      return RCSCache(settings.RCS_CACHE_DIR, settings.RCS_CACHE_SIZE)
+   return None
+
+def diffcache():
+   """ Returns the cache of diffs to warm with the new changes, if one
+       is configured """
+   if settings.DIFF_CACHE_DIR and settings.DIFF_CACHE_WARM:
+      return DiffCache(settings.DIFF_CACHE_DIR, settings.DIFF_CACHE_SIZE)
+   return None
+
+def blamecache():
+   """ Returns the blame cache to bring up to date with the new
+       changes, if one is configured """
+   if settings.BLAME_CACHE_DIR:
+      return BlameCache(settings.BLAME_CACHE_DIR, settings.BLAME_CACHE_SIZE)
+   return None
+
+class Cache:
+   """ Database rows keyed by their name, counting the lookups. Rows
+       added since the last commit are forgotten on a rollback. """
+   def __init__(self, rows):
+      self.rows = dict([(row.name, row) for row in rows])
+      self.uncommitted = []
+      self.hits = 0
+      self.misses = 0
+
+   def get(self, name):
+      row = self.rows.get(name)
+      if row is None:
+         self.misses += 1
+      else:
+         self.hits += 1
+      return row
+
+   def add(self, row):
+      self.rows[row.name] = row
+      self.uncommitted.append(row.name)
+
+   def commit(self):
+      self.uncommitted = []
+
+   def rollback(self):
+      for name in self.uncommitted:
+         self.rows.pop(name, None)
+      self.uncommitted = []
+
+   def __str__(self):
+      return "%d hits, %d misses" % (self.hits, self.misses)
+
+class LogCache:
+   """ Ids of the log messages keyed by their hash, which is all the
+       scanner needs to know about them. New messages are stored right
+       away, as changes refer to them, and forgotten on a rollback. """
+   def __init__(self):
+      self.ids = dict(LogMessage.objects.values_list('hash', 'id'))
+      self.uncommitted = []
+      self.hits = 0
+      self.misses = 0
+
+   def intern(self, text):
+      """ Returns the id of the log message with this text """
+      key = loghash(text)
+      id = self.ids.get(key)
+      if id is None:
+         self.misses += 1
+         log = LogMessage()
+         log.hash = key
+         log.text = text
+         log.save()
+         id = self.ids[key] = log.id
+         self.uncommitted.append(key)
+      else:
+         self.hits += 1
+      return id
+
+   def commit(self):
+      self.uncommitted = []
+
+   def rollback(self):
+      for key in self.uncommitted:
+         self.ids.pop(key, None)
+      self.uncommitted = []
+
+   def __str__(self):
+      return "%d hits, %d misses" % (self.hits, self.misses)
+
+class ChangesetGrouper:
+   """ Assigns new changes of a repository to changesets. Changes with a
+       commitid go to the changeset of that commitid. Others go to a
+       changeset of the same user and log message that is at most the
+       time window away and does not contain the file yet. """
+   diffstat = re.compile(r'^\+(\d+) -(\d+)$')
+
+   def __init__(self, repository, window):
+      self.r = repository
+      self.window = timedelta(seconds=window)
+      self.reload()
+
+   def reload(self):
+      self.commitids = {}
+      self.logs = {}
+      # changes assigned since the last commit
+      self.dirty = False
+      # changesets that ended within the window before the last one may
+      # still grow, e.g. if a commit was in progress during the last scan
+      latest = Changeset.objects.filter(repository=self.r) \
+                                .order_by('-commit_time')[:1]
+      if latest:
+         self.load(Changeset.objects.filter(repository=self.r,
+                     commit_time__gte=latest[0].commit_time - self.window))
+
+   def load(self, changesets):
+      changesets = dict([(cs.id, cs) for cs in changesets])
+      for cs in changesets.values():
+         cs.fileids = set()
+         self.index(cs)
+      changes = Change.objects.filter(changeset__in=changesets.keys())
+      for (changeset_id, file_id) in changes.values_list('changeset',
+                                                         'file'):
+         changesets[changeset_id].fileids.add(file_id)
+
+   def prune(self):
+      """ Forgets the changesets that ended more than the window before
+          the newest one, like the constructor leaves them out. Only
+          safe once all files of a scan are done, as a change read later
+          in a scan may belong to any changeset. """
+      changesets = self.commitids.values()
+      for css in self.logs.values():
+         changesets += css
+      if not changesets:
+         return
+      start = max([cs.commit_time for cs in changesets]) - self.window
+      for commitid, cs in self.commitids.items():
+         if cs.commit_time < start:
+            del self.commitids[commitid]
+      for key, css in self.logs.items():
+         css = [cs for cs in css if cs.commit_time >= start]
+         if css:
+            self.logs[key] = css
+         else:
+            del self.logs[key]
+
+   def commit(self):
+      self.dirty = False
+
+   def rollback(self):
+      """ Reloads the changesets, as those in memory may have been
+          created or updated since the last commit. """
+      if self.dirty:
+         self.reload()
+
+   def index(self, cs):
+      if cs.commitid:
+         self.commitids[cs.commitid] = cs
+      else:
+         self.logs.setdefault((cs.user_id, cs.log_id), []).append(cs)
+
+   def find(self, change, commitid):
+      if commitid:
+         return self.commitids.get(commitid)
+      for cs in self.logs.get((change.user.id, change.log_id), []):
+         if change.file.id not in cs.fileids and \
+            cs.start_time - self.window <= change.commit_time and \
+            change.commit_time <= cs.commit_time + self.window:
+            return cs
+      return None
 
-class Bug(Exception):
-   pass
+   def assign(self, change, commitid=None, lines=0):
+      """ Sets the changeset of a change, creating a new one if needed.
+          Returns the changeset, whose totals have been updated. The
+          lines of a new file count as added. """
+      self.dirty = True
+      cs = self.find(change, commitid)
+      if cs is None:
+         cs = Changeset()
+         cs.repository = self.r
+         cs.user = change.user
+         cs.log_id = change.log_id
+         cs.commitid = commitid
+         cs.start_time = cs.commit_time = change.commit_time
+         cs.save()
+         cs.fileids = set()
+         self.index(cs)
+      cs.start_time = min(cs.start_time, change.commit_time)
+      cs.commit_time = max(cs.commit_time, change.commit_time)
+      cs.files += 1
+      cs.fileids.add(change.file.id)
+      match = self.diffstat.match(change.diffstat)
+      if match:
+         cs.added += int(match.group(1))
+         cs.removed += int(match.group(2))
+      elif change.diffstat == 'new':
+         cs.added += lines
+      change.changeset = cs
+      return cs
+
+class ChangeWriter:
+   """ Collects new changes and file updates and writes them to the
+       database in batches, committing one transaction per batch. The
+       diffs of recent new changes are put into the diffs cache after
+       each batch, so their first view is served from it. The blame of
+       files in the blames cache is made for their new revisions. The
+       caches of the scanners are told about each commit and rollback,
+       so they don't keep rows which are not in the database. """
+   def __init__(self, batchsize=1000, diffs=None, blames=None):
+      self.batchsize = batchsize
+      self.diffs = diffs
+      self.blames = blames
+      self.caches = []
+      self.changes = []
+      self.files = {}
+      self.changesets = {}
+
+   def track(self, cache):
+      """ Adds a cache with commit() and rollback() methods """
+      if cache not in self.caches:
+         self.caches.append(cache)
+
+   def begin(self):
+      transaction.enter_transaction_management()
+      transaction.managed(True)
+
+   def end(self):
+      """ Leaves transaction management, discarding everything that
+          has not been flushed. """
+      transaction.rollback()
+      # the files were updated in memory only
+      for file in File.objects.filter(id__in=self.files.keys()):
+         self.files[file.id].last_change = file.last_change
+         self.files[file.id].last_rev = file.last_rev
+      for cache in self.caches:
+         cache.rollback()
+      self.changes = []
+      self.files = {}
+      self.changesets = {}
+      transaction.leave_transaction_management()
+
+   def addChange(self, change):
+      self.changes.append(change)
+
+   def updateFile(self, file):
+      """ Batches are only written after the update of a file, which
+          follows its changes, so a file is never written with only a
+          part of its new changes """
+      self.files[file.id] = file
+      if (len(self.files) >= self.batchsize or
+          len(self.changes) >= self.batchsize):
+         self.flush()
+
+   def updateChangeset(self, changeset):
+      """ Changesets are created right away, as changes refer to them,
+          but their times and totals are updated in batches. """
+      self.changesets[changeset.id] = changeset
+
+   def flush(self):
+      qn = connection.ops.quote_name
+      cursor = connection.cursor()
+      last = None
+      if self.changes:
+         # the ids of the new changes are those above the last one
+         cursor.execute("SELECT MAX(%s) FROM %s" % (
+                           qn(Change._meta.pk.column),
+                           qn(Change._meta.db_table)))
+         last = cursor.fetchone()[0] or 0
+         fields = [f for f in Change._meta.fields
+                   if not isinstance(f, AutoField)]
+         sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+                  qn(Change._meta.db_table),
+                  ", ".join([qn(f.column) for f in fields]),
+                  ", ".join(["%s"] * len(fields)))
+         cursor.executemany(sql,
+               [[f.get_db_prep_save(getattr(c, f.attname)) for f in fields]
+                for c in self.changes])
+      if self.files:
+         last_change = File._meta.get_field('last_change')
+         sql = "UPDATE %s SET %s = %%s, %s = %%s WHERE %s = %%s" % (
+                  qn(File._meta.db_table), qn(last_change.column),
+                  qn(File._meta.get_field('last_rev').column),
+                  qn(File._meta.pk.column))
+         cursor.executemany(sql,
+               [(last_change.get_db_prep_save(f.last_change), f.last_rev, f.id)
+                for f in self.files.values()])
+      if self.changesets:
+         columns = ['start_time', 'commit_time', 'files', 'added', 'removed']
+         fields = [Changeset._meta.get_field(c) for c in columns]
+         sql = "UPDATE %s SET %s WHERE %s = %%s" % (
+                  qn(Changeset._meta.db_table),
+                  ", ".join(["%s = %%s" % qn(f.column) for f in fields]),
+                  qn(Changeset._meta.pk.column))
+         cursor.executemany(sql,
+               [[f.get_db_prep_save(getattr(cs, f.attname)) for f in fields]
+                + [cs.id] for cs in self.changesets.values()])
+         # the changesets with new changes are indexed again as a whole
+         search.update(self.changesets.keys())
+      transaction.commit()
+      for cache in self.caches:
+         cache.commit()
+      self.changes = []
+      self.files = {}
+      self.changesets = {}
+      if self.diffs and last is not None:
+         self.warm(last)
+      if self.blames and last is not None:
+         self.reblame(last)
+      # with DEBUG enabled django keeps every query, which adds up
+      reset_queries()
+
+   def warm(self, last):
+      """ Makes the diffs of the changes after the id last committed in
+          the last settings.DIFF_CACHE_WARM days """
+      since = datetime.now() - timedelta(days=settings.DIFF_CACHE_WARM)
+      changes = Change.objects.filter(id__gt=last, commit_time__gte=since)
+      cache = rcscache()
+      for change in changes.select_related('file__repository'):
+         try:
+            self.diffs.diff(change, cache)
+         except READ_ERRORS:
+            # e.g. the first revision of a file, which has no diff
+            pass
+
+   def reblame(self, last):
+      """ Blames the new revisions of the changes after the id last
+          whose previous revision is in the blame cache, from the
+          blame of that revision """
+      changes = Change.objects.filter(id__gt=last).order_by('id')
+      cache = rcscache()
+      modules = {}
+      for change in changes.select_related('file__repository'):
+         repository = change.file.repository
+         if repository.id not in modules:
+            modules[repository.id] = repository.getmodule(cache, self.blames)
+         module = modules[repository.id]
+         try:
+            path = module.rcsfile([change.file.name], 1)
+            if self.blames.has(path, change.rev_old):
+               module.annotate([change.file.name], change.rev_new)
+         except READ_ERRORS:
+            # e.g. a removed file, which may have no RCS file left
+            pass
 
 class RepositoryScanner:
-   def __init__(self, repository):
+   # number of files handed to a worker process at once
+   chunksize = 50
+
+   def __init__(self, repository, writer=None, users=None, logs=None):
       self.r = repository
-      self.repo = RepositoryAccess(repository.path)
+      self.repo = RepositoryAccess(repository.path, rcscache())
+      self.writer = writer or ChangeWriter(diffs=diffcache(),
+                                           blames=blamecache())
+      # all lookups during the scan are answered from memory, the user
+      # and log caches may be shared by the scanners of several repositories
+      self.users = users or Cache(User.objects.all())
+      self.logs = logs or LogCache()
+      self.files = Cache(File.objects.filter(repository=repository))
+      self.changesets = ChangesetGrouper(repository,
+                                         settings.CHANGESET_WINDOW)
+      for cache in (self.users, self.logs, self.files, self.changesets):
+         self.writer.track(cache)
+      self.offset = None
+      self.scanned = 0
+      self.added = 0
+
+   def run(self, full=False):
+      """ Scans the repository for new changes. Only the files named in
+          the CVSROOT/history since the last scan are looked at, unless
+          a full scan is requested or the history is not usable. """
+      self.writer.begin()
+      try:
+         for filename in self.prepare(full):
+            self.handleFile(filename)
+         self.finish()
+         self.writer.flush()
+      finally:
+         self.writer.end()
+      self.summary()
+
+   def prepare(self, full=False):
+      """ Returns the names of the files that need to be scanned. """
+      if not full:
+         try:
+            return self.getChangedFilenames()
+         except HistoryUnavailable:
+            print "History unavailable, scanning all files"
+      # remember the history position before walking the tree, commits
+      # that happen during the walk are picked up by the next run
+      try:
+         self.offset = self.repo.getHistoryEnd()
+      except HistoryUnavailable:
+         self.offset = None
+      return self.repo.getFilenameList()
+
+   def getChangedFilenames(self):
+      if self.r.history_offset is None:
+         raise HistoryUnavailable(self.r.path)
+      (filenames, self.offset) = \
+            self.repo.getChangedFilenames(self.r.history_offset)
+      return filenames
+
+   def finish(self):
+      """ Records how far the history has been scanned. """
+      self.r.history_offset = self.offset
+      self.r.save()
 
-   def run(self):
-      for filename in self.repo.getFilenameList():
-         self.handleFile(filename)
+   def summary(self):
+      print "%s: %d files scanned, %d changes added" % (
+               self.r.name, self.scanned, self.added)
+      print "%s: file cache %s" % (self.r.name, self.files)
+
+   def tasks(self, key, filenames):
+      """ Splits the files to scan into tasks for scanFiles(). """
+      files = []
+      for filename in filenames:
+         file = self.files.rows.get(filename)
+         if file:
+            files.append((filename, file.last_change, file.last_rev))
+         else:
+            files.append((filename, None, None))
+      return [(key, self.r.path, self.repo.cache, files[i:i+self.chunksize])
+              for i in range(0, len(files), self.chunksize)]
 
    def checkUser(self, username):
       """ Return matching user record, create new one if non-existant """
-      qs = User.objects.filter(name=username)
-      if len(qs) == 0:
+      user = self.users.get(username)
+      if user == None:
          user = User() 
          user.name = username
          user.save()
-         return user
-      else:
-         return qs[0]
+         self.users.add(user)
+      return user
 
    def addFile(self, filename):
       file = File()
@@ -48,55 +482,179 @@ class RepositoryScanner:
       file.last_change = datetime.fromtimestamp(0)
       file.last_rev = None
       file.save()
+      self.files.add(file)
       print "Added %s" % (filename)
       return file
 
-   def addChange(self, file, rev):
-      print "Adding change %s %s" % (file.name, rev.string)
+   def addChange(self, file, change):
+      print "Adding change %s %s" % (file.name, change.rev_new)
       c = Change()
       c.file = file
-      c.user = self.checkUser(rev.author)
-      c.commit_time = datetime.fromtimestamp(rev.date)
-      c.rev_old = previousRev(rev.number)
-      c.rev_new = rev.string
-      c.logmessage = unicode(rev.log, "iso-8859-1").encode("utf-8")
-      c.diffstat = rev.changed or 'new'
-      c.save()
+      c.user = self.checkUser(change.author)
+      c.commit_time = change.date
+      c.rev_old = change.rev_old
+      c.rev_new = change.rev_new
+      c.log_id = self.logs.intern(
+                     unicode(change.log, "iso-8859-1").encode("utf-8"))
+      c.diffstat = change.diffstat
+      self.writer.updateChangeset(self.changesets.assign(c, change.commitid,
+                                                         change.lines))
+      self.writer.addChange(c)
+      self.added += 1
+
+   def filename(self, path):
+      """ Returns the name of the file whose RCS file is at path, None
+          if it is not a file of the repository """
+      root = os.path.join(watcher.realpath(self.r.path), '')
+      if not path.startswith(root) or not path.endswith(',v'):
+         return None
+      parts = path[len(root):-2].split(os.sep)
+      if parts[0] == 'CVSROOT':
+         return None
+      if len(parts) > 1 and parts[-2] == 'Attic':
+         del parts[-2]
+      return os.path.join('.', *parts)
 
    def checkFile(self, filename):
-      qs = File.objects.filter(repository=self.r).filter(name=filename)
-      if len(qs) == 1:
-         return qs[0]
-      elif len(qs) == 0:
-         return None 
-      else:
-         raise Bug()
+      return self.files.get(filename)
 
    def handleFile(self, filename):
       file = self.checkFile(filename)
-      if file == None:
-         file = self.addFile(filename)
-
-      # if timestamps match: no change since last scan, skip
-      timestamp = self.repo.getTimestamp(filename)
-      if timestamp == file.last_change:
+      try:
+         if file == None:
+            scan = self.repo.scanFile(filename)
+         else:
+            scan = self.repo.scanFile(filename, file.last_change, file.last_rev)
+      except UnknownFile:
+         # removed from the repository by hand since the commit
+         print "Skipping unknown file %s" % (filename)
          return
+      if scan:
+         self.storeScan(scan, file)
 
-      # if revision has not changed, update timestamp and continue
-      revlist = self.repo.getRevisions(filename)
-      rev = revlist.getNewest()
-      if rev.string == file.last_rev:
-         print "%s: %s/%s" % (file.name, rev.string, file.last_rev)
-         file.last_change = timestamp
-         file.save()
-         return
+   def storeScan(self, scan, file):
+      """ Writes the result of scanning a file to the database. """
+      self.scanned += 1
+      if file == None:
+         file = self.addFile(scan.filename)
+
+      # if revision has not changed only the timestamp is updated
+      if not scan.changes:
+         print "%s: %s/%s" % (file.name, scan.newest, file.last_rev)
 
       # add all changes since last known revision
-      for rev in revlist.getSince(file.last_rev):
-         self.addChange(file, rev)
+      for change in scan.changes:
+         self.addChange(file, change)
 
       # update timestamp and revision
-      file.last_change = timestamp
-      file.last_rev = revlist.getNewest().string
-      file.save()
+      file.last_change = scan.timestamp
+      file.last_rev = scan.newest
+      self.writer.updateFile(file)
+
+def cacheSummary(users, logs):
+   """ Prints the lookups of the user and log caches, which the scanners
+       of all repositories share """
+   print "user cache %s, log cache %s" % (users, logs)
+
+def scanRepositories(repositories, full=False, jobs=1, batchsize=1000):
+   """ Scans several repositories. With more than one job the RCS files
+       are parsed in a pool of worker processes, while the results are
+       written to the database by this process only. """
+   writer = ChangeWriter(batchsize, diffcache(), blamecache())
+   users = Cache(User.objects.all())
+   logs = LogCache()
+   scanners = [RepositoryScanner(r, writer, users, logs)
+               for r in repositories]
+   if jobs <= 1 or multiprocessing is None:
+      for scanner in scanners:
+         print "Scanning %s" % scanner.r.name
+         scanner.run(full)
+      cacheSummary(users, logs)
+      return
+
+   tasks = []
+   for key in range(len(scanners)):
+      print "Scanning %s" % scanners[key].r.name
+      filenames = scanners[key].prepare(full)
+      tasks += scanners[key].tasks(key, filenames)
+
+   # workers must not share the database connection of this process
+   connection.close()
+   pool = multiprocessing.Pool(jobs)
+   writer.begin()
+   try:
+      for (key, scans) in pool.imap_unordered(scanFiles, tasks):
+         for scan in scans:
+            scanner = scanners[key]
+            scanner.storeScan(scan, scanner.checkFile(scan.filename))
+      for scanner in scanners:
+         scanner.finish()
+      writer.flush()
+   finally:
+      writer.end()
+      pool.terminate()
+   for scanner in scanners:
+      scanner.summary()
+   cacheSummary(users, logs)
 
+def watchRepositories(repositories, delay=2, interval=5):
+   """ Scans several repositories, then keeps scanning the files whose
+       RCS files change, delay seconds after the last change to each.
+       Changes are noticed through inotify, or by polling every interval
+       seconds where it is not available. Runs until interrupted. """
+   writer = ChangeWriter(diffs=diffcache(), blames=blamecache())
+   users = Cache(User.objects.all())
+   logs = LogCache()
+   scanners = [RepositoryScanner(r, writer, users, logs)
+               for r in repositories]
+   # watch before the first scan, so no commit falls in between
+   watch = watcher.watcher([scanner.r.path for scanner in scanners],
+                           interval)
+   pending = watcher.Debouncer(delay)
+   try:
+      for scanner in scanners:
+         print "Scanning %s" % scanner.r.name
+         scanner.run()
+         scanner.changesets.prune()
+      cacheSummary(users, logs)
+      while True:
+         # the history up to here belongs to changes read below
+         offsets = []
+         for scanner in scanners:
+            try:
+               offsets.append(scanner.repo.getHistoryEnd())
+            except HistoryUnavailable:
+               offsets.append(None)
+         for path in watch.changes(pending.timeout()):
+            pending.add(path)
+         paths = pending.due()
+         if not paths:
+            continue
+         writer.begin()
+         try:
+            for path in paths:
+               for scanner in scanners:
+                  filename = scanner.filename(path)
+                  if filename is None:
+                     continue
+                  try:
+                     scanner.handleFile(filename)
+                  except READ_ERRORS, e:
+                     print "Skipping %s: %s" % (filename, e)
+            if not pending:
+               # the next run of scan.py starts from here
+               for (scanner, offset) in zip(scanners, offsets):
+                  if offset is not None:
+                     scanner.offset = offset
+                     scanner.finish()
+            writer.flush()
+         finally:
+            writer.end()
+         # only recent changesets may still grow, the others would pile
+         # up for as long as this runs
+         for scanner in scanners:
+            scanner.changesets.prune()
+         # don't hold on to the database connection while idle
+         connection.close()
+   finally:
+      watch.close()
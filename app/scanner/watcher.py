@@ -0,0 +1,391 @@
+#!/usr/bin/python2.5
+# vim:set tabstop=3 shiftwidth=3 expandtab:
+# vim:set autoindent smarttab nowrap:
+
+""" Watches repository trees for changed RCS files.
+
+    InotifyWatcher is told about changes by the Linux kernel, through
+    ctypes as python has no inotify module. PollingWatcher works
+    everywhere else: it stats the directories of the trees and only
+    lists and stats the files of those that changed. CVS and RCS write
+    a file by renaming a new one over it, which changes the directory.
+
+    Both return the paths of the RCS files changed since they were last
+    asked. Editors and commits touch a file several times in a row, the
+    Debouncer holds back a path until it has been quiet for a while. """
+
+import os
+import sys
+import stat
+import time
+import errno
+import select
+import struct
+import shutil
+import tempfile
+import unittest
+
+try:
+   import ctypes
+   import ctypes.util
+except ImportError:
+   # python < 2.5, poll
+   ctypes = None
+
+def isrcsfile(path):
+   return path.endswith(',v')
+
+def realpath(path):
+   """ Returns the real path as a byte string, which is what the paths
+       of changed files are """
+   if isinstance(path, unicode):
+      path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+   return os.path.realpath(path)
+
+def toplevel(paths):
+   """ Returns the real paths, without those inside another one """
+   paths = [realpath(path) for path in paths]
+   return [path for path in paths
+           if not [other for other in paths
+                   if path.startswith(os.path.join(other, ''))]]
+
+def rcsfiles(top):
+   """ Returns the paths of all RCS files below a directory """
+   ret = []
+   for dirpath, dirnames, filenames in os.walk(top):
+      ret += [os.path.join(dirpath, name) for name in filenames
+              if isrcsfile(name)]
+   return ret
+
+def watcher(paths, interval=5):
+   """ Returns an InotifyWatcher for the trees at paths, or a
+       PollingWatcher polling every interval seconds if inotify is not
+       available. """
+   try:
+      return InotifyWatcher(paths)
+   except EnvironmentError, e:
+      print "inotify unavailable (%s), polling every %s seconds" % (
+               e, interval)
+      return PollingWatcher(paths, interval)
+
+class Debouncer:
+   """ Paths that changed, each due once it had no change for delay
+       seconds, or maxdelay seconds after its first change. """
+   def __init__(self, delay=2, maxdelay=30):
+      self.delay = delay
+      self.maxdelay = maxdelay
+      # path -> [first change, last change]
+      self.paths = {}
+
+   def __len__(self):
+      return len(self.paths)
+
+   def add(self, path, now=None):
+      if now is None:
+         now = time.time()
+      times = self.paths.setdefault(path, [now, now])
+      times[1] = now
+
+   def when(self, path):
+      first, last = self.paths[path]
+      return min(last + self.delay, first + self.maxdelay)
+
+   def timeout(self, now=None):
+      """ Returns the seconds until the next path is due, None if there
+          are no paths """
+      if not self.paths:
+         return None
+      if now is None:
+         now = time.time()
+      return max(0, min([self.when(path) for path in self.paths]) - now)
+
+   def due(self, now=None):
+      """ Returns and forgets the paths which are due """
+      if now is None:
+         now = time.time()
+      ret = [path for path in self.paths if self.when(path) <= now]
+      for path in ret:
+         del self.paths[path]
+      ret.sort()
+      return ret
+
+class PollingWatcher:
+   """ Finds changed RCS files by polling. A directory is listed again
+       when its mtime changed, or changed shortly before it was last
+       listed, as the mtime of a directory changed twice within its
+       resolution stays the same. """
+   def __init__(self, paths, interval=5):
+      self.interval = interval
+      self.tops = toplevel(paths)
+      # directory -> mtime when it was listed
+      self.dirs = {}
+      # directories to list on the next poll regardless of their mtime
+      self.recent = {}
+      # directory -> {RCS file -> (inode, mtime, size)}
+      self.files = {}
+      self.last = time.time()
+      # the initial listing only records what is there
+      self.initial = 1
+      for top in self.tops:
+         self.scan(top)
+      self.initial = 0
+
+   def close(self):
+      pass
+
+   def changes(self, timeout=None):
+      """ Waits until the next poll, at most timeout seconds, and
+          returns the paths of the RCS files changed since the last """
+      wait = self.last + self.interval - time.time()
+      if timeout is not None and timeout < wait:
+         time.sleep(max(0, timeout))
+         return []
+      if wait > 0:
+         time.sleep(wait)
+      self.last = time.time()
+      changed = []
+      recent, self.recent = self.recent, {}
+      for dir, mtime in self.dirs.items():
+         try:
+            current = os.stat(dir)[stat.ST_MTIME]
+         except OSError:
+            self.forget(dir)
+            continue
+         if current != mtime or recent.has_key(dir):
+            changed += self.scan(dir, 0)
+      changed.sort()
+      return changed
+
+   def scan(self, dir, recurse=1):
+      """ Lists a directory, its new subdirectories, and with recurse
+          all subdirectories. Returns the RCS files changed since the
+          last listing. """
+      try:
+         now = time.time()
+         mtime = os.stat(dir)[stat.ST_MTIME]
+         names = os.listdir(dir)
+      except OSError:
+         self.forget(dir)
+         return []
+      if not self.dirs.has_key(dir):
+         recurse = 1
+      self.dirs[dir] = mtime
+      if mtime >= int(now) - 1:
+         self.recent[dir] = 1
+      changed = []
+      known = self.files.get(dir, {})
+      files = {}
+      for name in names:
+         path = os.path.join(dir, name)
+         try:
+            info = os.stat(path)
+         except OSError:
+            continue
+         if stat.S_ISDIR(info[stat.ST_MODE]):
+            if recurse or not self.dirs.has_key(path):
+               changed += self.scan(path)
+         elif isrcsfile(name):
+            files[path] = (info[stat.ST_INO], info[stat.ST_MTIME],
+                           info[stat.ST_SIZE])
+            if known.get(path) != files[path] and not self.initial:
+               changed.append(path)
+      self.files[dir] = files
+      return changed
+
+   def forget(self, dir):
+      """ Drops a removed directory and everything below it """
+      prefix = os.path.join(dir, '')
+      for table in (self.dirs, self.recent, self.files):
+         for path in table.keys():
+            if path == dir or path.startswith(prefix):
+               del table[path]
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+class InotifyWatcher:
+   """ Finds changed RCS files with inotify, watching every directory
+       of the trees. Raises EnvironmentError if inotify is not
+       available or the trees have more directories than may be
+       watched. """
+   mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+   event = struct.Struct('iIII')
+
+   def __init__(self, paths):
+      if ctypes is None:
+         raise EnvironmentError(errno.ENOSYS, "no ctypes")
+      if not hasattr(ctypes, 'get_errno'):
+         # python < 2.6, failed calls could not be told apart
+         raise EnvironmentError(errno.ENOSYS, "no ctypes.get_errno")
+      libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+      if not hasattr(libc, 'inotify_init'):
+         raise EnvironmentError(errno.ENOSYS, "no inotify")
+      self.libc = libc
+      self.fd = libc.inotify_init()
+      if self.fd < 0:
+         self.fail()
+      self.tops = toplevel(paths)
+      # watch descriptor -> directory
+      self.dirs = {}
+      try:
+         for top in self.tops:
+            self.watch(top)
+      except EnvironmentError:
+         self.close()
+         raise
+
+   def close(self):
+      if self.fd >= 0:
+         os.close(self.fd)
+         self.fd = -1
+
+   def fail(self):
+      code = ctypes.get_errno()
+      raise EnvironmentError(code, os.strerror(code))
+
+   def watch(self, top):
+      """ Watches a directory and all below it, returns the RCS files
+          in them, which may have been written before the watch """
+      found = []
+      for dirpath, dirnames, filenames in os.walk(top):
+         wd = self.libc.inotify_add_watch(self.fd, dirpath, self.mask)
+         if wd < 0:
+            if ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR):
+               # removed while walking
+               continue
+            self.fail()
+         self.dirs[wd] = dirpath
+         found += [os.path.join(dirpath, name) for name in filenames
+                   if isrcsfile(name)]
+      return found
+
+   def changes(self, timeout=None):
+      """ Waits at most timeout seconds for changes, None for as long as
+          it takes, and returns the paths of the changed RCS files """
+      changed = {}
+      while select.select([self.fd], [], [], timeout)[0]:
+         for path in self.read():
+            changed[path] = 1
+         # take what arrived together, don't wait for more
+         timeout = 0
+      changed = changed.keys()
+      changed.sort()
+      return changed
+
+   def read(self):
+      data = os.read(self.fd, 65536)
+      changed = []
+      pos = 0
+      while pos < len(data):
+         wd, mask, cookie, length = self.event.unpack_from(data, pos)
+         pos += self.event.size
+         name = data[pos:pos + length].rstrip('\0')
+         pos += length
+         if mask & IN_Q_OVERFLOW:
+            # events were lost, all files might have changed
+            for top in self.tops:
+               changed += rcsfiles(top)
+            continue
+         if mask & IN_IGNORED:
+            # the directory was removed
+            self.dirs.pop(wd, None)
+            continue
+         dir = self.dirs.get(wd)
+         if dir is None or not name:
+            continue
+         path = os.path.join(dir, name)
+         if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+               changed += self.watch(path)
+         elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and isrcsfile(name):
+            changed.append(path)
+      return changed
+
+
+class DebouncerTest(unittest.TestCase):
+   def testQuiet(self):
+      d = Debouncer(2, 30)
+      self.assert_(d.timeout(0) is None)
+      d.add('a,v', 0)
+      d.add('a,v', 1)
+      d.add('b,v', 2)
+      self.assert_(d.timeout(1) == 2)
+      self.assert_(d.due(2.5) == [])
+      self.assert_(d.due(3) == ['a,v'])
+      self.assert_(d.due(10) == ['b,v'])
+      self.assert_(len(d) == 0)
+
+   def testMaxDelay(self):
+      d = Debouncer(2, 5)
+      for now in range(10):
+         d.add('a,v', now)
+         if now == 4:
+            self.assert_(d.due(now) == [])
+      self.assert_(d.due(9) == ['a,v'])
+
+class WatcherTest(unittest.TestCase):
+   def setUp(self):
+      self.dir = os.path.realpath(tempfile.mkdtemp())
+      self.write('a,v')
+      self.write('README')
+
+   def tearDown(self):
+      shutil.rmtree(self.dir)
+
+   def write(self, name):
+      # the way RCS writes files, by renaming a new one over them
+      path = os.path.join(self.dir, name)
+      temp = os.path.join(os.path.dirname(path), ',new,')
+      open(temp, 'w').write(name)
+      os.rename(temp, path)
+      return path
+
+   def check(self, w):
+      try:
+         self.assert_(w.changes(0) == [])
+         changed = [self.write('a,v'), self.write('b,v')]
+         self.write('README')
+         self.assert_(w.changes(1) == changed)
+         self.assert_(w.changes(0) == [])
+         os.makedirs(os.path.join(self.dir, 'sub', 'Attic'))
+         changed = [self.write('sub/Attic/c,v')]
+         self.assert_(w.changes(1) == changed)
+         self.write('sub/Attic/c,v')
+         self.assert_(w.changes(1) == changed)
+      finally:
+         w.close()
+
+   def testPolling(self):
+      self.check(PollingWatcher([self.dir, os.path.join(self.dir, 'sub')],
+                                0))
+
+   def testNoErrno(self):
+      # ctypes of python 2.5, which has no get_errno, polls
+      global ctypes
+      saved = ctypes
+      class OldCtypes:
+         pass
+      ctypes = OldCtypes()
+      try:
+         w = watcher([self.dir], 0)
+      finally:
+         ctypes = saved
+      self.assert_(isinstance(w, PollingWatcher))
+      w.close()
+
+   def testInotify(self):
+      try:
+         w = InotifyWatcher([self.dir])
+      except EnvironmentError:
+         print >> sys.stderr, "inotify unavailable, not tested"
+         return
+      self.check(w)
+
+if __name__ == '__main__':
+   unittest.main()
@@ -22,6 +22,49 @@ DATABASE_PASSWORD = ''
 DATABASE_HOST = ''
 DATABASE_PORT = ''
 
+# Parsed RCS files are cached in this directory, at most RCS_CACHE_SIZE
+# bytes. Set to None to disable the cache.
+RCS_CACHE_DIR = os.path.join(SITE_ROOT, 'db', 'rcscache')
+RCS_CACHE_SIZE = 256 * 1024 * 1024
+
+# The diffs of changes are cached in this directory, at most
+# DIFF_CACHE_SIZE bytes, and the recently viewed ones in memory, at most
+# DIFF_CACHE_MEMORY bytes per process. The scanner makes the diffs of new
+# changes committed in the last DIFF_CACHE_WARM days, 0 to leave them to
+# the first view. Set DIFF_CACHE_DIR to None to disable the cache.
+DIFF_CACHE_DIR = os.path.join(SITE_ROOT, 'db', 'diffcache')
+DIFF_CACHE_SIZE = 256 * 1024 * 1024
+DIFF_CACHE_MEMORY = 32 * 1024 * 1024
+DIFF_CACHE_WARM = 7
+
+# The blame of a revision is kept in this directory, at most
+# BLAME_CACHE_SIZE bytes, and blame of later revisions starts from it.
+# The scanner adds the new revisions of files blamed before. Set to None
+# to disable the cache.
+BLAME_CACHE_DIR = os.path.join(SITE_ROOT, 'db', 'blamecache')
+BLAME_CACHE_SIZE = 64 * 1024 * 1024
+
+# The full texts of every SNAPSHOT_INTERVAL-th revision of a file are kept
+# in this directory, at most SNAPSHOT_SIZE bytes, so checking out an old
+# revision applies at most about that many deltas. Set to None to disable.
+SNAPSHOT_DIR = os.path.join(SITE_ROOT, 'db', 'snapshots')
+SNAPSHOT_INTERVAL = 50
+SNAPSHOT_SIZE = 256 * 1024 * 1024
+
+# How diffs are generated: 'internal' diffs in-process, 'external' runs
+# the diff program. Can be overridden per repository.
+DIFF_ENGINE = 'internal'
+
+# A diff is shown up to this many lines or bytes at a time, the rest is
+# loaded on request.
+DIFF_LINE_LIMIT = 2000
+DIFF_BYTE_LIMIT = 256 * 1024
+
+# Changes by the same user with the same log message are grouped into one
+# changeset if they are at most this many seconds apart. Commits made
+# with CVS 1.12 or later are grouped by their commitid instead.
+CHANGESET_WINDOW = 300
+
 TIME_ZONE = 'Europe/Berlin'
 LANGUAGE_CODE = 'en-us'
 
@@ -4,17 +4,24 @@
 from django.conf.urls.defaults import *
 import settings
 
+# position in the changes feed, see webreview.views.makecursor
+cursor = r'\d{14}(?:\.\d{6})?-\d+'
+
 urlpatterns = patterns('',
     (r'^$',                               'webreview.views.index'),
-    (r'^skip/(?P<skip>.*)$',              'webreview.views.changes'),
     (r'^diff/(?P<change_id>.*)/html$',    'webreview.views.diffhtml'),
+    (r'^changeset/(?P<changeset_id>\d+)/diffs$', 'webreview.views.changesetdiffs'),
+    (r'^blame/(?P<change_id>\d+)/html$',  'webreview.views.blamehtml'),
     (r'^addmodule$',                      'webreview.views.addmodule'),
     (r'^login$',                          'webreview.views.login'),
 
-    (r'^changes/all/skip/(?P<skip>\d+)$',                                'webreview.views.index'),
+    (r'^changes/all/after/(?P<after>%s)$' % cursor,                      'webreview.views.index'),
     (r'^changes/all$',                                                   'webreview.views.index'),
-    (r'^changes/(?P<filter>.*)/(?P<filter_id>\d+)/skip/(?P<skip>\d*)$',  'webreview.views.changes'),
+    (r'^changes/(?P<filter>.*)/(?P<filter_id>\d+)/after/(?P<after>%s)$' % cursor, 'webreview.views.changes'),
     (r'^changes/(?P<filter>.*)/(?P<filter_id>\d+)$',                     'webreview.views.changes'),
 
+    (r'^search/after/(?P<after>\d+)$',                                   'webreview.views.search'),
+    (r'^search$',                                                        'webreview.views.search'),
+
     (r'^static/(?P<path>.*)$', 'django.views.static.serve', {'document_root': settings.MEDIA_ROOT}),
 )
@@ -231,11 +231,11 @@ class _diff_fp:
     self.temp2 = temp2
     args = diff_opts[:]
     if info1 and info2:
-      args.extend(["-L", self._label(info1), "-L", self._label(info2)])
+      args.extend(["-L", _diff_label(info1), "-L", _diff_label(info2)])
     args.extend([temp1, temp2])
     self.fp = popen.popen("diff", args, "r")
 
-  def read(self, bytes):
+  def read(self, bytes=-1):
     return self.fp.read(bytes)
 
   def readline(self):
@@ -259,6 +259,7 @@ class _diff_fp:
   def __del__(self):
     self.close()
 
-  def _label(self, (path, date, rev)):
-    date = date and time.strftime('%Y/%m/%d %H:%M:%S', time.gmtime(date))
-    return "%s\t%s\t%s" % (path, date, rev)
+def _diff_label((path, date, rev)):
+  """generate the label of a file in a diff"""
+  date = date and time.strftime('%Y/%m/%d %H:%M:%S', time.gmtime(date))
+  return "%s\t%s\t%s" % (path, date, rev)
@@ -16,11 +16,12 @@ This is a Version Control library driver for locally accessible cvs-repositories
 
 import os
 import string
-import re
 import cStringIO
 import tempfile
+import unittest
 
 import vclib
+import vclib.pydiff
 import rcsparse
 import blame
 
@@ -30,6 +31,31 @@ from vclib.bincvs import CVSRepository, Revision, Tag, \
                          _file_log, _log_path
 
 class CCVSRepository(CVSRepository):
+  def __init__(self, name, rootpath, cache=None, diff_engine='internal',
+               blamecache=None, snapshots=None):
+    """cache is an optional rcscache.RCSCache used for all parsing.
+
+    diff_engine selects how rawdiff() compares revisions, 'internal' to
+    diff in-process, 'external' to run the diff program. The diff
+    program is also used for diff types the internal engine lacks.
+
+    blamecache is an optional blamecache.BlameCache which keeps the
+    results of annotate().
+
+    snapshots is an optional snapshots.SnapshotCache, checkouts then
+    start from the nearest texts stored in it."""
+    CVSRepository.__init__(self, name, rootpath)
+    self.cache = cache
+    self.diff_engine = diff_engine
+    self.blamecache = blamecache
+    self.snapshots = snapshots
+
+  def _parse(self, path, sink):
+    if self.cache:
+      self.cache.parse(path, sink)
+    else:
+      rcsparse.Parser().parse(open(path, 'rb'), sink)
+
   def dirlogs(self, path_parts, rev, entries, options):
     """see vclib.Repository.dirlogs docstring
 
@@ -61,7 +87,7 @@ class CCVSRepository(CVSRepository):
       if path:
         entry.path = path
         try:
-          rcsparse.Parser().parse(open(path, 'rb'), InfoSink(entry, rev, alltags))
+          self._parse(path, InfoSink(entry, rev, alltags))
         except IOError, e:
           entry.errors.append("rcsparse error: %s" % e)
         except RuntimeError, e:
@@ -84,49 +110,143 @@ class CCVSRepository(CVSRepository):
     or None. If None, will return information about all revisions, otherwise,
     will only return information about the specified revision or branch.
 
+    Option values recognized by this implementation:
+
+      cvs_newer_than
+        revision string. if set, log messages and lines changed are only
+        read for revisions with a later date than this revision, the
+        deltatexts of all other revisions are skipped
+
+    Without cvs_newer_than the trunk revisions also get a "lines"
+    attribute with the number of lines of their text.
+
     Option values returned by this implementation:
 
       cvs_tags
         dictionary of Tag objects for all tags encountered
     """
     path = self.rcsfile(path_parts, 1)
-    sink = TreeSink()
-    rcsparse.Parser().parse(open(path, 'rb'), sink)
+    sink = TreeSink(options.get('cvs_newer_than'))
+    try:
+      self._parse(path, sink)
+    except rcsparse.RCSStopParser:
+      pass
     filtered_revs = _file_log(sink.revs.values(), sink.tags,
                               sink.default_branch, rev)
     for rev in filtered_revs:
       if rev.prev and len(rev.number) == 2:
-        rev.changed = rev.prev.next_changed
+        rev.changed = getattr(rev.prev, 'next_changed', None)
     options['cvs_tags'] = sink.tags
 
     return filtered_revs
 
   def rawdiff(self, path_parts1, rev1, path_parts2, rev2, type, options={}):
-    temp1 = tempfile.mktemp()
-    open(temp1, 'wb').write(self.openfile(path_parts1, rev1)[0].getvalue())
-    temp2 = tempfile.mktemp()
-    open(temp2, 'wb').write(self.openfile(path_parts2, rev2)[0].getvalue())
+    if self.diff_engine == 'internal' and path_parts1 == path_parts2:
+      try:
+        return self._deltadiff(path_parts1, rev1, rev2, type, options)
+      except NotImplementedError:
+        pass
+
+    if path_parts1 == path_parts2:
+      # both revisions come out of a single pass over the file
+      (lines1, r1, date1), (lines2, r2, date2) = \
+        self._checkout(path_parts1, [rev1, rev2])
+    else:
+      (lines1, r1, date1), = self._checkout(path_parts1, [rev1])
+      (lines2, r2, date2), = self._checkout(path_parts2, [rev2])
+
+    info1 = (self.rcsfile(path_parts1, root=1, v=0), date1, r1)
+    info2 = (self.rcsfile(path_parts2, root=1, v=0), date2, r2)
+    return self._diff(lines1, lines2, info1, info2, type, options)
+
+  def rawdiffs(self, path_parts, pairs, type, options={}):
+    """Return file objects reading the diffs of several (rev1, rev2) pairs
+    of revisions of one file, in the order of the pairs
+
+    Adjacent revisions are diffed from their deltatext like in rawdiff(),
+    all other revisions are checked out in a single pass over the file."""
+    diffs = [None] * len(pairs)
+    if self.diff_engine == 'internal':
+      for i in range(len(pairs)):
+        try:
+          diffs[i] = self._deltadiff(path_parts, pairs[i][0], pairs[i][1],
+                                     type, options)
+        except NotImplementedError:
+          pass
 
-    r1 = self.itemlog(path_parts1, rev1, {})[-1]
-    r2 = self.itemlog(path_parts2, rev2, {})[-1]
+    revs = [ ]
+    for i in range(len(pairs)):
+      if diffs[i] is None:
+        for rev in pairs[i]:
+          if rev not in revs:
+            revs.append(rev)
+    if not revs:
+      return diffs
+    path = self.rcsfile(path_parts, root=1, v=0)
+    checkouts = { }
+    for rev, (lines, r, date) in zip(revs, self._checkout(path_parts, revs)):
+      checkouts[rev] = (lines, (path, date, r))
+    for i in range(len(pairs)):
+      if diffs[i] is None:
+        lines1, info1 = checkouts[pairs[i][0]]
+        lines2, info2 = checkouts[pairs[i][1]]
+        diffs[i] = self._diff(lines1, lines2, info1, info2, type, options)
+    return diffs
+
+  def _diff(self, lines1, lines2, info1, info2, type, options):
+    if self.diff_engine == 'internal':
+      try:
+        return vclib.pydiff.diff(lines1, lines2, info1, info2, type, options)
+      except NotImplementedError:
+        pass
 
-    info1 = (self.rcsfile(path_parts1, root=1, v=0), r1.date, r1.string)
-    info2 = (self.rcsfile(path_parts2, root=1, v=0), r2.date, r2.string)
+    temp1 = tempfile.mktemp()
+    open(temp1, 'wb').write(string.join(lines1, "\n"))
+    temp2 = tempfile.mktemp()
+    open(temp2, 'wb').write(string.join(lines2, "\n"))
 
     diff_args = vclib._diff_args(type, options)
 
     return vclib._diff_fp(temp1, temp2, info1, info2, diff_args)
 
+  def _deltadiff(self, path_parts, rev1, rev2, type, options):
+    """Diff two adjacent revisions by converting the deltatext between
+    them, raises NotImplementedError if that is not possible"""
+    if not vclib.pydiff.delta_supported(type, options):
+      raise NotImplementedError
+    sink = DeltaSink(rev1, rev2)
+    try:
+      self._parse(self.rcsfile(path_parts, 1), sink)
+    except rcsparse.RCSStopParser:
+      pass
+    if sink.delta is None:
+      # the revisions are not adjacent
+      raise NotImplementedError
+    path = self.rcsfile(path_parts, root=1, v=0)
+    return vclib.pydiff.delta_diff(sink.sstext.text, sink.delta, sink.reverse,
+                                   (path, sink.dates[rev1], rev1),
+                                   (path, sink.dates[rev2], rev2),
+                                   type, options)
+
   def annotate(self, path_parts, rev=None):
-    source = blame.BlameSource(self.rcsfile(path_parts, 1), rev)
+    source = blame.BlameSource(self.rcsfile(path_parts, 1), rev, self.cache,
+                               self.blamecache)
     return source, source.revision
 
   def openfile(self, path_parts, rev=None):
+    (lines, revision, date), = self._checkout(path_parts, [rev])
+    return cStringIO.StringIO(string.join(lines, "\n")), revision
+
+  def _checkout(self, path_parts, revs):
+    """Check out several revisions of a file at once, returns a list of
+    (lines split at newlines, revision number, date) tuples"""
     path = self.rcsfile(path_parts, 1)
-    sink = COSink(rev)
-    rcsparse.Parser().parse(open(path, 'rb'), sink)
-    revision = sink.last and sink.last.string
-    return cStringIO.StringIO(string.join(sink.sstext.text, "\n")), revision
+    sink = MultiCOSink(revs, self.snapshots, path)
+    try:
+      self._parse(path, sink)
+    except rcsparse.RCSStopParser:
+      pass
+    return sink.revisions()
 
 class MatchingSink(rcsparse.Sink):
   """Superclass for sinks that search for revisions based on tag or number"""
@@ -207,14 +327,18 @@ class InfoSink(MatchingSink):
       raise rcsparse.RCSStopParser
 
 class TreeSink(rcsparse.Sink):
-  d_command = re.compile('^d(\d+)\\s(\\d+)')
-  a_command = re.compile('^a(\d+)\\s(\\d+)')
-
-  def __init__(self):
+  def __init__(self, newer_than=None):
     self.revs = { }
     self.tags = { }
+    self.next = { }
+    # the trunk revision each trunk deltatext leads from
+    self.newer = { }
     self.head = None
     self.default_branch = None
+    self.newer_than = newer_than
+    # revisions whose log and text are still needed, None for all
+    self.logs = None
+    self.texts = None
 
   def set_head_revision(self, revision):
     self.head = revision
@@ -229,79 +353,91 @@ class TreeSink(rcsparse.Sink):
   def define_revision(self, revision, date, author, state, branches, next):
     # check !revs.has_key(revision)
     self.revs[revision] = Revision(revision, date, author, state == "dead")
+    self.next[revision] = next
+    if next and string.count(revision, '.') == 1:
+      self.newer[next] = revision
+
+  def set_commitid(self, revision, commitid):
+    self.revs[revision].commitid = commitid
+
+  def tree_completed(self):
+    if not self.revs.has_key(self.newer_than):
+      return
+    date = self.revs[self.newer_than].date
+    self.logs = { }
+    self.texts = { }
+    for revision, rev in self.revs.items():
+      if rev.date > date:
+        self.logs[revision] = 1
+        if len(rev.number) > 2:
+          self.texts[revision] = 1
+        elif self.next[revision]:
+          # trunk deltas are reversed, the lines changed by a trunk
+          # revision are found in the deltatext of its predecessor
+          self.texts[self.next[revision]] = 1
+    if not self.logs:
+      raise rcsparse.RCSStopParser
+
+  def want_log(self, revision):
+    return self.logs is None or self.logs.has_key(revision)
+
+  def want_text(self, revision):
+    # the head revision's text is the full file, never a delta, it is
+    # only read for the lines of the trunk revisions when all are read
+    if revision == self.head:
+      return self.texts is None
+    return self.texts is None or self.texts.has_key(revision)
 
   def set_revision_info(self, revision, log, text):
     # check revs.has_key(revision)
     rev = self.revs[revision]
-    rev.log = log
-
-    changed = None
-    added = 0
-    deled = 0
-    if self.head != revision:
-      changed = 1
-      lines = string.split(text, '\n')
-      idx = 0
-      while idx < len(lines):
-        command = lines[idx]
-        dmatch = self.d_command.match(command)
-        idx = idx + 1
-        if dmatch:
-          deled = deled + string.atoi(dmatch.group(2))
-        else:
-          amatch = self.a_command.match(command)
-          if amatch:
-            count = string.atoi(amatch.group(2))
-            added = added + count
-            idx = idx + count
-          elif command:
-            raise "error while parsing deltatext: %s" % command
+    if log is not None:
+      rev.log = log
+
+    if revision == self.head and text is not None:
+      # the lines of the file, those of the older trunk revisions follow
+      # from their deltatexts
+      rev.lines = string.count(text, '\n') + (text[-1:] not in ('', '\n'))
+      text = None
+
+    if text is None:
+      changed = None
+    else:
+      added, deled = blame.diffstat(text)
+      if len(rev.number) == 2:
+        newer = self.revs.get(self.newer.get(revision))
+        if hasattr(newer, 'lines'):
+          rev.lines = newer.lines + added - deled
+        # a trunk delta leads from the revision to its predecessor
+        added, deled = deled, added
+      changed = "+%i -%i" % (added, deled)
 
     if len(rev.number) == 2:
-      rev.next_changed = changed and "+%i -%i" % (deled, added)
+      rev.next_changed = changed
     else:
-      rev.changed = changed and "+%i -%i" % (added, deled)
+      rev.changed = changed
+
+    if self.logs is not None:
+      # stop reading once everything needed has been seen
+      self.logs.pop(revision, None)
+      self.texts.pop(revision, None)
+      if not self.logs and not self.texts:
+        raise rcsparse.RCSStopParser
 
 class StreamText:
-  d_command = re.compile('^d(\d+)\\s(\\d+)')
-  a_command = re.compile('^a(\d+)\\s(\\d+)')
+  """The lines of a revision being checked out. The commands of each
+  delta are parsed once and applied together by blame.apply_delta."""
 
   def __init__(self, text):
     self.text = string.split(text, "\n")
 
+  def copy(self):
+    other = StreamText('')
+    other.text = self.text[:]
+    return other
+
   def command(self, cmd):
-    adjust = 0
-    add_lines_remaining = 0
-    diffs = string.split(cmd, "\n")
-    if diffs[-1] == "":
-      del diffs[-1]
-    if len(diffs) == 0:
-      return
-    if diffs[0] == "":
-      del diffs[0]
-    for command in diffs:
-      if add_lines_remaining > 0:
-        # Insertion lines from a prior "a" command
-        self.text.insert(start_line + adjust, command)
-        add_lines_remaining = add_lines_remaining - 1
-        adjust = adjust + 1
-        continue
-      dmatch = self.d_command.match(command)
-      amatch = self.a_command.match(command)
-      if dmatch:
-        # "d" - Delete command
-        start_line = string.atoi(dmatch.group(1))
-        count      = string.atoi(dmatch.group(2))
-        begin = start_line + adjust - 1
-        del self.text[begin:begin + count]
-        adjust = adjust - count
-      elif amatch:
-        # "a" - Add command
-        start_line = string.atoi(amatch.group(1))
-        count      = string.atoi(amatch.group(2))
-        add_lines_remaining = count
-      else:
-        raise RuntimeError, 'Error parsing diff commands'
+    self.text = blame.apply_delta(self.text, blame.parse_delta(cmd))
 
 def secondnextdot(s, start):
   # find the position the second dot after the start index.
@@ -322,6 +458,21 @@ class COSink(MatchingSink):
     if self.find_tag is None:
       raise vclib.InvalidRevision(self.find)
 
+  def _applies(self, rev):
+    """Return true if the delta of rev is on the way from the head to
+    the revision being checked out"""
+    tag = self.find_tag
+    depth = len(rev.number)
+    if rev.number == self.head.number:
+      return 1
+    if depth == 2:
+      return tag.number and rev.number >= tag.number[:depth]
+    return (rev.number[:depth-1] == tag.number[:depth-1] and
+            (rev.number <= tag.number or len(tag.number) == depth-1))
+
+  def want_text(self, revision):
+    return self._applies(Revision(revision))
+
   def set_revision_info(self, revision, log, text):
     tag = self.find_tag
     rev = Revision(revision)
@@ -329,23 +480,210 @@ class COSink(MatchingSink):
     if rev.number == tag.number:
       self.log = log
 
-    depth = len(rev.number)
+    if not self._applies(rev):
+      return
 
     if rev.number == self.head.number:
       assert self.sstext is None
       self.sstext = StreamText(text)
-    elif (depth == 2 and tag.number and rev.number >= tag.number[:depth]):
+    elif len(rev.number) == 2:
       assert len(self.last.number) == 2
       assert rev.number < self.last.number
       self.sstext.command(text)
-    elif (depth > 2 and rev.number[:depth-1] == tag.number[:depth-1] and
-          (rev.number <= tag.number or len(tag.number) == depth-1)):
+    else:
       assert len(rev.number) - len(self.last.number) in (0, 2)
       assert rev.number > self.last.number
       self.sstext.command(text)
+
+    #print "tag =", tag.number, "rev =", rev.number, "<br>"
+    self.last = rev
+
+
+class MultiCOSink(rcsparse.Sink):
+  """Checks out several revisions of a file in a single pass over the
+  deltatexts. The revisions share one text until their delta chains
+  part, from there on each one is rebuilt on a copy.
+
+  With a snapshots.SnapshotCache each revision starts from the text of
+  the nearest stored revision on the way from the head to it, and the
+  texts of the revisions due for a snapshot that the pass makes are
+  stored. Stops the parser once all revisions are complete."""
+
+  def __init__(self, revs, snapshots=None, path=None):
+    self.sinks = map(COSink, revs)
+    self.snapshots = snapshots
+    self.path = path
+    self.dates = { }
+    # the revisions whose deltas apply to the text of a revision
+    self.children = { }
+    # sink -> the revisions whose deltas are still to be applied to it
+    self.todo = { }
+
+  def set_head_revision(self, revision):
+    for sink in self.sinks:
+      sink.set_head_revision(revision)
+
+  def set_principal_branch(self, branch_number):
+    for sink in self.sinks:
+      sink.set_principal_branch(branch_number)
+
+  def define_tag(self, name, revision):
+    for sink in self.sinks:
+      sink.define_tag(name, revision)
+
+  def admin_completed(self):
+    for sink in self.sinks:
+      sink.admin_completed()
+
+  def define_revision(self, revision, date, author, state, branches, next):
+    self.dates[revision] = date
+    children = list(branches)
+    if next:
+      children.append(next)
+    self.children[revision] = children
+
+  def tree_completed(self):
+    # stored texts by revision, a seed shared by several sinks is one text
+    seeds = { }
+    for sink in self.sinks:
+      way = [ ]
+      revision = sink.head.string
+      while revision:
+        way.append(revision)
+        children = filter(lambda child, sink=sink:
+                            sink._applies(Revision(child)),
+                          self.children.get(revision, [ ]))
+        revision = children and children[0]
+      if self.snapshots:
+        for i in range(len(way) - 1, 0, -1):
+          if not self.snapshots.due(way[i]):
+            continue
+          if not seeds.has_key(way[i]):
+            text = self.snapshots.get(self.path, way[i], self.dates[way[i]])
+            seeds[way[i]] = text is not None and StreamText(text)
+          if seeds[way[i]]:
+            sink.sstext = seeds[way[i]]
+            sink.last = Revision(way[i])
+            way = way[i+1:]
+            break
+      todo = self.todo[id(sink)] = { }
+      for revision in way:
+        todo[revision] = 1
+    self._check_done()
+
+  def want_text(self, revision):
+    for todo in self.todo.values():
+      if todo.has_key(revision):
+        return 1
+    return 0
+
+  def set_revision_info(self, revision, log, text):
+    # group the sinks the delta applies to by the text they share
+    groups = { }
+    for sink in self.sinks:
+      if self.todo[id(sink)].has_key(revision):
+        del self.todo[id(sink)][revision]
+        groups.setdefault(id(sink.sstext), [ ]).append(sink)
+
+    rev = Revision(revision)
+    for group in groups.values():
+      first = group[0]
+      if first.sstext is None:
+        first.sstext = StreamText(text)
+      else:
+        sharing = filter(lambda sink, sstext=first.sstext:
+                           sink.sstext is sstext, self.sinks)
+        if len(sharing) > len(group):
+          # the other revisions still need the text as it is
+          first.sstext = first.sstext.copy()
+        first.sstext.command(text)
+      for sink in group:
+        sink.sstext = first.sstext
+        sink.last = rev
+      # the way to it had no stored text of the revision
+      if (self.snapshots and revision != first.head.string and
+          self.snapshots.due(revision)):
+        self.snapshots.put(self.path, revision, self.dates[revision],
+                           string.join(first.sstext.text, "\n"))
+
+    self._check_done()
+
+  def _check_done(self):
+    for todo in self.todo.values():
+      if todo:
+        return
+    raise rcsparse.RCSStopParser
+
+  def revisions(self):
+    """Return (lines, revision number, date) for each requested revision"""
+    result = [ ]
+    for sink in self.sinks:
+      revision = sink.last and sink.last.string
+      result.append((sink.sstext.text, revision, self.dates.get(revision)))
+    return result
+
+
+class DeltaSink(COSink):
+  """Checks out one of two adjacent revisions along with the deltatext
+  that turns it into the other one. Stops the parser once both have been
+  read, or once the tree shows that the revisions are not adjacent."""
+
+  def __init__(self, rev1, rev2):
+    COSink.__init__(self, None)
+    self.rev1 = rev1
+    self.rev2 = rev2
+    # the revision whose text the deltatext of a revision applies to
+    self.parents = { }
+    self.dates = { }
+    self.deltarev = None
+    self.delta = None
+
+  def define_revision(self, revision, date, author, state, branches, next):
+    self.dates[revision] = date
+    if next:
+      self.parents[next] = revision
+    for branch in branches:
+      self.parents[branch] = revision
+
+  def tree_completed(self):
+    # tags and branch names are not looked up, only revision numbers
+    if not (self.dates.has_key(self.rev1) and self.dates.has_key(self.rev2)):
+      raise rcsparse.RCSStopParser
+    if self.parents.get(self.rev2) == self.rev1:
+      # forward delta on a branch
+      base, self.deltarev, self.reverse = self.rev1, self.rev2, 0
+    elif self.parents.get(self.rev1) == self.rev2:
+      # reverse delta on the trunk
+      base, self.deltarev, self.reverse = self.rev2, self.rev1, 1
     else:
-      rev = None
+      raise rcsparse.RCSStopParser
+    self.find_tag = Tag(None, base)
+
+  def want_text(self, revision):
+    return revision == self.deltarev or COSink.want_text(self, revision)
+
+  def set_revision_info(self, revision, log, text):
+    if revision == self.deltarev:
+      self.delta = text
+    COSink.set_revision_info(self, revision, log, text)
+    # the deltatexts leading to a revision precede those of its children
+    if self.delta is not None and self.last and \
+       self.last.number == self.find_tag.number:
+      raise rcsparse.RCSStopParser
+
+
+class StreamTextTest(unittest.TestCase):
+  def testCommands(self):
+    # a single command is applied in place, many in one pass
+    for delta in ('d2 1\n', 'd2 1\na3 1\nx\nd5 2\na8 2\ny\nz\n'):
+      text = StreamText('1\n2\n3\n4\n5\n6\n7\n8\n9')
+      text.command(delta)
+      if len(delta) == 5:
+        self.assert_(text.text == ['1', '3', '4', '5', '6', '7', '8', '9'])
+      else:
+        self.assert_(text.text == ['1', '3', 'x', '4', '7', '8', 'y', 'z',
+                                   '9'])
+
 
-    if rev:
-      #print "tag =", tag.number, "rev =", rev.number, "<br>"
-      self.last = rev
+if __name__ == '__main__':
+  unittest.main()
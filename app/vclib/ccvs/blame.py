@@ -30,6 +30,8 @@ import string
 import re
 import time
 import math
+import array
+import unittest
 import rcsparse
 
 class CVSParser(rcsparse.Sink):
@@ -42,7 +44,8 @@ class CVSParser(rcsparse.Sink):
 
   SECONDS_PER_DAY = 86400
 
-  def __init__(self):
+  def __init__(self, cache=None):
+    self.cache = cache
     self.Reset()
 
   def Reset(self):
@@ -267,8 +270,12 @@ class CVSParser(rcsparse.Sink):
       raise RuntimeError, ('error: %s appeared to be under CVS control, ' +
               'but the RCS file is inaccessible.') % rcs_pathname
 
-    rcsparse.Parser().parse(rcsfile, self)
-    rcsfile.close()
+    if self.cache:
+      rcsfile.close()
+      self.cache.parse(rcs_pathname, self)
+    else:
+      rcsparse.Parser().parse(rcsfile, self)
+      rcsfile.close()
 
     if opt_rev in [None, '', 'HEAD']:
       # Explicitly specified topmost revision in tree
@@ -412,21 +419,363 @@ class CVSParser(rcsparse.Sink):
     return revision
 
 
+_command = re.compile('^([ad])(\\d+)\\s(\\d+)')
+
+def parse_delta(text):
+  """Split a deltatext into its commands, (start, count, None) to delete
+  count lines from line start on and (start, count, lines) to add the
+  lines after line start. Line numbers refer to the text the delta is
+  applied to."""
+  commands = [ ]
+  lines = string.split(text, '\n')
+  if lines[-1] == '':
+    del lines[-1]
+  if lines and lines[0] == '':
+    del lines[0]
+  i = 0
+  while i < len(lines):
+    match = _command.match(lines[i])
+    if not match:
+      raise RuntimeError, 'Error parsing diff commands'
+    start = int(match.group(2))
+    count = int(match.group(3))
+    if match.group(1) == 'a':
+      commands.append((start, count, lines[i+1:i+1+count]))
+      i = i + 1 + count
+    else:
+      commands.append((start, count, None))
+      i = i + 1
+  return commands
+
+def apply_delta(lines, commands):
+  """Return a list of lines with the commands of a delta applied.
+
+  Each command moves the lines after it when applied to the list in
+  place. A few commands are applied that way, last first so the line
+  numbers of the others stay valid, which leaves the list to the one
+  who passed it. Otherwise a new list is built in a single pass that
+  copies the unchanged stretches as slices, which costs about as much
+  as moving all lines a few dozen times."""
+  moved = 0
+  for command in commands:
+    moved = moved + len(lines) - command[0]
+  if moved <= 32 * len(lines):
+    commands = commands[:]
+    commands.reverse()
+    for start, count, added in commands:
+      if added is None:
+        del lines[start-1:start-1+count]
+      else:
+        lines[start:start] = added
+    return lines
+
+  result = [ ]
+  pos = 0
+  for start, count, added in commands:
+    if added is None:
+      result.extend(lines[pos:start-1])
+      pos = start - 1 + count
+    else:
+      result.extend(lines[pos:start])
+      pos = start
+      result.extend(added)
+  result.extend(lines[pos:])
+  return result
+
+
+# a command line, after the empty lines before it
+_stat_command = re.compile('\\n*([ad])(\\d+)[ \t](\\d+)[^\\n]*\\n?')
+
+def diffstat(text):
+  """Return the number of lines added and deleted by a deltatext.
+
+  The text is walked by offsets instead of being split into lines. The
+  lines added by an 'a' command are skipped by finding their newlines,
+  a few one by one, more with a pattern matching as many lines."""
+  added = 0
+  deled = 0
+  pos = 0
+  end = len(text)
+  command = _stat_command.match
+  find = text.find
+  while pos < end:
+    match = command(text, pos)
+    if not match:
+      if string.strip(text[pos:], '\n'):
+        raise RuntimeError, 'error while parsing deltatext at %d' % pos
+      break
+    kind, count = match.group(1, 3)
+    count = int(count)
+    pos = match.end()
+    if kind == 'd':
+      deled = deled + count
+      continue
+    added = added + count
+    while count > 4 and pos >= 0:
+      skip = min(count, 10000)
+      match = re.compile('(?:[^\\n]*\\n){%d}' % skip).match(text, pos)
+      pos = match and match.end() or -1
+      count = count - skip
+    while count and pos >= 0:
+      pos = find('\n', pos)
+      if pos >= 0:
+        pos = pos + 1
+      count = count - 1
+    if pos < 0:
+      # the last added line has no newline
+      break
+  return added, deled
+
+class RevisionMap:
+  """The revision that added each line of a revision of a file. The
+  lines hold small numbers standing for the revisions in a compact
+  array. A delta builds a new array in a single pass, copying the
+  lines between its commands once, so applying it takes time in the
+  length of the file however many commands it has."""
+
+  def __init__(self, revision=None, count=0):
+    self.revisions = [ ]
+    self.numbers = { }
+    self.lines = array.array('i')
+    if count:
+      self.lines = array.array('i', [self._number(revision)]) * count
+
+  def __len__(self):
+    return len(self.lines)
+
+  def __iter__(self):
+    revisions = self.revisions
+    for number in self.lines:
+      yield revisions[number]
+
+  def __getstate__(self):
+    return self.revisions, self.lines.tostring()
+
+  def __setstate__(self, state):
+    self.revisions, lines = state
+    self.numbers = { }
+    for number in range(len(self.revisions)):
+      self.numbers[self.revisions[number]] = number
+    self.lines = array.array('i')
+    self.lines.fromstring(lines)
+
+  def forward(self, commands, rev):
+    """Apply a delta leading to rev, like those of branch revisions. The
+    lines it adds are attributed to rev."""
+    edits = [ ]
+    for start, count, added in commands:
+      if added is None:
+        edits.append((start - 1, count, 0))
+      else:
+        edits.append((start, 0, count))
+    self._edit(edits, rev)
+
+  def backward(self, commands, rev):
+    """Apply a delta leading from rev to this revision in reverse, like
+    those stored with the predecessor of a trunk revision. The lines it
+    deletes are the ones rev added."""
+    # the commands count the lines of rev, the edits those of this map
+    edits = [ ]
+    shift = 0
+    for start, count, added in commands:
+      if added is None:
+        edits.append((start - 1 + shift, 0, count))
+        shift = shift - count
+      else:
+        edits.append((start + shift, count, 0))
+        shift = shift + count
+    self._edit(edits, rev)
+
+  def _number(self, rev):
+    number = self.numbers.get(rev)
+    if number is None:
+      number = self.numbers[rev] = len(self.revisions)
+      self.revisions.append(rev)
+    return number
+
+  def _edit(self, edits, rev):
+    """Apply (position, lines to drop, lines of rev to add) edits sorted
+    by position, the positions counting the lines before any edit"""
+    lines = self.lines
+    added = array.array('i', [self._number(rev)])
+    result = array.array('i')
+    pos = 0
+    for at, drop, add in edits:
+      result.extend(lines[pos:at])
+      result.extend(added * add)
+      pos = at + drop
+    result.extend(lines[pos:])
+    self.lines = result
+
+
+class BlameParser(CVSParser):
+  """Builds the revision map of a revision with RevisionMap instead of
+  slicing a list for every command. Only the deltatexts of the
+  trunk and of the branches leading to the revision are read, each is
+  split once.
+
+  With a blamecache.BlameCache as store the map starts from that of the
+  nearest stored ancestor, base, and only the deltas after it and those
+  for the text of the revision are read."""
+
+  def __init__(self, cache=None, store=None):
+    CVSParser.__init__(self, cache)
+    self.store = store
+    self.path = None
+    self.opt_rev = None
+    self.revision = None
+    self.base = None
+    self.base_map = None
+    self.needed = { }
+    self.head_lines = None
+    self.deltas = { }
+
+  def want_log(self, revision):
+    return 0
+
+  def want_text(self, revision):
+    return self.needed.has_key(revision)
+
+  def tree_completed(self):
+    if self.opt_rev in [None, '', 'HEAD']:
+      self.revision = self.head_revision
+    else:
+      self.revision = self.map_tag_to_revision(self.opt_rev)
+      if self.revision == '':
+        raise RuntimeError, 'error: -r: No such revision: ' + self.opt_rev
+    ancestors = [self.revision] + self.ancestor_revisions(self.revision)
+    if self.store:
+      for rev in ancestors:
+        self.base_map = self.store.get(self.path, rev, self.timestamp[rev])
+        if self.base_map is not None:
+          self.base = rev
+          break
+    if self.base is None:
+      # the trunk for the length of the primordial revision, the
+      # branches up to the revision
+      rev = self.head_revision
+      while rev:
+        self.needed[rev] = 1
+        rev = self.prev_revision.get(rev)
+      for rev in ancestors:
+        self.needed[rev] = 1
+      return
+    # the deltas from the base on, a trunk revision is reached by the
+    # delta of its predecessor
+    for rev in ancestors[:ancestors.index(self.base)]:
+      if self.trunk_rev.match(rev):
+        self.needed[self.prev_revision[rev]] = 1
+      else:
+        self.needed[rev] = 1
+    # and those for the text
+    rev = self.revision
+    while rev:
+      self.needed[rev] = 1
+      rev = self.prev_delta.get(rev)
+
+  def set_revision_info(self, revision, log, text):
+    if text is None:
+      return
+    if revision == self.head_revision:
+      self.head_lines = string.split(text, '\n')
+      if self.head_lines[-1] == '':
+        del self.head_lines[-1]
+    else:
+      self.deltas[revision] = parse_delta(text)
+
+  def parse_cvs_file(self, rcs_pathname, opt_rev=None):
+    """Return the revision number of opt_rev, its revision map is in
+    revision_map"""
+    self.path = rcs_pathname
+    self.opt_rev = opt_rev
+    if self.cache:
+      self.cache.parse(rcs_pathname, self)
+    else:
+      try:
+        rcsfile = open(rcs_pathname, 'rb')
+      except:
+        raise RuntimeError, ('error: %s appeared to be under CVS control, ' +
+                'but the RCS file is inaccessible.') % rcs_pathname
+      try:
+        rcsparse.Parser().parse(rcsfile, self)
+      finally:
+        rcsfile.close()
+
+    ancestors = [self.revision] + self.ancestor_revisions(self.revision)
+    if self.base is not None:
+      ancestors = ancestors[:ancestors.index(self.base)+1]
+      ancestors.reverse()
+      self.revision_map = self.base_map
+    else:
+      # the length of the primordial revision, from the head down
+      line_count = len(self.head_lines or [ ])
+      rev = self.prev_revision.get(self.head_revision)
+      while rev:
+        for start, count, added in self.deltas[rev]:
+          if added is None:
+            line_count = line_count - count
+          else:
+            line_count = line_count + count
+        rev = self.prev_revision.get(rev)
+      ancestors.reverse()
+      self.revision_map = RevisionMap(ancestors[0], line_count)
+    last_revision = ancestors[0]
+    for revision in ancestors[1:]:
+      if self.trunk_rev.match(revision):
+        # the delta turns the revision into the previous one
+        self.revision_map.backward(self.deltas[last_revision], revision)
+      else:
+        self.revision_map.forward(self.deltas[revision], revision)
+      last_revision = revision
+    return self.revision
+
+  def knows(self, map):
+    """Return true if the lines of a revision map all come from
+    revisions of the file"""
+    for revision in map.revisions:
+      if not self.revision_author.has_key(revision):
+        return 0
+    return 1
+
+  def extract_revision(self, revision):
+    path = [ ]
+    while revision:
+      path.append(revision)
+      revision = self.prev_delta.get(revision)
+    path.reverse()
+    text = list(self.head_lines or [ ])
+    for revision in path[1:]:
+      text = apply_delta(text, self.deltas[revision])
+    return text
+
+
 class BlameSource:
-  def __init__(self, rcs_file, opt_rev=None):
+  def __init__(self, rcs_file, opt_rev=None, cache=None, store=None):
     # Parse the CVS file
-    parser = CVSParser()
+    parser = BlameParser(cache, store)
     revision = parser.parse_cvs_file(rcs_file, opt_rev)
     count = len(parser.revision_map)
     lines = parser.extract_revision(revision)
+    if parser.base is not None and (len(lines) != count or
+                                    not parser.knows(parser.revision_map)):
+      # a stored map that no longer fits the file, e.g. after revisions
+      # were removed from it
+      parser = BlameParser(cache)
+      revision = parser.parse_cvs_file(rcs_file, opt_rev)
+      count = len(parser.revision_map)
+      lines = parser.extract_revision(revision)
     if len(lines) != count:
       raise RuntimeError, 'Internal consistency error'
+    if store and parser.base != revision:
+      store.put(rcs_file, revision, parser.timestamp[revision],
+                parser.revision_map)
 
     # set up some state variables
     self.revision = revision
     self.lines = lines
     self.num_lines = count
     self.parser = parser
+    self.revs = iter(parser.revision_map)
 
     # keep track of where we are during an iteration
     self.idx = -1
@@ -441,14 +790,14 @@ class BlameSource:
       raise BlameSequencingError()
 
     # Get the line and metadata for it.
-    rev = self.parser.revision_map[idx]
+    rev = self.revs.next()
     prev_rev = self.parser.prev_revision.get(rev)
     line_number = idx + 1
     author = self.parser.revision_author[rev]
     thisline = self.lines[idx]
-    ### TODO:  Put a real date in here.
     item = _item(text=thisline, line_number=line_number, rev=rev,
-                 prev_rev=prev_rev, author=author, date=None)
+                 prev_rev=prev_rev, author=author,
+                 date=self.parser.timestamp[rev])
     self.last = item
     self.idx = idx
     return item
@@ -462,3 +811,57 @@ class _item:
   def __init__(self, **kw):
     vars(self).update(kw)
 
+
+class DiffstatTest(unittest.TestCase):
+  def testDeltas(self):
+    self.assert_(diffstat('') == (0, 0))
+    self.assert_(diffstat('d2 1\na3 2\nd\na1 1\n') == (2, 1))
+    # added lines beyond the few skipped one by one, no final newline
+    self.assert_(diffstat('\na0 6\n1\n2\n3\n4\n5\n6\nd9 3\n')
+                 == (6, 3))
+    self.assert_(diffstat('a0 2\nx\ny') == (2, 0))
+    self.assertRaises(RuntimeError, diffstat, 'x1 1\n')
+
+
+class RevisionMapTest(unittest.TestCase):
+  def commands(self, lines, count):
+    # replace every few lines by one of the revision
+    step = lines / count
+    commands = []
+    for i in range(count):
+      commands.append((i * step + 1, 1, None))
+      commands.append((i * step + 2, 1, ['x']))
+    return commands
+
+  def testEdits(self):
+    m = RevisionMap('1.1', 9)
+    m.forward([(2, 1, None), (3, 1, ['x']), (5, 2, None),
+               (8, 2, ['y', 'z'])], '1.2')
+    self.assert_(list(m) == ['1.1', '1.1', '1.2', '1.1', '1.1', '1.1',
+                             '1.2', '1.2', '1.1'])
+    # the delta stored with 1.1 leads from 1.2 back to it, the line
+    # it deletes is one 1.2 added
+    m = RevisionMap('1.1', 6)
+    m.backward([(2, 1, None), (3, 1, ['x'])], '1.2')
+    self.assert_(list(m) == ['1.1', '1.2', '1.1', '1.1', '1.1', '1.1'])
+
+  def testLinear(self):
+    # a delta is applied in time linear in the lines of the map, not
+    # in the lines times its commands, so a file ten times as large
+    # takes about as long with the same many revisions and commands
+    def best(lines):
+      commands = self.commands(lines, 1000)
+      times = []
+      for i in range(3):
+        m = RevisionMap('1.1', lines)
+        start = time.time()
+        for rev in range(2, 22):
+          m.forward(commands, '1.%d' % rev)
+        times.append(time.time() - start)
+        self.assert_(len(m) == lines)
+      return min(times)
+    self.assert_(best(100000) < 4 * best(10000))
+
+
+if __name__ == '__main__':
+  unittest.main()
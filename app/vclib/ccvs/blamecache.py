@@ -0,0 +1,131 @@
+# -*-python-*-
+
+"""On-disk store of blame revision maps.
+
+The revision map of a revision of a file never changes once the
+revision is committed, so it is kept per RCS file and revision. Blame
+for a later revision starts from the map of its nearest stored
+ancestor and only applies the deltas from there, see
+blame.BlameParser.
+
+Entries are stored along with the date of the revision, like the texts
+of snapshots.py. An entry is only used while the revision in the file
+has that date, not e.g. after it was removed and committed again. The
+least recently used entries are removed when the store grows beyond its
+byte budget.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import cPickle
+
+import vclib.diskstore
+import vclib.ccvs
+
+# bump when the format of the entries changes
+_VERSION = 2
+
+
+class BlameCache:
+  def __init__(self, directory, budget=256*1024*1024):
+    self.disk = vclib.diskstore.DiskStore(directory, budget)
+
+  def has(self, path, revision):
+    """Return true if the map of the revision of the RCS file at path is
+    stored, without reading it"""
+    return self.disk.has(_name(path, revision))
+
+  def get(self, path, revision, date):
+    """Return the stored blame.RevisionMap of the revision of the RCS file
+    at path, which has the given date, or None"""
+    name = _name(path, revision)
+    fp = self.disk.open(name)
+    if fp is None:
+      return None
+    try:
+      try:
+        version, stored, map = cPickle.load(fp)
+      finally:
+        fp.close()
+    except (EnvironmentError, EOFError, ValueError, TypeError,
+            ImportError, AttributeError, cPickle.UnpicklingError):
+      return None
+    if (version != _VERSION or
+        stored != (os.path.abspath(path), revision, date)):
+      return None
+    self.disk.touch(name)
+    return map
+
+  def put(self, path, revision, date, map):
+    def write(fp):
+      cPickle.dump((_VERSION, (os.path.abspath(path), revision, date), map),
+                   fp, cPickle.HIGHEST_PROTOCOL)
+    self.disk.write(_name(path, revision), write)
+
+
+def _name(path, revision):
+  return vclib.diskstore.pathname(path, '-' + revision)
+
+
+class BlameCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def annotate(self, repo, rev):
+    source, revision = repo.annotate(['module2', 'gpl.txt'], rev)
+    return [(line.rev, line.text, line.date) for line in source]
+
+  def testIncremental(self):
+    plain = vclib.ccvs.CCVSRepository('test', 'test/repo')
+    cache = BlameCache(self.dir)
+    cached = vclib.ccvs.CCVSRepository('test', 'test/repo',
+                                       blamecache=cache)
+    path = plain.rcsfile(['module2', 'gpl.txt'], 1)
+    self.assert_(self.annotate(cached, '1.1') == self.annotate(plain, '1.1'))
+    self.assert_(cache.has(path, '1.1'))
+    # each from the one before
+    for rev in ('1.2', '1.3', '1.1.1.1'):
+      source, revision = cached.annotate(['module2', 'gpl.txt'], rev)
+      self.assert_(source.parser.base == '1.1' or
+                   source.parser.base == '1.2')
+      self.assert_(self.annotate(cached, rev) == self.annotate(plain, rev))
+      self.assert_(cache.has(path, rev))
+
+  def testStale(self):
+    cache = BlameCache(self.dir)
+    cached = vclib.ccvs.CCVSRepository('test', 'test/repo',
+                                       blamecache=cache)
+    plain = vclib.ccvs.CCVSRepository('test', 'test/repo')
+    path = cached.rcsfile(['module2', 'gpl.txt'], 1)
+    dates = { }
+    for rev in plain.itemlog(['module2', 'gpl.txt'], None, { }):
+      dates[rev.string] = rev.date
+    source, revision = plain.annotate(['module2', 'gpl.txt'], '1.2')
+    # the map of another file
+    other = plain.annotate(['module1', 'file2.txt'], '1.1')[0].parser
+    cache.put(path, '1.2', dates['1.2'], other.revision_map)
+    self.assert_(self.annotate(cached, '1.3') == self.annotate(plain, '1.3'))
+    # one of as many lines, with revisions the file doesn't have
+    cache.put(path, '1.2', dates['1.2'],
+              vclib.ccvs.blame.RevisionMap('1.9', len(source.lines)))
+    self.assert_(self.annotate(cached, '1.3') == self.annotate(plain, '1.3'))
+    # the map of a revision committed at another time
+    cache.put(path, '1.2', dates['1.2'] + 1, source.parser.revision_map)
+    self.assert_(cache.get(path, '1.2', dates['1.2']) is None)
+    self.assert_(cache.get(path, '1.2', dates['1.2'] + 1) is not None)
+
+  def testEviction(self):
+    cache = BlameCache(self.dir, 1)
+    r = vclib.ccvs.CCVSRepository('test', 'test/repo', blamecache=cache)
+    r.annotate(['module2', 'gpl.txt'], '1.2')
+    r.annotate(['module1', 'file2.txt'], '1.1')
+    self.assert_(cache.disk.used <= 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,233 @@
+# -*-python-*-
+
+"""On-disk cache of parsed RCS files.
+
+The cache keeps everything an rcsparse sink is told about an RCS file,
+except for the deltatexts themselves: admin section, revision tree,
+description, log messages and the file offsets of the deltatexts.
+Feeding a sink from the cache replays these calls in the order of the
+parser and only reads the deltatexts the sink wants straight from the
+RCS file.
+
+Entries are stored per RCS file and are invalid once the size or mtime
+of the file changed. The least recently used entries are removed when
+the cache grows beyond its byte budget.
+"""
+
+import os
+import stat
+import string
+import shutil
+import tempfile
+import unittest
+import cPickle
+
+import vclib.diskstore
+import vclib.ccvs
+import rcsparse
+from rcsparse import default
+
+# bump when the format of the entries changes
+_VERSION = 2
+
+
+class RCSCache:
+  def __init__(self, directory, budget=256*1024*1024):
+    self.disk = vclib.diskstore.DiskStore(directory, budget)
+
+  def parse(self, path, sink):
+    """Feed an rcsparse sink with the contents of the RCS file at path,
+    like rcsparse.Parser().parse() does"""
+    info = os.stat(path)
+    entry = self._load(path, info)
+    if entry is None:
+      entry = _record(path)
+      after = os.stat(path)
+      # don't store what may be a mix of two versions of the file
+      if (after[stat.ST_SIZE] == info[stat.ST_SIZE] and
+          after[stat.ST_MTIME] == info[stat.ST_MTIME]):
+        self._store(path, info, entry)
+    _replay(path, entry, sink)
+
+  def _load(self, path, info):
+    name = vclib.diskstore.pathname(path)
+    fp = self.disk.open(name)
+    if fp is None:
+      return None
+    try:
+      try:
+        version, size, mtime, entry = cPickle.load(fp)
+      finally:
+        fp.close()
+    except (EnvironmentError, EOFError, ValueError, cPickle.UnpicklingError):
+      return None
+    if (version != _VERSION or size != info[stat.ST_SIZE] or
+        mtime != info[stat.ST_MTIME]):
+      return None
+    self.disk.touch(name)
+    return entry
+
+  def _store(self, path, info, entry):
+    def write(fp):
+      cPickle.dump((_VERSION, info[stat.ST_SIZE], info[stat.ST_MTIME],
+                    entry), fp, cPickle.HIGHEST_PROTOCOL)
+    self.disk.write(vclib.diskstore.pathname(path), write)
+
+
+class _RecordingSink(rcsparse.Sink):
+  """Sink recording everything but the deltatexts, whose offsets are
+  recorded instead"""
+
+  def __init__(self):
+    self.admin = [ ]
+    self.tree = [ ]
+    self.commitids = [ ]
+    self.description = None
+    self.deltas = [ ]
+    self.range = None
+
+  def set_head_revision(self, revision):
+    self.admin.append(('set_head_revision', (revision,)))
+  def set_principal_branch(self, branch_name):
+    self.admin.append(('set_principal_branch', (branch_name,)))
+  def define_tag(self, name, revision):
+    self.admin.append(('define_tag', (name, revision)))
+  def set_access(self, accessors):
+    self.admin.append(('set_access', (accessors,)))
+  def set_expansion(self, mode):
+    self.admin.append(('set_expansion', (mode,)))
+  def set_locking(self, mode):
+    self.admin.append(('set_locking', (mode,)))
+  def set_locker(self, revision, locker):
+    self.admin.append(('set_locker', (revision, locker)))
+  def set_comment(self, comment):
+    self.admin.append(('set_comment', (comment,)))
+
+  def define_revision(self, revision, timestamp, author, state,
+                      branches, next):
+    self.tree.append((revision, timestamp, author, state, branches, next))
+
+  def set_commitid(self, revision, commitid):
+    self.commitids.append((revision, commitid))
+
+  def set_description(self, description):
+    self.description = description
+
+  def want_text(self, revision):
+    return 0
+
+  def set_revision_range(self, revision, start, end):
+    self.range = (start, end)
+
+  def set_revision_info(self, revision, log, text):
+    start, end = self.range
+    self.deltas.append((revision, log, start, end))
+
+
+def _record(path):
+  sink = _RecordingSink()
+  parser = default.Parser()
+  # only this stream knows the offsets of the skipped deltatexts
+  parser.stream_class = default._MmapTokenStream
+  fp = open(path, 'rb')
+  try:
+    parser.parse(fp, sink)
+  finally:
+    fp.close()
+  return sink.admin, sink.tree, sink.commitids, sink.description, sink.deltas
+
+
+def _replay(path, entry, sink):
+  admin, tree, commitids, description, deltas = entry
+  for name, args in admin:
+    getattr(sink, name)(*args)
+  sink.admin_completed()
+
+  for args in tree:
+    sink.define_revision(*args)
+  for args in commitids:
+    sink.set_commitid(*args)
+  sink.tree_completed()
+
+  sink.set_description(description)
+
+  fp = None
+  try:
+    for revision, log, start, end in deltas:
+      want_log = sink.want_log(revision)
+      want_text = sink.want_text(revision)
+      if want_text:
+        if fp is None:
+          fp = open(path, 'rb')
+        fp.seek(start)
+        text = string.replace(fp.read(end - start), '@@', '@')
+      else:
+        text = None
+        sink.set_revision_range(revision, start, end)
+      if not want_log:
+        log = None
+      if want_log or want_text:
+        sink.set_revision_info(revision, log, text)
+  finally:
+    if fp:
+      fp.close()
+
+  sink.parse_completed()
+
+
+class RCSCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def files(self):
+    """Return the path parts of the files of the test repository"""
+    files = [ ]
+    for dirpath, dirnames, filenames in os.walk('test/repo'):
+      if 'CVSROOT' in dirnames:
+        dirnames.remove('CVSROOT')
+      for name in filenames:
+        if name[-2:] == ',v':
+          parts = string.split(dirpath, os.sep)[2:]
+          files.append(parts + [name[:-2]])
+    return files
+
+  def revisions(self, repo, path_parts, since=None):
+    return [(rev.string, rev.date, rev.author, rev.log, rev.changed)
+            for rev in repo.itemlog(path_parts, None,
+                                    {'cvs_newer_than': since})]
+
+  def testSameRevisions(self):
+    plain = vclib.ccvs.CCVSRepository('test', 'test/repo')
+    cached = vclib.ccvs.CCVSRepository('test', 'test/repo',
+                                       RCSCache(self.dir))
+    for path_parts in self.files():
+      for since in (None, '1.1'):
+        revs = self.revisions(plain, path_parts, since)
+        # the first call fills the cache, the second one reads it
+        self.assert_(self.revisions(cached, path_parts, since) == revs)
+        self.assert_(self.revisions(cached, path_parts, since) == revs)
+    self.assert_(len(os.listdir(self.dir)) > 0)
+
+  def testSameContents(self):
+    plain = vclib.ccvs.CCVSRepository('test', 'test/repo')
+    cached = vclib.ccvs.CCVSRepository('test', 'test/repo',
+                                       RCSCache(self.dir))
+    for rev in ('1.1', '1.2', '1.3', '1.1.1.1', None):
+      text = plain.openfile(['module2', 'gpl.txt'], rev)[0].getvalue()
+      for i in range(2):
+        self.assert_(cached.openfile(['module2', 'gpl.txt'], rev)[0]
+                     .getvalue() == text)
+
+  def testEviction(self):
+    cache = RCSCache(self.dir, 1)
+    r = vclib.ccvs.CCVSRepository('test', 'test/repo', cache)
+    r.itemlog(['module1', 'file2.txt'], None, { })
+    r.itemlog(['module2', 'gpl.txt'], None, { })
+    self.assert_(cache.disk.used <= 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
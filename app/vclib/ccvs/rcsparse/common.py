@@ -45,8 +45,30 @@ class Sink:
   def define_revision(self, revision, timestamp, author, state,
                       branches, next):
     pass
+  def set_commitid(self, revision, commitid):
+    """Called after define_revision() for revisions with a commitid, which
+    CVS 1.12 and later assign to all files of a commit."""
+    pass
   def set_revision_info(self, revision, log, text):
     pass
+  def want_log(self, revision):
+    """Return false if the log message of the revision is not needed.
+
+    Unwanted log messages are skipped by the parser without copying them
+    and passed to set_revision_info() as None."""
+    return 1
+  def want_text(self, revision):
+    """Return false if the deltatext of the revision is not needed.
+
+    Unwanted deltatexts are skipped by the parser without copying them
+    and passed to set_revision_info() as None. If neither log nor text
+    of a revision is wanted, set_revision_info() is not called."""
+    return 1
+  def set_revision_range(self, revision, start, end):
+    """Called for skipped deltatexts if the token stream knows their
+    position. start and end are the file offsets of the text, which
+    still has its '@' characters doubled."""
+    pass
   def admin_completed(self):
     pass
   def tree_completed(self):
@@ -232,17 +254,25 @@ class _Parser:
       #    permissions	644;
       #    hardlinks	@configure.in@;
       # this is "newphrase" in RCSFILE(5). we just want to skip over these.
+      # the exception is the commitid written by CVS 1.12 and later.
+      commitid = None
       while 1:
         token = self.ts.get()
         if token == 'desc' or token[0] in string.digits:
           self.ts.unget(token)
           break
+        if token == 'commitid':
+          commitid = self.ts.get()
+          if commitid == ';':
+            continue
         # consume everything up to the semicolon
         while self.ts.get() != ';':
           pass
 
       self.sink.define_revision(revision, timestamp, author, state, branches,
                                 next)
+      if commitid is not None:
+        self.sink.set_commitid(revision, commitid)
 
   def parse_rcs_description(self):
     self.ts.match('desc')
@@ -254,37 +284,58 @@ class _Parser:
       if revision is None:
         # EOF
         break
-      text, sym2, log, sym1 = self.ts.mget(4)
+      want_log = self.sink.want_log(revision)
+      want_text = self.sink.want_text(revision)
+      sym1 = self.ts.get()
       if sym1 != 'log':
-        print `text[:100], sym2[:100], log[:100], sym1[:100]`
         raise RCSExpected(sym1, 'log')
+      log = self._get_string(want_log)
+      sym2 = self.ts.get()
       if sym2 != 'text':
         raise RCSExpected(sym2, 'text')
+      if want_text:
+        text = self.ts.get()
+      else:
+        text = None
+        range = self.ts.skip()
+        if range:
+          self.sink.set_revision_range(revision, range[0], range[1])
       ### need to add code to chew up "newphrase"
-      self.sink.set_revision_info(revision, log, text)
+      if want_log or want_text:
+        self.sink.set_revision_info(revision, log, text)
+
+  def _get_string(self, wanted):
+    if wanted:
+      return self.ts.get()
+    self.ts.skip()
+    return None
 
   def parse(self, file, sink):
     self.ts = self.stream_class(file)
     self.sink = sink
-
-    self.parse_rcs_admin()
-
-    # let sink know when the admin section has been completed
-    self.sink.admin_completed()
-
-    self.parse_rcs_tree()
-
-    # many sinks want to know when the tree has been completed so they can
-    # do some work to prep for the arrival of the deltatext
-    self.sink.tree_completed()
-
-    self.parse_rcs_description()
-    self.parse_rcs_deltatext()
-
-    # easiest for us to tell the sink it is done, rather than worry about
-    # higher level software doing it.
-    self.sink.parse_completed()
-
-    self.ts = self.sink = None
+    try:
+      self.parse_rcs_admin()
+
+      # let sink know when the admin section has been completed
+      self.sink.admin_completed()
+
+      self.parse_rcs_tree()
+
+      # many sinks want to know when the tree has been completed so they can
+      # do some work to prep for the arrival of the deltatext
+      self.sink.tree_completed()
+
+      self.parse_rcs_description()
+      self.parse_rcs_deltatext()
+
+      # easiest for us to tell the sink it is done, rather than worry about
+      # higher level software doing it.
+      self.sink.parse_completed()
+    finally:
+      # also when a sink stops the parser, streams holding on to the
+      # file like _MmapTokenStream let go of it right away
+      if hasattr(self.ts, 'close'):
+        self.ts.close()
+      self.ts = self.sink = None
 
 # --------------------------------------------------------------------------
@@ -16,6 +16,7 @@ import time
 
 from __init__ import parse
 import common
+import default
 
 
 class DebugSink(common.Sink):
@@ -43,6 +44,10 @@ class DebugSink(common.Sink):
     print '    branches:', branches
     print '    next:', next
 
+  def set_commitid(self, revision, commitid):
+    print 'revision:', revision
+    print '    commitid:', commitid
+
   def set_revision_info(self, revision, log, text):
     print 'revision:', revision
     print '    log:', log
@@ -93,6 +98,11 @@ class DumpSink(common.Sink):
 def dump_file(fname):
   parse(open(fname, 'rb'), DumpSink())
 
+class LogSink(common.Sink):
+  "Sink only interested in the log messages."
+  def want_text(self, revision):
+    return 0
+
 def time_file(fname):
   f = open(fname, 'rb')
   s = common.Sink()
@@ -101,13 +111,26 @@ def time_file(fname):
   t = time.time() - t
   print t
 
+  # compare the token streams of the default parser
+  for stream_class in (default._TokenStream, default._MmapTokenStream):
+    for sink_class in (common.Sink, LogSink):
+      parser = default.Parser()
+      parser.stream_class = stream_class
+      f = open(fname, 'rb')
+      t = time.time()
+      parser.parse(f, sink_class())
+      t = time.time() - t
+      f.close()
+      print '%-16s %-8s %f' % (stream_class.__name__, sink_class.__name__, t)
+
 def _usage():
   print 'This is normally a module for importing, but it has a couple'
   print 'features for testing as an executable script.'
   print 'USAGE: %s COMMAND filename,v' % sys.argv[0]
   print '  where COMMAND is one of:'
   print '    dump: filename is "dumped" to stdout'
-  print '    time: filename is parsed with the time written to stdout'
+  print '    time: filename is parsed with the time written to stdout,'
+  print '          followed by the times of the different token streams'
   sys.exit(1)
 
 if __name__ == '__main__':
@@ -16,6 +16,10 @@
 # -----------------------------------------------------------------------
 
 import string
+import re
+import mmap
+import unittest
+from cStringIO import StringIO
 import common
 
 class _TokenStream:
@@ -129,6 +133,65 @@ class _TokenStream:
     print 'T:', `token`
     return token
 
+  def skip(self):
+    """Skip the next token from the RCS file.
+
+    Strings are scanned for their terminating "@" without copying their
+    contents, which is most of the work for large deltatexts."""
+
+    if self.__dict__.has_key('get'):
+      # a token was put back with unget()
+      self.get()
+      return
+
+    buf = self.buf
+    idx = self.idx
+
+    while 1:
+      if idx == len(buf):
+        buf = self.rcsfile.read(self.CHUNK_SIZE)
+        if buf == '':
+          del self.buf
+          return
+        idx = 0
+
+      if buf[idx] not in string.whitespace:
+        break
+
+      idx = idx + 1
+
+    if buf[idx] != '@':
+      self.buf = buf
+      self.idx = idx
+      self.get()
+      return
+
+    idx = idx + 1
+
+    while 1:
+      if idx == len(buf):
+        idx = 0
+        buf = self.rcsfile.read(self.CHUNK_SIZE)
+        if buf == '':
+          raise RuntimeError, 'EOF'
+      i = string.find(buf, '@', idx)
+      if i == -1:
+        idx = len(buf)
+        continue
+      if i == len(buf) - 1:
+        idx = 0
+        buf = '@' + self.rcsfile.read(self.CHUNK_SIZE)
+        if buf == '@':
+          raise RuntimeError, 'EOF'
+        continue
+      if buf[i + 1] == '@':
+        idx = i + 2
+        continue
+
+      self.buf = buf
+      self.idx = i + 1
+      return
+
   def match(self, match):
     "Try to match the next token from the input buffer."
 
@@ -164,6 +227,108 @@ class _TokenStream:
     return result
 
 
+class _MmapTokenStream:
+  """Token stream working on the whole RCS file at once.
+
+  The file is memory mapped if possible (it is read into a string
+  otherwise) and token boundaries are found with regular expressions and
+  find() instead of character by character. Skipped strings are never
+  copied, skip() returns their offsets instead. Produces the same tokens
+  as _TokenStream and can be used in its place as Parser.stream_class."""
+
+  _re_whitespace = re.compile('[%s]*' % re.escape(string.whitespace))
+  _re_token = re.compile('[^%s;]+' % re.escape(string.whitespace))
+
+  def __init__(self, file):
+    self.rcsfile = file
+    self.idx = 0
+    self.pushed = [ ]
+    try:
+      self.buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+      # not a real file, or an empty one
+      self.buf = file.read()
+    self.size = len(self.buf)
+    if self.size == 0:
+      raise RuntimeError, 'EOF'
+
+  def close(self):
+    "Release the memory map, the parser calls this once it is done."
+    if isinstance(self.buf, mmap.mmap):
+      self.buf.close()
+
+  def _string_end(self, idx):
+    """Return the offset of the '@' ending the string whose contents start
+    at idx. Within a string '@@' stands for a single '@'."""
+    buf = self.buf
+    while 1:
+      i = buf.find('@', idx)
+      if i == -1:
+        raise RuntimeError, 'EOF'
+      if i + 1 == self.size or buf[i + 1] != '@':
+        return i
+      # an escaped '@', the string goes on after it
+      idx = i + 2
+
+  def _next(self):
+    "Return the type of the next token and its start offset."
+    if self.pushed:
+      return 'pushed', None
+    idx = self._re_whitespace.match(self.buf, self.idx).end()
+    if idx == self.size:
+      return None, idx
+    return self.buf[idx], idx
+
+  def get(self):
+    "Get the next token from the RCS file."
+    c, idx = self._next()
+    if c == 'pushed':
+      return self.pushed.pop()
+    if c is None:
+      self.idx = idx
+      return None
+    if c == ';':
+      self.idx = idx + 1
+      return ';'
+    if c == '@':
+      end = self._string_end(idx + 1)
+      self.idx = end + 1
+      return string.replace(self.buf[idx + 1:end], '@@', '@')
+    match = self._re_token.match(self.buf, idx)
+    self.idx = match.end()
+    return match.group()
+
+  def skip(self):
+    """Skip the next token. For strings, the (start, end) offsets of the
+    still escaped contents are returned, None otherwise."""
+    c, idx = self._next()
+    if c == '@':
+      end = self._string_end(idx + 1)
+      self.idx = end + 1
+      return idx + 1, end
+    self.get()
+    return None
+
+  def match(self, match):
+    "Try to match the next token from the input buffer."
+    token = self.get()
+    if token != match:
+      raise RuntimeError, ('Unexpected parsing error in RCS file.\n' +
+                           'Expected token: %s, but saw: %s' % (match, token))
+
+  def unget(self, token):
+    "Put this token back, for the next get() to return."
+    self.pushed.append(token)
+
+  def mget(self, count):
+    "Return multiple tokens. 'next' is at the end."
+    result = [ ]
+    for i in range(count):
+      result.append(self.get())
+    result.reverse()
+    return result
+
+
 class Parser(common._Parser):
   stream_class = _TokenStream
 
@@ -238,3 +403,48 @@ class Parser(common._Parser):
         # warn("Unexpected RCS token: $token\n")
 
     raise RuntimeError, "Unexpected EOF"
+
+
+class TokenStreamTest(unittest.TestCase):
+  # '@@' escapes at the start, the end and in runs, an empty string
+  text = ('head\t1.2;\naccess;\nsymbols\n\tr1:1.1;\nlocks; strict;\n'
+          'comment\t@# @;\n\ndesc\n@@@a@@b@@@@c @@@\n\n1.2\nlog\n@@\n'
+          'text\n@x@@\n@@y\n@\n')
+
+  def tokens(self, ts, skip=0):
+    tokens = []
+    while 1:
+      if skip and tokens and tokens[-1] in ('desc', 'log', 'text'):
+        # the skipped strings are read from their offsets
+        start, end = ts.skip()
+        tokens.append(self.text[start:end].replace('@@', '@'))
+        continue
+      token = ts.get()
+      if token is None:
+        return tokens
+      tokens.append(token)
+
+  def testSameTokens(self):
+    for path in ('test/repo/module2/gpl.txt,v',
+                 'test/repo/module1/file2.txt,v'):
+      fp = open(path, 'rb')
+      tokens = self.tokens(_TokenStream(fp))
+      fp.seek(0)
+      mmapped = _MmapTokenStream(fp)
+      self.assert_(self.tokens(mmapped) == tokens)
+      mmapped.close()
+      fp.close()
+    mmapped = self.tokens(_MmapTokenStream(StringIO(self.text)))
+    self.assert_(mmapped[-7:] == ['desc', '@a@b@@c @', '1.2', 'log', '',
+                                  'text', 'x@\n@y\n'])
+    # with every chunk size, strings and escapes cross chunk boundaries
+    for size in range(1, 12):
+      class Chunked(_TokenStream):
+        CHUNK_SIZE = size
+      self.assert_(self.tokens(Chunked(StringIO(self.text))) == mmapped)
+    self.assert_(self.tokens(_MmapTokenStream(StringIO(self.text)), 1)
+                 == mmapped)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -293,6 +293,10 @@ class _mxTokenStream:
   def unget(self, token):
     self.tokens.append(token)
 
+  def skip(self):
+    # the tag tables always copy strings, there is nothing to save here
+    self.get()
+
   def mget(self, count):
     "Return multiple tokens. 'next' is at the end."
     while len(self.tokens) < count:
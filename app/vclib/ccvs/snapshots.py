@@ -0,0 +1,140 @@
+# -*-python-*-
+
+"""On-disk store of full texts of revisions, the keyframes of checkouts.
+
+A revision is checked out by applying the deltas on the way from the
+head to it, which takes long for old revisions of files with many
+revisions. The text of every revision whose last number is a multiple
+of the interval is stored when a checkout passes it, later checkouts
+start from the nearest one on their way. On the trunk this leaves less
+than interval deltas to apply, on a branch less than twice as many.
+
+Entries are stored compressed per RCS file and revision along with the
+date of the revision. A commit leaves the texts of the revisions before
+it as they were, an entry is only invalid once the revision in the file
+has another date, e.g. after it was removed and committed again. The
+least recently used entries are removed when the store grows beyond its
+byte budget.
+"""
+
+import os
+import string
+import shutil
+import tempfile
+import unittest
+import cPickle
+import zlib
+
+import vclib.diskstore
+import vclib.ccvs
+
+# bump when the format of the entries changes
+_VERSION = 2
+
+
+class SnapshotCache:
+  def __init__(self, directory, interval=50, budget=256*1024*1024):
+    self.interval = interval
+    self.disk = vclib.diskstore.DiskStore(directory, budget)
+
+  def due(self, revision):
+    """Return true if the text of the revision is to be stored"""
+    return int(revision[string.rfind(revision, '.')+1:]) % self.interval == 0
+
+  def get(self, path, revision, date):
+    """Return the stored text of the revision of the RCS file at path,
+    which has the given date, or None"""
+    name = _name(path, revision)
+    fp = self.disk.open(name)
+    if fp is None:
+      return None
+    try:
+      try:
+        version, stored = cPickle.load(fp)
+        if (version != _VERSION or
+            stored != (os.path.abspath(path), revision, date)):
+          return None
+        text = zlib.decompress(fp.read())
+      finally:
+        fp.close()
+    except (EnvironmentError, EOFError, ValueError, TypeError,
+            cPickle.UnpicklingError, zlib.error):
+      return None
+    self.disk.touch(name)
+    return text
+
+  def put(self, path, revision, date, text):
+    def write(fp):
+      cPickle.dump((_VERSION, (os.path.abspath(path), revision, date)), fp,
+                   cPickle.HIGHEST_PROTOCOL)
+      fp.write(zlib.compress(text))
+    self.disk.write(_name(path, revision), write)
+
+
+def _name(path, revision):
+  return vclib.diskstore.pathname(path, '-' + revision)
+
+
+class SnapshotCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def testSameContents(self):
+    plain = vclib.ccvs.CCVSRepository('test', 'test/repo')
+    snapshots = SnapshotCache(self.dir, 1)
+    cached = vclib.ccvs.CCVSRepository('test', 'test/repo',
+                                       snapshots=snapshots)
+    path = plain.rcsfile(['module2', 'gpl.txt'], 1)
+    for rev in ('1.1', '1.2', '1.1.1.1', '1.3', None):
+      text = plain.openfile(['module2', 'gpl.txt'], rev)[0].getvalue()
+      # the first one stores the revisions passed, the second one
+      # starts from the revision itself
+      for i in range(2):
+        self.assert_(cached.openfile(['module2', 'gpl.txt'], rev)[0]
+                     .getvalue() == text)
+    # all but the head
+    checkouts = plain._checkout(['module2', 'gpl.txt'],
+                                ['1.1', '1.2', '1.1.1.1', '1.3'])
+    for lines, rev, date in checkouts:
+      self.assert_((snapshots.get(path, rev, date) is None) ==
+                   (rev == '1.3'))
+
+  def testSinglePass(self):
+    # several revisions come out of one pass, which starts from the
+    # stored texts and stores those it passes
+    plain = vclib.ccvs.CCVSRepository('test', 'test/repo')
+    snapshots = SnapshotCache(self.dir, 1)
+    cached = vclib.ccvs.CCVSRepository('test', 'test/repo',
+                                       snapshots=snapshots)
+    path = plain.rcsfile(['module2', 'gpl.txt'], 1)
+    revs = ['1.1.1.1', '1.2', '1.3', '1.1']
+    checkouts = plain._checkout(['module2', 'gpl.txt'], revs)
+    self.assert_(cached._checkout(['module2', 'gpl.txt'], revs) ==
+                 checkouts)
+    for lines, rev, date in checkouts[:2] + checkouts[3:]:
+      self.assert_(snapshots.get(path, rev, date) is not None)
+    self.assert_(cached._checkout(['module2', 'gpl.txt'], revs) ==
+                 checkouts)
+    # the head is not taken from the store, 1.2 is
+    snapshots.put(path, '1.2', checkouts[1][2], 'stored')
+    self.assert_(cached._checkout(['module2', 'gpl.txt'], ['1.3', '1.2'])
+                 == [checkouts[2], (['stored'], '1.2', checkouts[1][2])])
+
+  def testStale(self):
+    snapshots = SnapshotCache(self.dir, 1)
+    path = os.path.join(self.dir, 'file,v')
+    shutil.copy('test/repo/module2/gpl.txt,v', path)
+    snapshots.put(path, '1.1', 1000, 'text')
+    self.assert_(snapshots.get(path, '1.1', 1000) == 'text')
+    # a commit to the file leaves it alone
+    os.utime(path, (0, 0))
+    self.assert_(snapshots.get(path, '1.1', 1000) == 'text')
+    # the revision committed anew
+    self.assert_(snapshots.get(path, '1.1', 2000) is None)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,175 @@
+# -*-python-*-
+
+"""Directory of files kept within a byte budget.
+
+The caches on disk keep their entries as files in a directory, each
+written atomically, and remove the least recently used ones when the
+directory grows beyond its budget. The mtime of an entry tells when it
+was last used. What the entries hold and how they are named is up to
+the caches.
+"""
+
+import os
+import stat
+import shutil
+import tempfile
+import hashlib
+import unittest
+
+# entries are created with the permissions of other files of the process
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def pathname(path, suffix=''):
+  """Return the name of an entry for the file at path, spread over
+  subdirectories"""
+  key = hashlib.sha1(os.path.abspath(path)).hexdigest()
+  return os.path.join(key[:2], key + suffix)
+
+
+class DiskStore:
+  def __init__(self, directory, budget=256*1024*1024):
+    self.directory = directory
+    self.budget = budget
+    # bytes used by the directory, determined on the first write
+    self.used = None
+
+  def has(self, name):
+    return os.path.isfile(os.path.join(self.directory, name))
+
+  def open(self, name):
+    """Return the entry opened for reading, or None"""
+    try:
+      return open(os.path.join(self.directory, name), 'rb')
+    except EnvironmentError:
+      return None
+
+  def touch(self, name):
+    """Mark the entry as used now, once it was found valid"""
+    try:
+      os.utime(os.path.join(self.directory, name), None)
+    except EnvironmentError:
+      pass
+
+  def write(self, name, write):
+    """Replace the entry with what write(fp) writes to fp"""
+    entrypath = os.path.join(self.directory, name)
+    dirname = os.path.dirname(entrypath)
+    try:
+      if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+      fd, temp = tempfile.mkstemp(dir=dirname)
+    except EnvironmentError:
+      # the caches are only an optimization, never fail because of them
+      return
+    try:
+      try:
+        fp = os.fdopen(fd, 'wb')
+        try:
+          write(fp)
+        finally:
+          fp.close()
+        # mkstemp makes the file readable by its owner only
+        os.chmod(temp, 0666 & ~_umask)
+        try:
+          replaced = os.stat(entrypath)[stat.ST_SIZE]
+        except EnvironmentError:
+          replaced = 0
+        os.rename(temp, entrypath)
+        size = os.stat(entrypath)[stat.ST_SIZE]
+      except:
+        try:
+          os.remove(temp)
+        except EnvironmentError:
+          pass
+        raise
+    except EnvironmentError:
+      return
+
+    if self.used is None:
+      self._evict()
+    else:
+      self.used = self.used + size - replaced
+      if self.used > self.budget:
+        self._evict()
+
+  def _evict(self):
+    """Remove the least recently used entries until the directory is
+    well below its budget, so this doesn't happen on every write"""
+    entries = [ ]
+    used = 0
+    for dirpath, dirnames, filenames in os.walk(self.directory):
+      for name in filenames:
+        entrypath = os.path.join(dirpath, name)
+        try:
+          info = os.stat(entrypath)
+        except EnvironmentError:
+          continue
+        entries.append((info[stat.ST_MTIME], info[stat.ST_SIZE], entrypath))
+        used = used + info[stat.ST_SIZE]
+    if used > self.budget:
+      entries.sort()
+      for mtime, size, entrypath in entries:
+        if used <= self.budget * 3 / 4:
+          break
+        try:
+          os.remove(entrypath)
+        except EnvironmentError:
+          continue
+        used = used - size
+    self.used = used
+
+
+class DiskStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def testEviction(self):
+    disk = DiskStore(self.dir, 3500)
+    for name in ('a/1', 'a/2', 'b/3'):
+      disk.write(name, lambda fp: fp.write('x' * 1000))
+      os.utime(os.path.join(self.dir, name), (0, 0))
+    os.utime(os.path.join(self.dir, 'b/3'), (0, 1))
+    disk.touch('a/1')
+    disk.write('b/4', lambda fp: fp.write('x' * 1000))
+    # the least recently used go until it is down to 3/4 of the budget
+    self.assert_(disk.used == 2000)
+    self.assert_(disk.has('a/1') and disk.has('b/4'))
+    self.assert_(not disk.has('a/2') and not disk.has('b/3'))
+    self.assert_(disk.open('a/1').read() == 'x' * 1000)
+    self.assert_(disk.open('a/2') is None)
+
+  def testReplace(self):
+    disk = DiskStore(self.dir, 3500)
+    for i in range(4):
+      disk.write('a/1', lambda fp: fp.write('x' * 1000))
+    self.assert_(disk.used == 1000)
+    disk.write('a/1', lambda fp: fp.write('x' * 10))
+    self.assert_(disk.used == 10)
+
+  def testFailedWrite(self):
+    # no temporary files are left behind, errors of the environment
+    # are ignored
+    disk = DiskStore(self.dir)
+    def fail(fp, error=IOError):
+      fp.write('x')
+      raise error
+    disk.write('a/1', fail)
+    self.assertRaises(ValueError, disk.write, 'a/1',
+                      lambda fp: fail(fp, ValueError))
+    self.assert_(os.listdir(os.path.join(self.dir, 'a')) == [ ])
+    self.assert_(not disk.has('a/1'))
+
+  def testMode(self):
+    disk = DiskStore(self.dir)
+    disk.write('a/1', lambda fp: fp.write('x'))
+    mode = os.stat(os.path.join(self.dir, 'a/1'))[stat.ST_MODE]
+    self.assert_(stat.S_IMODE(mode) == 0666 & ~_umask)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,618 @@
+# -*-python-*-
+
+"""In-process replacement for running GNU diff on two checked out files.
+
+Works on the line lists produced by checkouts (the file contents split
+at newlines, so a file ending in a newline has an empty last element)
+and writes unified or context diffs in the format of GNU diff, honoring
+the options understood by vclib._diff_args().
+"""
+
+import os
+import re
+import string
+import time
+import tempfile
+import unittest
+import cStringIO
+
+import vclib
+
+_re_function = re.compile('[A-Za-z_$]')
+_re_delta = re.compile('^([ad])(\\d+)\\s(\\d+)')
+_NO_NEWLINE = '\\ No newline at end of file\n'
+
+
+def diff(lines1, lines2, info1, info2, type, options={}):
+  """Return a file object reading the diff of two line lists
+
+  info1 and info2 are the (path, date, revision) tuples used for the
+  file labels, type and options are the same as for Repository.rawdiff().
+  Raises NotImplementedError for diff types other than UNIFIED and
+  CONTEXT, and for files differing in too many places to compare them
+  quickly."""
+
+  if type == vclib.UNIFIED:
+    format = _unified
+  elif type == vclib.CONTEXT:
+    format = _context
+  else:
+    raise NotImplementedError
+  context = options.get('context', 3)
+
+  a = _Lines(lines1)
+  b = _Lines(lines2)
+  if options.get('ignore_white', 0):
+    keys1 = map(_strip_white, a.lines)
+    keys2 = map(_strip_white, b.lines)
+  else:
+    keys1 = a.keys()
+    keys2 = b.keys()
+
+  out = cStringIO.StringIO()
+  groups = _grouped_opcodes(_opcodes(keys1, keys2), context)
+  if groups:
+    format(out, a, b, groups, vclib._diff_label(info1),
+           vclib._diff_label(info2), options.get('funout', 0))
+  out.seek(0)
+  return out
+
+
+def delta_diff(base, delta, reverse, info1, info2, type, options={}):
+  """Return a file object reading the diff of two adjacent revisions
+
+  Instead of comparing two checkouts this converts the RCS deltatext
+  between the revisions into hunks, so the work depends on the size of
+  the change rather than the size of the file. base are the lines of the
+  revision the deltatext applies to, as produced by checkouts. delta is
+  the deltatext, which turns base into the other revision. It is a
+  reverse delta on the trunk, where base is the newer revision, and a
+  forward delta on branches, where base is the older one.
+
+  Raises NotImplementedError for diffs delta_supported() rejects."""
+
+  if not delta_supported(type, options):
+    raise NotImplementedError
+  # as in checkouts, the empty element after a trailing newline
+  eol = base[-1:] == ['']
+  if eol:
+    base = base[:-1]
+
+  codes, added = _delta_opcodes(len(base), delta)
+  length = len(base)
+  other = codes and codes[-1][4] or 0
+  other_eol = 1
+  for tag, i1, i2, j1, j2 in codes:
+    if j2 == other and j2 > j1:
+      # the last line of the other revision is one of the base or the
+      # last one the deltatext adds
+      if tag == 'equal':
+        other_eol = eol or i2 < length
+      else:
+        other_eol = delta[-1:] == '\n'
+  if reverse:
+    swap = { 'insert': 'delete', 'delete': 'insert', 'replace': 'replace',
+             'equal': 'equal' }
+    codes = map(lambda (tag, i1, i2, j1, j2), swap=swap:
+                  (swap[tag], j1, j2, i1, i2), codes)
+    ends = (other, other_eol, length, eol)
+  else:
+    ends = (length, eol, other, other_eol)
+
+  out = cStringIO.StringIO()
+  groups = _grouped_opcodes(codes, options.get('context', 3))
+  if groups:
+    _delta_unified(out, base, added, reverse, ends, groups,
+                   vclib._diff_label(info1), vclib._diff_label(info2))
+  out.seek(0)
+  return out
+
+
+def delta_supported(type, options):
+  """Return true if delta_diff() can produce this type of diff: unified
+  diffs without options besides the context"""
+  return (type == vclib.UNIFIED and not options.get('ignore_white', 0) and
+          not options.get('funout', 0))
+
+
+def _delta_opcodes(length, delta):
+  """Opcodes turning a base text of length lines into the other revision,
+  derived from the ed style commands of an RCS deltatext. Also returns
+  the lines added by the deltatext keyed by their position in the other
+  revision."""
+  commands = string.split(delta, '\n')
+  codes = [ ]
+  added = { }
+  i = j = 0
+  k = 0
+  while k < len(commands):
+    match = _re_delta.match(commands[k])
+    k = k + 1
+    if not match:
+      if commands[k-1] == '':
+        continue
+      raise RuntimeError, 'Error parsing diff commands'
+    line = int(match.group(2))
+    count = int(match.group(3))
+    # the commands refer to lines of the base text, in ascending order
+    if match.group(1) == 'd':
+      start = line - 1
+    else:
+      start = line
+    if start > i:
+      codes.append(['equal', i, start, j, j + start - i])
+      j = j + start - i
+      i = start
+    if match.group(1) == 'd':
+      codes.append(['delete', i, i + count, j, j])
+      i = i + count
+    else:
+      added[j] = commands[k:k+count]
+      k = k + count
+      if codes and codes[-1][0] == 'delete' and codes[-1][2] == i:
+        # a deletion followed by an addition at the same place
+        codes[-1][0] = 'replace'
+        codes[-1][4] = j + count
+      else:
+        codes.append(['insert', i, i, j, j + count])
+      j = j + count
+  if i < length:
+    codes.append(['equal', i, length, j, j + length - i])
+  return map(tuple, codes), added
+
+
+def _delta_unified(out, base, added, reverse, ends, groups, label1, label2):
+  # the length of the old and the new revision, and whether they end in
+  # a newline
+  length1, eol1, length2, eol2 = ends
+  out.write('--- %s\n+++ %s\n' % (label1, label2))
+  for group in groups:
+    i1, j1 = group[0][1], group[0][3]
+    i2, j2 = group[-1][2], group[-1][4]
+    out.write('@@ -%s +%s @@\n' % (_range_unified(i1, i2),
+                                   _range_unified(j1, j2)))
+    for tag, i1, i2, j1, j2 in group:
+      # lines of the other revision only come from the deltatext
+      if tag == 'equal':
+        if reverse:
+          _write(out, ' ', base[j1:j2], j2 == length2 and not eol2)
+        else:
+          _write(out, ' ', base[i1:i2], i2 == length1 and not eol1)
+        continue
+      if reverse:
+        old = added.get(i1, [ ])
+        new = base[j1:j2]
+      else:
+        old = base[i1:i2]
+        new = added.get(j1, [ ])
+      if tag != 'insert':
+        _write(out, '-', old, i2 == length1 and not eol1)
+      if tag != 'delete':
+        _write(out, '+', new, j2 == length2 and not eol2)
+
+
+def _write(out, prefix, lines, noeol=0):
+  for line in lines:
+    out.write(prefix + line + '\n')
+  if lines and noeol:
+    out.write(_NO_NEWLINE)
+
+
+class _Lines:
+  def __init__(self, lines):
+    # the empty element after a trailing newline is no line of its own
+    if lines and lines[-1] == '':
+      self.lines = lines[:-1]
+      self.eol = 1
+    else:
+      self.lines = lines
+      self.eol = not lines
+
+  def keys(self):
+    """Lines as compared, the last line only equals a last line which
+    lacks a newline as well"""
+    if self.eol:
+      return self.lines
+    return self.lines[:-1] + [self.lines[-1] + '\n']
+
+  def write(self, out, prefix, i1, i2):
+    for i in xrange(i1, i2):
+      out.write(prefix + self.lines[i] + '\n')
+    if i2 == len(self.lines) and i2 > i1 and not self.eol:
+      out.write(_NO_NEWLINE)
+
+  def function(self, i):
+    """Return the line which diff -p shows for a hunk starting at i"""
+    while i > 0:
+      i = i - 1
+      if _re_function.match(self.lines[i]):
+        return ' ' + string.rstrip(self.lines[i][:40])
+    return ''
+
+
+def _strip_white(line):
+  return string.join(string.split(line), '')
+
+
+def _opcodes(a, b):
+  """Opcodes like those of difflib.SequenceMatcher turning a into b, for
+  a shortest edit script found with the O(ND) algorithm of Myers, as GNU
+  diff does. Raises NotImplementedError if the files differ in so many
+  places that this would take long, diff() callers then run diff."""
+  # compare small integers rather than the lines themselves
+  ids = { }
+  a = map(lambda line, ids=ids: ids.setdefault(line, len(ids)), a)
+  b = map(lambda line, ids=ids: ids.setdefault(line, len(ids)), b)
+
+  matches = [ ]
+  _compare(a, 0, len(a), b, 0, len(b), matches, [_MAX_COST])
+  matches.sort()
+
+  codes = [ ]
+  i = j = 0
+  for i1, j1, size in matches + [(len(a), len(b), 0)]:
+    if i < i1 and j < j1:
+      codes.append(('replace', i, i1, j, j1))
+    elif i < i1:
+      codes.append(('delete', i, i1, j, j))
+    elif j < j1:
+      codes.append(('insert', i, i, j, j1))
+    if size:
+      codes.append(('equal', i1, i1 + size, j1, j1 + size))
+    i, j = i1 + size, j1 + size
+  return codes
+
+
+# diagonals the search may extend in all before diff() gives up
+_MAX_COST = 2000000
+
+
+def _compare(a, a0, a1, b, b0, b1, matches, budget):
+  """Append the (i, j, size) runs of equal lines of a shortest edit script
+  turning a[a0:a1] into b[b0:b1] to matches. Only linear space is used:
+  the script is split in the middle and both halves compared in turn."""
+  while 1:
+    # the common prefix and suffix need no search
+    start = a0
+    while a0 < a1 and b0 < b1 and a[a0] == b[b0]:
+      a0 = a0 + 1
+      b0 = b0 + 1
+    if a0 > start:
+      matches.append((start, b0 - (a0 - start), a0 - start))
+    end = a1
+    while a0 < a1 and b0 < b1 and a[a1-1] == b[b1-1]:
+      a1 = a1 - 1
+      b1 = b1 - 1
+    if a1 < end:
+      matches.append((a1, b1, end - a1))
+    if a0 == a1 or b0 == b1:
+      return
+
+    x, y = _middle(a, a0, a1, b, b0, b1, budget)
+    _compare(a, a0, x, b, b0, y, matches, budget)
+    a0, b0 = x, y
+
+
+def _middle(a, a0, a1, b, b0, b1, budget):
+  """Return a point (x, y) in the middle of a shortest edit script for
+  two ranges without a common prefix or suffix, searching from both ends
+  at once until the furthest reaching paths overlap."""
+  n = a1 - a0
+  m = b1 - b0
+  delta = n - m
+  odd = delta & 1
+  # the furthest x reached on each diagonal k = x - y from the start,
+  # and from the end on diagonal delta - k counting from the end,
+  # indexed by k + offset
+  limit = (n + m + 1) / 2
+  offset = limit + 1
+  forward = [-1] * (2 * offset + 1)
+  backward = [-1] * (2 * offset + 1)
+  forward[offset+1] = backward[offset+1] = 0
+  # diagonals to skip at either side, whose paths left the ranges
+  fstart = fend = bstart = bend = 0
+  for d in xrange(limit + 1):
+    budget[0] = budget[0] - 2 * d - 2
+    if budget[0] < 0:
+      raise NotImplementedError
+
+    for k in xrange(-d + fstart, d + 1 - fend, 2):
+      if k == -d or (k != d and forward[offset+k-1] < forward[offset+k+1]):
+        x = forward[offset+k+1]
+      else:
+        x = forward[offset+k-1] + 1
+      y = x - k
+      while x < n and y < m and a[a0+x] == b[b0+y]:
+        x = x + 1
+        y = y + 1
+      forward[offset+k] = x
+      if x > n:
+        fend = fend + 2
+      elif y > m:
+        fstart = fstart + 2
+      elif odd:
+        i = offset + delta - k
+        if 0 <= i < len(backward) and backward[i] != -1 and \
+           x >= n - backward[i]:
+          return a0 + x, b0 + y
+
+    for k in xrange(-d + bstart, d + 1 - bend, 2):
+      if k == -d or (k != d and backward[offset+k-1] < backward[offset+k+1]):
+        x = backward[offset+k+1]
+      else:
+        x = backward[offset+k-1] + 1
+      y = x - k
+      while x < n and y < m and a[a1-1-x] == b[b1-1-y]:
+        x = x + 1
+        y = y + 1
+      backward[offset+k] = x
+      if x > n:
+        bend = bend + 2
+      elif y > m:
+        bstart = bstart + 2
+      elif not odd:
+        i = offset + delta - k
+        if 0 <= i < len(forward) and forward[i] != -1 and \
+           forward[i] >= n - x:
+          return a0 + forward[i], b0 + forward[i] - (delta - k)
+
+  # not reached, the paths overlap after (n + m + 1) / 2 steps at most
+  raise NotImplementedError
+
+
+def _grouped_opcodes(codes, n):
+  """Group opcodes into hunks with n lines of context, like
+  difflib.SequenceMatcher.get_grouped_opcodes(). Returns an empty list
+  if there are no changes."""
+  codes = filter(lambda code: code[1] != code[2] or code[3] != code[4], codes)
+  if not codes or (len(codes) == 1 and codes[0][0] == 'equal'):
+    return [ ]
+  if codes[0][0] == 'equal':
+    tag, i1, i2, j1, j2 = codes[0]
+    codes[0] = tag, max(i1, i2-n), i2, max(j1, j2-n), j2
+  if codes[-1][0] == 'equal':
+    tag, i1, i2, j1, j2 = codes[-1]
+    codes[-1] = tag, i1, min(i2, i1+n), j1, min(j2, j1+n)
+
+  groups = [ ]
+  group = [ ]
+  for tag, i1, i2, j1, j2 in codes:
+    # end the current hunk at a large unchanged range
+    if tag == 'equal' and i2-i1 > n+n:
+      group.append((tag, i1, min(i2, i1+n), j1, min(j2, j1+n)))
+      groups.append(group)
+      group = [ ]
+      i1, j1 = max(i1, i2-n), max(j1, j2-n)
+    group.append((tag, i1, i2, j1, j2))
+  if group and not (len(group) == 1 and group[0][0] == 'equal'):
+    groups.append(group)
+  return groups
+
+
+def _range_unified(start, stop):
+  length = stop - start
+  if length == 1:
+    return '%d' % (start + 1)
+  if not length:
+    return '%d,0' % start
+  return '%d,%d' % (start + 1, length)
+
+
+def _range_context(start, stop):
+  length = stop - start
+  if not length:
+    return '%d' % start
+  if length == 1:
+    return '%d' % (start + 1)
+  return '%d,%d' % (start + 1, stop)
+
+
+def _unified(out, a, b, groups, label1, label2, funout):
+  out.write('--- %s\n+++ %s\n' % (label1, label2))
+  for group in groups:
+    i1, j1 = group[0][1], group[0][3]
+    i2, j2 = group[-1][2], group[-1][4]
+    function = funout and a.function(i1) or ''
+    out.write('@@ -%s +%s @@%s\n' % (_range_unified(i1, i2),
+                                     _range_unified(j1, j2), function))
+    for tag, i1, i2, j1, j2 in group:
+      if tag == 'equal':
+        a.write(out, ' ', i1, i2)
+      else:
+        a.write(out, '-', i1, i2)
+        b.write(out, '+', j1, j2)
+
+
+def _context(out, a, b, groups, label1, label2, funout):
+  out.write('*** %s\n--- %s\n' % (label1, label2))
+  prefix = { 'insert': '+ ', 'delete': '- ', 'replace': '! ', 'equal': '  ' }
+  for group in groups:
+    i1, j1 = group[0][1], group[0][3]
+    i2, j2 = group[-1][2], group[-1][4]
+    function = funout and a.function(i1) or ''
+    out.write('***************%s\n' % function)
+
+    out.write('*** %s ****\n' % _range_context(i1, i2))
+    for tag, _, _, _, _ in group:
+      if tag in ('replace', 'delete'):
+        for tag, i1, i2, _, _ in group:
+          if tag != 'insert':
+            a.write(out, prefix[tag], i1, i2)
+        break
+
+    out.write('--- %s ----\n' % _range_context(j1, j2))
+    for tag, _, _, _, _ in group:
+      if tag in ('replace', 'insert'):
+        for tag, _, _, j1, j2 in group:
+          if tag != 'delete':
+            b.write(out, prefix[tag], j1, j2)
+        break
+
+
+class _FilesTest(unittest.TestCase):
+  """Writes line lists to temporary files for GNU diff and patch"""
+  lines = map(lambda i: 'line %d' % i, range(1, 21))
+  info1 = ('file', 1000000000, '1.1')
+  info2 = ('file', 1000086400, '1.2')
+
+  def setUp(self):
+    self.temps = [ ]
+
+  def tearDown(self):
+    for temp in self.temps:
+      if os.path.exists(temp):
+        os.remove(temp)
+
+  def temp(self, lines):
+    fd, temp = tempfile.mkstemp()
+    os.write(fd, string.join(lines, '\n'))
+    os.close(fd)
+    self.temps.append(temp)
+    return temp
+
+
+class DiffTest(_FilesTest):
+  def check(self, lines1, lines2, type=vclib.UNIFIED, options={}):
+    """Compare the diff of two line lists with the one of GNU diff, and
+    apply it with patch"""
+    ours = self.apply(lines1, lines2, type, options)
+    fp = vclib._diff_fp(self.temp(lines1), self.temp(lines2), self.info1,
+                        self.info2, vclib._diff_args(type, options))
+    theirs = fp.read()
+    fp.close()
+    self.assertEqual(ours, theirs)
+
+  def apply(self, lines1, lines2, type=vclib.UNIFIED, options={}):
+    """Return the diff of two line lists after checking that patch turns
+    the first one into the second one with it"""
+    ours = diff(lines1, lines2, self.info1, self.info2, type, options).read()
+    old = self.temp(lines1)
+    patch = self.temp([ours])
+    self.assert_(os.system('patch -s -f %s %s' % (old, patch)) == 0)
+    self.assert_(open(old, 'rb').read() == string.join(lines2, '\n'))
+    return ours
+
+  def testInsert(self):
+    self.check(self.lines + [''], self.lines[:5] + ['new'] + self.lines[5:]
+               + [''])
+    self.check(self.lines + [''], ['new'] + self.lines + [''])
+    self.check(self.lines + [''], self.lines + ['new', ''])
+
+  def testDelete(self):
+    self.check(self.lines + [''], self.lines[:5] + self.lines[7:] + [''])
+    self.check(self.lines + [''], self.lines[1:] + [''])
+    self.check(self.lines + [''], self.lines[:-1] + [''])
+
+  def testChange(self):
+    lines = self.lines[:]
+    lines[2] = 'changed'
+    lines[9:11] = ['x', 'y', 'z']
+    lines[17] = 'changed'
+    # hunks apart and joined by their context
+    self.check(self.lines + [''], lines + [''])
+    self.check(self.lines + [''], lines + [''], options={'context': 1})
+    self.check(self.lines + [''], lines + [''], vclib.CONTEXT)
+    self.check(self.lines + [''], lines + [''], vclib.CONTEXT,
+               {'context': 5})
+
+  def testEmpty(self):
+    self.check([''], self.lines + [''])
+    self.check(self.lines + [''], [''])
+    self.assert_(diff([''], [''], self.info1, self.info2,
+                      vclib.UNIFIED).read() == '')
+
+  def testNoNewline(self):
+    self.check(self.lines, self.lines + [''])
+    self.check(self.lines + [''], self.lines)
+    self.check(self.lines, self.lines[:-1] + ['changed'])
+    self.check(self.lines, self.lines[:5] + self.lines[6:])
+    self.check(self.lines, self.lines[:5] + self.lines[6:], vclib.CONTEXT)
+
+  def testRepeatedLines(self):
+    # takes time in the number of differences, not the square of the
+    # lines. GNU diff may pick other lines among the equal ones.
+    lines1 = [ ]
+    for i in range(10000):
+      lines1.extend(['{', '', '}', 'line %d' % (i % 7)])
+    lines2 = lines1[:]
+    for i in range(0, len(lines2), 400):
+      lines2[i:i+2] = ['}', 'x', '']
+    start = time.time()
+    self.apply(lines1, lines2)
+    self.assert_(time.time() - start < 10)
+
+  def testTooExpensive(self):
+    a = map(str, range(100))
+    b = map(str, range(100, 200))
+    self.assertRaises(NotImplementedError, _compare, a, 0, len(a), b, 0,
+                      len(b), [ ], [100])
+
+
+class DeltaDiffTest(_FilesTest):
+  def delta(self, lines1, lines2):
+    """The RCS deltatext turning lines1 into lines2"""
+    return os.popen('diff -n %s %s' % (self.temp(lines1),
+                                        self.temp(lines2))).read()
+
+  def check(self, lines1, lines2, options={}):
+    """Compare the diffs from the forward and the reverse deltatext
+    with the one of GNU diff"""
+    fp = vclib._diff_fp(self.temp(lines1), self.temp(lines2), self.info1,
+                        self.info2, vclib._diff_args(vclib.UNIFIED, options))
+    theirs = fp.read()
+    fp.close()
+    self.assertEqual(delta_diff(lines1, self.delta(lines1, lines2), 0,
+                                self.info1, self.info2, vclib.UNIFIED,
+                                options).read(), theirs)
+    self.assertEqual(delta_diff(lines2, self.delta(lines2, lines1), 1,
+                                self.info1, self.info2, vclib.UNIFIED,
+                                options).read(), theirs)
+
+  def testStart(self):
+    lines = self.lines + ['']
+    self.check(lines, lines[1:])
+    self.check(lines, ['new'] + lines)
+    self.check(lines, ['new'] + lines[2:])
+
+  def testEnd(self):
+    lines = self.lines + ['']
+    self.check(lines, lines[:-2] + [''])
+    self.check(lines, lines[:-1] + ['new', ''])
+    self.check(lines, lines[:-3] + ['new', ''])
+
+  def testAdjacent(self):
+    lines = self.lines + ['']
+    # a deletion and an addition next to each other, apart from another
+    self.check(lines, lines[:5] + ['x', 'y'] + lines[6:])
+    self.check(lines, lines[:5] + lines[6:7] + ['x'] + lines[7:])
+    self.check(lines, lines[:5] + ['x'] + lines[5:6] + lines[7:])
+
+  def testContext(self):
+    lines = self.lines + ['']
+    # changes sharing their context and just apart
+    for gap in range(5, 9):
+      changed = lines[:]
+      changed[4] = 'x'
+      del changed[5 + gap]
+      self.check(lines, changed)
+      self.check(lines, changed, {'context': 1})
+      self.check(lines, changed, {'context': 0})
+
+  def testNoNewline(self):
+    self.check(self.lines, self.lines + [''])
+    self.check(self.lines + [''], self.lines)
+    self.check(self.lines, self.lines[:-1] + ['changed'])
+    self.check(self.lines, self.lines[:5] + self.lines[6:])
+    self.check(self.lines, self.lines[:-2] + ['x'] + self.lines[-1:])
+    self.check(self.lines, self.lines[:-1] + [''])
+    self.check(self.lines, self.lines + ['new'])
+    self.check(self.lines, self.lines[:-1])
+
+  def testEmpty(self):
+    self.check([''], self.lines + [''])
+    self.check(self.lines + [''], [''])
+    self.check([''], self.lines)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,144 @@
+# vim:set tabstop=3 shiftwidth=3 expandtab:
+# vim:set autoindent smarttab nowrap:
+
+""" Cache of the diffs shown for changes.
+
+    A committed change never changes, so its diff is kept once made,
+    keyed by the id of the change. Recently used diffs are kept in
+    memory, all of them in a directory which survives restarts. Both
+    tiers drop the least recently used diffs once they exceed their
+    byte budget.
+
+    The files in the directory hold the text after a short header, so a
+    part of a large diff can be read without reading all of it. """
+
+import os
+import stat
+import cPickle
+import cStringIO
+
+from vclib.diskstore import DiskStore
+
+# bump when the format of the entries changes
+_VERSION = 2
+
+def source(change):
+   """ Returns what the diff of a change is made from """
+   return (change.file.repository.path, change.file.name,
+           change.rev_old, change.rev_new)
+
+class DiffCache:
+   def __init__(self, directory, budget=256*1024*1024, memory=0):
+      """ budget is the size of the directory, memory the size of the
+          diffs kept in memory, 0 to keep none """
+      self.disk = DiskStore(directory, budget)
+      self.memory = memory
+      # change id -> [last use, source, diff text]
+      self.entries = {}
+      self.inmemory = 0
+      self.clock = 0
+
+   def diff(self, change, rcscache=None, snapshots=None):
+      """ Returns the unified diff of a change as text """
+      fp = self.open(change, rcscache, snapshots)
+      try:
+         return fp.read()
+      finally:
+         fp.close()
+
+   def open(self, change, rcscache=None, snapshots=None):
+      """ Returns a file object reading the unified diff of a change """
+      fp = self.read(change.id, source(change))
+      if fp is None:
+         module = change.file.repository.getmodule(rcscache,
+                                                   snapshots=snapshots)
+         diff = module.rawdiff([change.file.name], change.rev_old,
+                               [change.file.name], change.rev_new, 1)
+         text = diff.read()
+         diff.close()
+         self.put(change.id, source(change), text)
+         fp = cStringIO.StringIO(text)
+      return fp
+
+   def get(self, id, source):
+      """ Returns the cached diff of the change with this id, or None.
+          source identifies what was diffed, an entry with another
+          source is stale, e.g. from a database created anew. """
+      fp = self.read(id, source)
+      if fp is None:
+         return None
+      try:
+         return fp.read()
+      finally:
+         fp.close()
+
+   def read(self, id, source):
+      """ Returns a file object reading the cached diff, or None. Diffs
+          too large for memory are read from their file. """
+      self.clock += 1
+      entry = self.entries.get(id)
+      if entry and entry[1] == source:
+         entry[0] = self.clock
+         return cStringIO.StringIO(entry[2])
+      fp = self._load(id, source)
+      if fp is not None and self._fits(fp):
+         text = fp.read()
+         fp.close()
+         self._remember(id, source, text)
+         fp = cStringIO.StringIO(text)
+      return fp
+
+   def put(self, id, source, text):
+      self.clock += 1
+      self._remember(id, source, text)
+      self._store(id, source, text)
+
+   def _fits(self, fp):
+      # larger ones would push out too many others
+      start = fp.tell()
+      return os.fstat(fp.fileno())[stat.ST_SIZE] - start <= self.memory / 4
+
+   def _remember(self, id, source, text):
+      if len(text) > self.memory / 4:
+         return
+      old = self.entries.get(id)
+      if old:
+         self.inmemory -= len(old[2])
+      self.entries[id] = [self.clock, source, text]
+      self.inmemory += len(text)
+      if self.inmemory > self.memory:
+         # drop the least recently used until well below the budget, so
+         # this doesn't happen on every diff
+         entries = [(entry[0], id) for (id, entry) in self.entries.items()]
+         entries.sort()
+         for (clock, id) in entries:
+            if self.inmemory <= self.memory * 3 / 4:
+               break
+            self.inmemory -= len(self.entries.pop(id)[2])
+
+   def _name(self, id):
+      return os.path.join('%02d' % (id % 100), str(id))
+
+   def _load(self, id, source):
+      """ Returns the file of the entry, positioned at the text """
+      name = self._name(id)
+      fp = self.disk.open(name)
+      if fp is None:
+         return None
+      try:
+         version, stored = cPickle.load(fp)
+      except (EnvironmentError, EOFError, ValueError, TypeError,
+              cPickle.UnpicklingError):
+         fp.close()
+         return None
+      if version != _VERSION or stored != source:
+         fp.close()
+         return None
+      self.disk.touch(name)
+      return fp
+
+   def _store(self, id, source, text):
+      def write(fp):
+         cPickle.dump((_VERSION, source), fp, cPickle.HIGHEST_PROTOCOL)
+         fp.write(text)
+      self.disk.write(self._name(id), write)
@@ -0,0 +1,12 @@
+# vim:set tabstop=3 shiftwidth=3 expandtab:
+# vim:set autoindent smarttab nowrap:
+
+from django.db.models.signals import post_syncdb
+
+def createsearch(sender, **kwargs):
+   """ The full-text table is no model, syncdb can't create it """
+   if sender.__name__.split('.')[-2] == 'webreview':
+      from webreview import search
+      search.create()
+
+post_syncdb.connect(createsearch)
@@ -2,9 +2,11 @@
 # vim:set autoindent smarttab nowrap:
 
 from django.db import models
+from django.conf import settings
 from datetime import timedelta, datetime
 
 import re
+import hashlib
 
 # Create your models here.
 class Category(models.Model):
@@ -14,6 +16,19 @@ class Repository(models.Model):
    path = models.TextField()
    name = models.CharField(max_length=100)
    category = models.ForeignKey(Category, null=True)
+   # position in CVSROOT/history up to which commits have been scanned
+   history_offset = models.IntegerField(null=True)
+   # 'internal' or 'external', empty to use settings.DIFF_ENGINE
+   diff_engine = models.CharField(max_length=10, blank=True, default='')
+
+   def getmodule(self, cache=None, blamecache=None, snapshots=None):
+      """ Returns the vclib repository to access the RCS files with """
+      # imported here, the scripts load the models before vclib is on
+      # the path
+      import vclib.ccvs
+      return vclib.ccvs.CCVSRepository("foo", self.path, cache,
+                                       self.diff_engine or settings.DIFF_ENGINE,
+                                       blamecache, snapshots)
 
 class File(models.Model):
    repository = models.ForeignKey('Repository') 
@@ -22,35 +37,75 @@ class File(models.Model):
    last_rev = models.CharField(max_length=20, null=True)
 
 class User(models.Model):
-   name = models.CharField(max_length=40)
+   name = models.CharField(max_length=40, db_index=True)
 
 class Branch(models.Model):
    tag = models.CharField(max_length=100)
    name = models.CharField(max_length=30)
     
+def loghash(text):
+   """ Returns the key of a log message in the LogMessage table """
+   if isinstance(text, unicode):
+      text = text.encode('utf-8')
+   return hashlib.sha1(text).hexdigest()
+
+class LogMessage(models.Model):
+   """ Every log message is stored once, the changes of a commit share
+       it. Keyed by loghash() of the text. """
+   hash = models.CharField(max_length=40, unique=True)
+   text = models.TextField()
+
+class Changeset(models.Model):
+   """ The changes of one commit, grouped by the scanner. The feed is
+       ordered by (commit_time, id), see sql/changeset.sql for the
+       indexes. """
+   repository = models.ForeignKey('Repository')
+   user = models.ForeignKey('User')
+   log = models.ForeignKey('LogMessage')
+   commitid = models.CharField(max_length=32, null=True)
+   # commit times of the first and the last change
+   start_time = models.DateTimeField()
+   commit_time = models.DateTimeField()
+   files = models.IntegerField(default=0)
+   added = models.IntegerField(default=0)
+   removed = models.IntegerField(default=0)
+
+   def diffstat(self):
+      return "+%d -%d" % (self.added, self.removed)
+
+class SearchTerm(models.Model):
+   """ A word of a changeset, see webreview.search. Only used if the
+       database has no full-text index. """
+   term = models.CharField(max_length=100)
+   changeset = models.ForeignKey('Changeset')
+
+   class Meta:
+      unique_together = (('term', 'changeset'),)
+
 class Change(models.Model):
    file = models.ForeignKey('File')
    user = models.ForeignKey('User')
+   changeset = models.ForeignKey('Changeset', null=True)
    rev_old = models.CharField(max_length=20)
    rev_new = models.CharField(max_length=20)
-   logmessage = models.TextField()
-   commit_time = models.DateTimeField()
+   log = models.ForeignKey('LogMessage')
+   commit_time = models.DateTimeField(db_index=True)
    diffstat = models.CharField(max_length=40)
 
    loglenlimit = 200
    loglenshort = 190
 
    def logisshort(self):
-      return (len(self.logmessage) < self.loglenlimit)
+      return (len(self.log.text) < self.loglenlimit)
 
    def longlog(self):
-      return self.logmessage
+      return self.log.text
    
    def shortlog(self):
       if self.logisshort():
-         return self.logmessage
+         return self.log.text
       else:
-         return self.logmessage[:self.loglenshort]
+         return self.log.text[:self.loglenshort]
 
    def commit_time_nice(self):
       delta = datetime.now() - self.commit_time
@@ -72,9 +127,6 @@ class Change(models.Model):
       ret += " ago"
       return ret
 
-   def sameset(self, other):
-      return self.user == other.user and self.logmessage == other.logmessage
-
 class Comment(models.Model):
    change = models.ForeignKey('Change')
    user = models.ForeignKey('User')
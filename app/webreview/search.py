@@ -0,0 +1,204 @@
+# vim:set tabstop=3 shiftwidth=3 expandtab:
+# vim:set autoindent smarttab nowrap:
+
+""" Full-text search over the log messages, authors and paths of the
+    changesets.
+
+    Each changeset is one document of the index, with its id as the key.
+    On SQLite with FTS5 or FTS4 compiled in the documents live in the
+    webreview_search virtual table, otherwise in the SearchTerm table,
+    an inverted index of their words. Results are returned newest
+    changeset id first, which both indexes read in order instead of
+    sorting the matches.
+
+    A query is a list of words which must all be found. A word can be
+    limited to one field with log:, author: or path:, words joined by
+    punctuation like path:module/file.c must follow each other. """
+
+import re
+import posixpath
+
+from django.conf import settings
+from django.db import connection, DatabaseError
+
+from webreview.models import Change, Changeset, SearchTerm
+
+TABLE = 'webreview_search'
+FIELDS = ('log', 'author', 'path')
+
+# the words as split by the FTS tokenizers
+_word = re.compile(r'[^\W_]+', re.UNICODE)
+
+# the ids passed in one query stay below the SQLite variable limit
+_chunk = 500
+
+def parse(query):
+   """ Returns the (field, text) pairs of a query, field is None if a
+       word is not limited to a field. Words without any letters or
+       digits are dropped. """
+   terms = []
+   for word in query.split():
+      field, sep, text = word.partition(':')
+      if not sep or field.lower() not in FIELDS:
+         field, text = None, word
+      else:
+         field = field.lower()
+      if _word.search(text):
+         terms.append((field, text))
+   return terms
+
+def words(text):
+   return _word.findall(text.lower())
+
+def documents(ids):
+   """ Returns the (id, log, author, path) documents of the changesets """
+   docs = {}
+   for (id, log, author) in Changeset.objects.filter(id__in=ids) \
+            .values_list('id', 'log__text', 'user__name'):
+      docs[id] = (log, author, set())
+   for (id, module, name) in Change.objects.filter(changeset__in=ids) \
+            .values_list('changeset', 'file__repository__name', 'file__name'):
+      docs[id][2].add(posixpath.normpath(posixpath.join(module, name)))
+   return [(id, log, author, "\n".join(sorted(paths)))
+           for (id, (log, author, paths)) in docs.items()]
+
+class FTSIndex:
+   """ The index in an SQLite FTS5 or FTS4 table """
+   def empty(self):
+      cursor = connection.cursor()
+      cursor.execute("SELECT 1 FROM %s LIMIT 1" % TABLE)
+      return cursor.fetchone() is None
+
+   def update(self, docs):
+      cursor = connection.cursor()
+      for i in range(0, len(docs), _chunk):
+         chunk = docs[i:i+_chunk]
+         cursor.execute("DELETE FROM %s WHERE rowid IN (%s)" % (
+                           TABLE, ", ".join(["%s"] * len(chunk))),
+                        [doc[0] for doc in chunk])
+         cursor.executemany("INSERT INTO %s (rowid, %s) VALUES (%%s, %s)" % (
+                              TABLE, ", ".join(FIELDS),
+                              ", ".join(["%s"] * len(FIELDS))), chunk)
+
+   def search(self, terms, after, limit, reverse):
+      # quoted, the words are phrases and never operators
+      match = " ".join([(field and field + ':' or '') +
+                        '"%s"' % text.replace('"', '""')
+                        for (field, text) in terms])
+      sql = "SELECT rowid FROM %s WHERE %s MATCH %%s" % (TABLE, TABLE)
+      params = [match]
+      if after is not None:
+         sql += reverse and " AND rowid > %s" or " AND rowid < %s"
+         params.append(after)
+      sql += " ORDER BY rowid %s LIMIT %d" % (reverse and "ASC" or "DESC",
+                                              limit)
+      cursor = connection.cursor()
+      cursor.execute(sql, params)
+      return [row[0] for row in cursor.fetchall()]
+
+class TermIndex:
+   """ The index in the SearchTerm table. Every word of a changeset is
+       stored once by itself and once prefixed with its field, so each
+       word of a query is a single lookup in the (term, changeset)
+       index. Words joined by punctuation only need to be present. """
+   def __init__(self):
+      self.length = SearchTerm._meta.get_field('term').max_length
+
+   def terms(self, doc):
+      terms = set()
+      for (field, text) in zip(FIELDS, doc[1:]):
+         for word in words(text):
+            terms.add(word[:self.length])
+            terms.add((field + ':' + word)[:self.length])
+      return terms
+
+   def empty(self):
+      return not SearchTerm.objects.all()[:1]
+
+   def update(self, docs):
+      qn = connection.ops.quote_name
+      table = qn(SearchTerm._meta.db_table)
+      term = qn(SearchTerm._meta.get_field('term').column)
+      changeset = qn(SearchTerm._meta.get_field('changeset').column)
+      cursor = connection.cursor()
+      for i in range(0, len(docs), _chunk):
+         chunk = docs[i:i+_chunk]
+         cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (table,
+                           changeset, ", ".join(["%s"] * len(chunk))),
+                        [doc[0] for doc in chunk])
+         cursor.executemany("INSERT INTO %s (%s, %s) VALUES (%%s, %%s)" % (
+                              table, term, changeset),
+                            [(t, doc[0]) for doc in chunk
+                                         for t in self.terms(doc)])
+
+   def search(self, terms, after, limit, reverse):
+      keys = []
+      for (field, text) in terms:
+         for word in words(text):
+            key = (field and field + ':' + word or word)[:self.length]
+            if key not in keys:
+               keys.append(key)
+      qn = connection.ops.quote_name
+      table = qn(SearchTerm._meta.db_table)
+      term = qn(SearchTerm._meta.get_field('term').column)
+      changeset = qn(SearchTerm._meta.get_field('changeset').column)
+      # walk the changesets of the first word in order and look up
+      # the others for each of them
+      sql = "SELECT t0.%s FROM %s t0" % (changeset, table)
+      for i in range(1, len(keys)):
+         sql += " JOIN %s t%d ON t%d.%s = %%s AND t%d.%s = t0.%s" % (
+                  table, i, i, term, i, changeset, changeset)
+      sql += " WHERE t0.%s = %%s" % term
+      params = keys[1:] + keys[:1]
+      if after is not None:
+         sql += " AND t0.%s %s %%s" % (changeset, reverse and '>' or '<')
+         params.append(after)
+      sql += " ORDER BY t0.%s %s LIMIT %d" % (changeset,
+                                              reverse and "ASC" or "DESC",
+                                              limit)
+      cursor = connection.cursor()
+      cursor.execute(sql, params)
+      return [row[0] for row in cursor.fetchall()]
+
+def create():
+   """ Creates the FTS table if the database supports one, called after
+       syncdb. Without it the SearchTerm table is used. """
+   if settings.DATABASE_ENGINE != 'sqlite3' or \
+      TABLE in connection.introspection.table_names():
+      return
+   cursor = connection.cursor()
+   for module in ('fts5', 'fts4'):
+      try:
+         cursor.execute("CREATE VIRTUAL TABLE %s USING %s(%s)" % (
+                           TABLE, module, ", ".join(FIELDS)))
+      except DatabaseError:
+         # not compiled into this SQLite
+         continue
+      return
+
+_index = None
+
+def getindex():
+   """ Returns the index in use for this database """
+   global _index
+   if _index is None:
+      if settings.DATABASE_ENGINE == 'sqlite3' and \
+         TABLE in connection.introspection.table_names():
+         _index = FTSIndex()
+      else:
+         _index = TermIndex()
+   return _index
+
+def update(ids):
+   """ (Re)indexes the changesets with these ids, after their changes
+       have been stored """
+   getindex().update(documents(ids))
+
+def search(query, after=None, limit=100, reverse=False):
+   """ Returns the ids of the first limit changesets matching the query,
+       those before the id after in descending order, or those after it
+       in ascending order with reverse. """
+   terms = parse(query)
+   if not terms:
+      return []
+   return getindex().search(terms, after, limit, reverse)
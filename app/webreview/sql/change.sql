@@ -0,0 +1,2 @@
+-- the changes of a file in the order of their commits
+CREATE INDEX webreview_change_file_time ON webreview_change (file_id, commit_time);
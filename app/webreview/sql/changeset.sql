@@ -0,0 +1,3 @@
+-- the feed pages by (commit_time, id), of all repositories or of one
+CREATE INDEX webreview_changeset_time ON webreview_changeset (commit_time, id);
+CREATE INDEX webreview_changeset_repository_time ON webreview_changeset (repository_id, commit_time, id);
@@ -0,0 +1,2 @@
+-- files are looked up by name within a repository
+CREATE INDEX webreview_file_repository_name ON webreview_file (repository_id, name);
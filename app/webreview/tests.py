@@ -0,0 +1,709 @@
+# vim:set tabstop=3 shiftwidth=3 expandtab:
+# vim:set autoindent smarttab nowrap:
+
+import os
+import re
+import sys
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.db import connection, reset_queries
+from django.test import TestCase
+
+from webreview.models import Category, Repository, File, User, Change, \
+                             Changeset, LogMessage, loghash
+from webreview.views import keyset
+from webreview import views
+from webreview import search
+from webreview.diffcache import DiffCache, source
+from vclib.ccvs import blame
+from vclib.ccvs.rcscache import RCSCache
+from vclib.ccvs.blamecache import BlameCache
+from vclib.ccvs.snapshots import SnapshotCache
+
+def addChanges(count):
+   """ Adds count changes spread over two categories, two modules each """
+   modules = []
+   for c in range(2):
+      category = Category.objects.create(name='cat%d' % c)
+      for m in range(2):
+         modules.append(Repository.objects.create(name='mod%d%d' % (c, m),
+                           path='/nonexistent', category=category))
+   users = [User.objects.create(name='user%d' % u) for u in range(3)]
+   files = [File.objects.create(repository=modules[f % len(modules)],
+               name='./file%d' % f, last_change=datetime(2009, 1, 1))
+            for f in range(10)]
+   time = datetime(2009, 1, 1)
+   for i in range(count):
+      # three changes per changeset
+      if i % 3 == 0:
+         changeset = Changeset.objects.create(
+               repository=files[i % len(files)].repository,
+               user=users[i / 3 % len(users)],
+               log=LogMessage.objects.create(text='change set %d' % (i / 3),
+                                 hash=loghash('change set %d' % (i / 3))),
+               start_time=time + timedelta(minutes=i / 3),
+               commit_time=time + timedelta(minutes=i / 3))
+      Change.objects.create(file=files[i % len(files)], changeset=changeset,
+            user=changeset.user, rev_old='1.1', rev_new='1.2',
+            log=changeset.log, diffstat='+1 -1',
+            commit_time=changeset.commit_time)
+
+def usecaches(directory):
+   """ Points the caches of the views into directory instead of the
+       ones of the site, returns those for restorecaches() """
+   site = (views.rcscache, views.diffcache, views.blamecache, views.snapshots)
+   views.rcscache = RCSCache(os.path.join(directory, 'rcscache'))
+   views.diffcache = DiffCache(os.path.join(directory, 'diffcache'),
+                               memory=100000)
+   views.blamecache = BlameCache(os.path.join(directory, 'blamecache'))
+   views.snapshots = SnapshotCache(os.path.join(directory, 'snapshots'))
+   return site
+
+def restorecaches(site):
+   views.rcscache, views.diffcache, views.blamecache, views.snapshots = site
+
+class QueryCountTest(TestCase):
+   """ The number of queries for a page of the feed must not depend on
+       the number of changes shown. """
+   def setUp(self):
+      self.debug = settings.DEBUG
+      # connection.queries is only recorded in debug mode
+      settings.DEBUG = True
+
+   def tearDown(self):
+      settings.DEBUG = self.debug
+
+   def countQueries(self, url):
+      reset_queries()
+      response = self.client.get(url)
+      self.assertEqual(response.status_code, 200)
+      return len(connection.queries)
+
+   def testIndex(self):
+      addChanges(450)
+      # changesets, their changes, categories, modules
+      self.assertEqual(self.countQueries('/'), 4)
+
+   def testFewChanges(self):
+      addChanges(5)
+      self.assertEqual(self.countQueries('/'), 4)
+
+   def testCategory(self):
+      addChanges(450)
+      # the category and its modules are looked up as well, the ids of
+      # the changesets of all modules are found in one query
+      self.assertEqual(self.countQueries('/changes/category/1'), 7)
+
+   def testCategoryModules(self):
+      # more than a page in the category
+      addChanges(900)
+      response = self.client.get('/changes/category/1')
+      cursor = response.context['navigation'].next
+      for m in range(10):
+         Repository.objects.create(name='more%d' % m, path='/nonexistent',
+                                   category_id=1)
+      self.assertEqual(self.countQueries('/changes/category/1'), 7)
+      # plus the ids and changesets before the cursor
+      self.assertEqual(self.countQueries('/changes/category/1/after/%s' %
+                                         cursor), 9)
+
+   def testCategoryPages(self):
+      addChanges(450)
+      category = Category.objects.get(id=1)
+      expected = list(Changeset.objects.filter(repository__category=category)
+                                       .order_by('-commit_time', '-id'))
+      pages = []
+      after = None
+      while True:
+         page, nav = views.getchangesets(category=category, after=after,
+                                         limit=7)
+         pages.append(page)
+         if nav.prev is not None:
+            self.assertEqual(views.getchangesets(category=category,
+                                                 after=nav.prev,
+                                                 limit=7)[0], pages[-2])
+         if nav.next is None:
+            break
+         after = nav.next
+      self.assertEqual(sum(pages, []), expected)
+
+   def testModule(self):
+      addChanges(450)
+      self.assertEqual(self.countQueries('/changes/module/1'), 5)
+
+   def testNextPage(self):
+      addChanges(450)
+      response = self.client.get('/')
+      cursor = response.context['navigation'].next
+      # plus the changesets before the cursor for the previous page
+      self.assertEqual(self.countQueries('/changes/all/after/%s' % cursor), 5)
+
+class SearchTest(TestCase):
+   """ Both indexes must find the same changesets, newest first. """
+   def setUp(self):
+      addChanges(30)
+      search.update(list(Changeset.objects.values_list('id', flat=True)))
+
+   def check(self, index):
+      def find(query, after=None, limit=100, reverse=False):
+         return index.search(search.parse(query), after, limit, reverse)
+      self.assertEqual(find('set'), range(10, 0, -1))
+      self.assertEqual(find('change 7'), [8])
+      self.assertEqual(find('log:set author:user1'), [8, 5, 2])
+      self.assertEqual(find('author:set'), [])
+      # paths start with the module, file1 is in mod01
+      self.assertEqual(find('path:mod01/file1'), [8, 4, 1])
+      self.assertEqual(find('path:mod01 file3'), [8, 2])
+      self.assertEqual(find('user2', after=9, limit=2), [6, 3])
+      self.assertEqual(find('user2', after=3, reverse=True), [6, 9])
+
+   def testFTS(self):
+      index = search.getindex()
+      if not isinstance(index, search.FTSIndex):
+         return
+      self.check(index)
+
+   def testTerms(self):
+      index = search.TermIndex()
+      index.update(search.documents(range(1, 11)))
+      self.check(index)
+
+   def testUpdate(self):
+      # a changeset that grows is indexed again
+      change = Change.objects.get(id=1)
+      change.id = None
+      change.file = File.objects.get(name='./file9')
+      change.save()
+      search.update([1])
+      self.assertEqual(search.search('path:file9 set'), [10, 7, 4, 1])
+
+   def testView(self):
+      response = self.client.get('/search?q=author:user2')
+      self.assertEqual(response.status_code, 200)
+      self.assertEqual([cs.id for cs in response.context['changesets']],
+                       [9, 6, 3])
+      response = self.client.get('/search?q=%3A')
+      self.assertEqual(response.context['changesets'], [])
+
+class DiffCacheTest(TestCase):
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+
+   def tearDown(self):
+      shutil.rmtree(self.directory)
+
+   def testGet(self):
+      cache = DiffCache(self.directory, memory=1000)
+      source = ('/repo', './file', '1.1', '1.2')
+      self.assertEqual(cache.get(1, source), None)
+      cache.put(1, source, 'diff')
+      self.assertEqual(cache.get(1, source), 'diff')
+      # from the directory
+      self.assertEqual(DiffCache(self.directory).get(1, source), 'diff')
+      # the id of a change of another database
+      other = ('/repo', './file', '1.2', '1.3')
+      self.assertEqual(cache.get(1, other), None)
+      self.assertEqual(DiffCache(self.directory).get(1, other), None)
+
+   def testMemory(self):
+      cache = DiffCache(self.directory, memory=100)
+      for id in range(11):
+         cache.put(id, None, '%010d' % id)
+      # the least recently used are dropped until 75 bytes are left
+      self.assertEqual(sorted(cache.entries.keys()), range(4, 11))
+      self.assertEqual(cache.inmemory, 70)
+      cache.get(4, None)
+      for id in range(11, 15):
+         cache.put(id, None, '%010d' % id)
+      self.assertEqual(sorted(cache.entries.keys()), [4] + range(9, 15))
+      # dropped ones come back from the directory
+      self.assertEqual(cache.get(0, None), '%010d' % 0)
+      cache.put(7, None, 'x' * 26)
+      self.failIf(7 in cache.entries)
+
+   def testDirectory(self):
+      cache = DiffCache(self.directory, budget=10000)
+      for id in range(50):
+         cache.put(id, None, 'x' * 1000)
+      used = 0
+      for dirpath, dirnames, filenames in os.walk(self.directory):
+         for name in filenames:
+            used += os.path.getsize(os.path.join(dirpath, name))
+      self.assert_(used <= 10000)
+      self.assertEqual(DiffCache(self.directory).get(49, None), 'x' * 1000)
+
+class ChangesetDiffsTest(TestCase):
+   """ The diffs of a changeset in one response equal the single ones """
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      self.caches = usecaches(self.directory)
+      repository = Repository.objects.create(name='test',
+                     path=os.path.join(settings.SITE_ROOT, 'test', 'repo'))
+      user = User.objects.create(name='oliver')
+      log = LogMessage.objects.create(text='log', hash=loghash('log'))
+      self.changeset = Changeset.objects.create(repository=repository,
+                          user=user, log=log, start_time=datetime(2010, 1, 1),
+                          commit_time=datetime(2010, 1, 1))
+      for (name, rev_old, rev_new) in (('./module2/gpl.txt', '1.1', '1.2'),
+                                       ('./module2/gpl.txt', '1.1', '1.3'),
+                                       ('./module1/file2.txt', '1.2', '1.3'),
+                                       ('./module1/file2.txt', 'New', '1.1')):
+         file = File.objects.get_or_create(repository=repository, name=name,
+                                           last_change=datetime(2010, 1, 1))[0]
+         Change.objects.create(file=file, changeset=self.changeset, user=user,
+               rev_old=rev_old, rev_new=rev_new, log=log, diffstat='',
+               commit_time=datetime(2010, 1, 1))
+
+   def tearDown(self):
+      restorecaches(self.caches)
+      shutil.rmtree(self.directory)
+
+   def testDiffs(self):
+      # the second time from the cache
+      for i in range(2):
+         response = self.client.get('/changeset/%d/diffs' % self.changeset.id)
+         self.assertEqual(response.status_code, 200)
+         content = response.content
+         for change in Change.objects.exclude(rev_old='New'):
+            single = self.client.get('/diff/%d/html' % change.id).content
+            self.assert_('<div id="diffset%d">%s</div>' % (change.id, single)
+                         in content)
+         self.assert_('<i>no diff</i>' in content)
+
+   def testLoadMore(self):
+      change = Change.objects.get(rev_new='1.3', file__name='./module2/gpl.txt')
+      url = '/diff/%d/html' % change.id
+      full = self.client.get(url).content
+      more = re.compile(r'<tr id="diffmore\d+">.*?, (\d+)\).*?</tr>\n')
+      limit = settings.DIFF_LINE_LIMIT
+      settings.DIFF_LINE_LIMIT = 100
+      try:
+         for cached in (True, False):
+            if not cached:
+               views.diffcache = None
+            content = self.client.get(url).content
+            pages = 1
+            match = more.search(content)
+            while match:
+               rows = self.client.get(url + '?offset=' + match.group(1))
+               content = content[:match.start()] + rows.content + \
+                         content[match.end():]
+               pages += 1
+               match = more.search(content)
+            self.assertEqual(content, full)
+            self.assert_(pages > 5)
+      finally:
+         settings.DIFF_LINE_LIMIT = limit
+
+   def testBadOffset(self):
+      change = Change.objects.get(rev_new='1.3', file__name='./module2/gpl.txt')
+      for offset in ('x', '-5', '1.5', ''):
+         response = self.client.get('/diff/%d/html?offset=%s' % (change.id,
+                                                                offset))
+         self.assertEqual(response.status_code, 400)
+
+class BlameTest(TestCase):
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      self.caches = usecaches(self.directory)
+      repository = Repository.objects.create(name='test',
+                     path=os.path.join(settings.SITE_ROOT, 'test', 'repo'))
+      self.module = repository.getmodule()
+      user = User.objects.create(name='oliver')
+      log = LogMessage.objects.create(text='log', hash=loghash('log'))
+      file = File.objects.create(repository=repository,
+                                 name='./module2/gpl.txt',
+                                 last_change=datetime(2010, 1, 1))
+      self.change = Change.objects.create(file=file, user=user,
+                       rev_old='1.2', rev_new='1.3', log=log, diffstat='',
+                       commit_time=datetime(2010, 1, 1))
+
+   def tearDown(self):
+      restorecaches(self.caches)
+      shutil.rmtree(self.directory)
+
+   def testEngine(self):
+      # the same lines and revisions as the list based parser
+      path = self.module.rcsfile(['module2', 'gpl.txt'], 1)
+      for rev in ('1.1', '1.1.1.1', '1.2', '1.3'):
+         parser = blame.CVSParser()
+         parser.parse_cvs_file(path, rev)
+         source, revision = self.module.annotate(['module2', 'gpl.txt'], rev)
+         lines = list(source)
+         self.assertEqual([line.rev for line in lines], parser.revision_map)
+         self.assertEqual([line.text for line in lines],
+                          parser.extract_revision(revision))
+         for line in lines:
+            self.assertEqual(line.date, parser.timestamp[line.rev])
+
+   def testView(self):
+      response = self.client.get('/blame/%d/html' % self.change.id)
+      self.assertEqual(response.status_code, 200)
+      content = response.content
+      source, revision = self.module.annotate(['module2', 'gpl.txt'], '1.3')
+      self.assertEqual(content.count('<td class="code">'), len(list(source)))
+      self.assert_('<td class="blame">1.2</td>' in content)
+      self.assert_('<td class="blame">1.3</td>' in content)
+
+class QueryPlanTest(TestCase):
+   """ The feed and scanner queries must read ranges of indexes instead
+       of scanning tables or sorting rows. Checked with SQLite only. """
+   def setUp(self):
+      # no rows needed, the python sqlite module commits before EXPLAIN
+      # which would keep them for the following tests
+      self.key = (datetime(2009, 1, 1, 0, 5), 20)
+
+   def assertIndexed(self, queryset):
+      if settings.DATABASE_ENGINE != 'sqlite3':
+         return
+      sql, params = queryset.query.as_sql()
+      cursor = connection.cursor()
+      cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+      for row in cursor.fetchall():
+         detail = row[-1]
+         self.failIf('TEMP B-TREE' in detail, detail)
+         if 'INDEX' not in detail and 'PRIMARY KEY' not in detail:
+            self.failIf('SCAN' in detail or detail.startswith('TABLE'),
+                        detail)
+
+   def testFeed(self):
+      changesets = Changeset.objects.select_related('user')
+      self.assertIndexed(keyset(changesets, self.key)[:101])
+      self.assertIndexed(keyset(changesets, self.key, reverse=True)[:101])
+
+   def testModuleFeed(self):
+      changesets = Changeset.objects.select_related('user') \
+                                    .filter(repository=1)
+      self.assertIndexed(keyset(changesets, self.key)[:101])
+      self.assertIndexed(keyset(changesets, self.key, reverse=True)[:101])
+
+   def testChanges(self):
+      self.assertIndexed(Change.objects.filter(changeset__in=[1, 2, 3])
+                               .select_related('file__repository', 'user'))
+      self.assertIndexed(Change.objects.filter(file=1)
+                               .order_by('commit_time'))
+
+   def testLookups(self):
+      self.assertIndexed(File.objects.filter(repository=1, name='./file1'))
+      self.assertIndexed(User.objects.filter(name='user1'))
+
+class ChangeWriterTest(TestCase):
+   def testFileBoundary(self):
+      # a file's changes are written together with its new revision
+      from scanner.repscanner import ChangeWriter
+      addChanges(3)
+      file = File.objects.all()[0]
+      change = Change.objects.filter(file=file)[0]
+      writer = ChangeWriter(batchsize=2)
+      writer.begin()
+      try:
+         for rev in ('1.3', '1.4', '1.5'):
+            writer.addChange(Change(file=file, changeset=change.changeset,
+                                    user=change.user, rev_old='1.2',
+                                    rev_new=rev, log=change.log,
+                                    diffstat='+1 -1',
+                                    commit_time=change.commit_time))
+         self.assertEqual(Change.objects.filter(file=file).count(), 1)
+         file.last_rev = '1.5'
+         writer.updateFile(file)
+         self.assertEqual(Change.objects.filter(file=file).count(), 4)
+         self.assertEqual(File.objects.get(id=file.id).last_rev, '1.5')
+      finally:
+         writer.end()
+
+   def testRollback(self):
+      # the caches forget what they got since the last commit
+      from scanner.repscanner import ChangeWriter, Cache, LogCache, \
+                                     ChangesetGrouper
+      addChanges(1)
+      change = Change.objects.all()[0]
+      file = File.objects.create(repository=change.file.repository,
+                                 name='./other', last_change=datetime.now())
+      users = Cache(User.objects.all())
+      logs = LogCache()
+      grouper = ChangesetGrouper(change.file.repository, 300)
+      writer = ChangeWriter()
+      for cache in (users, logs, grouper, users):
+         writer.track(cache)
+      self.assertEqual(len(writer.caches), 3)
+      writer.begin()
+      try:
+         users.add(User.objects.create(name='committed'))
+         committed = logs.intern('committed')
+         writer.flush()
+         users.add(User.objects.create(name='new'))
+         logs.intern('new')
+         cs = grouper.assign(Change(file=file, user=change.user,
+                                    log=change.log, diffstat='+1 -1',
+                                    commit_time=change.commit_time))
+         self.assertEqual((cs.id, cs.files), (change.changeset.id, 1))
+         writer.updateChangeset(cs)
+         file.last_rev = '1.1'
+         writer.updateFile(file)
+      finally:
+         writer.end()
+      self.assert_(users.get('committed') and not users.get('new'))
+      self.assertEqual(logs.ids.get(loghash('committed')), committed)
+      self.assert_(loghash('new') not in logs.ids)
+      self.assertEqual(file.last_rev, None)
+      self.assertEqual(grouper.find(Change(file=file, user=change.user,
+                                           log=change.log,
+                                           commit_time=change.commit_time),
+                                    None).files, 0)
+
+   def testWarmErrors(self):
+      # RCS files that fail to parse are left out of the caches, their
+      # changes are stored all the same
+      from scanner.repscanner import ChangeWriter
+      directory = tempfile.mkdtemp()
+      try:
+         repository = Repository.objects.create(name='broken',
+                                                path=directory)
+         module = repository.getmodule()
+         user = User.objects.create(name='oliver')
+         log = LogMessage.objects.create(text='log', hash=loghash('log'))
+         diffs = DiffCache(os.path.join(directory, 'diffs'))
+         blames = BlameCache(os.path.join(directory, 'blames'))
+         writer = ChangeWriter(diffs=diffs, blames=blames)
+         writer.begin()
+         try:
+            for name, text in (('unterminated', 'head 1.2; @'),
+                               ('garbage', 'head 1.2;\naccess;\nsymbols;\n'
+                                           'locks; strict;\n1.2 date x;\n')):
+               path = os.path.join(directory, name + ',v')
+               open(path, 'w').write(text)
+               # the blame of the new revision is made from this one
+               blames.put(path, '1.1', 0, blame.RevisionMap('1.1', 1))
+               file = File.objects.create(repository=repository,
+                                          name='./' + name,
+                                          last_change=datetime.now())
+               writer.addChange(Change(file=file, user=user, rev_old='1.1',
+                                       rev_new='1.2', log=log, diffstat='',
+                                       commit_time=datetime.now()))
+               writer.updateFile(file)
+            writer.flush()
+         finally:
+            writer.end()
+         changes = Change.objects.filter(file__repository=repository)
+         self.assertEqual(sorted([c.file.name for c in changes]),
+                          ['./garbage', './unterminated'])
+         for change in changes:
+            self.assertEqual(diffs.get(change.id, source(change)), None)
+            path = module.rcsfile([change.file.name], 1)
+            self.assert_(blames.has(path, '1.1'))
+            self.assert_(not blames.has(path, '1.2'))
+         self.assert_(not os.path.exists(os.path.join(directory, 'diffs')))
+      finally:
+         shutil.rmtree(directory)
+
+class ChangesetGrouperTest(TestCase):
+   def setUp(self):
+      addChanges(1)
+      self.change = Change.objects.all()[0]
+      self.start = self.change.commit_time + timedelta(days=1)
+
+   def assign(self, grouper, seconds, name='./file0', commitid=None,
+              diffstat='', lines=0):
+      """ Assigns a change of the file with that name, seconds after the
+          start, returns its changeset """
+      file, created = File.objects.get_or_create(
+                         repository=self.change.file.repository, name=name,
+                         defaults={'last_change': self.start})
+      return grouper.assign(Change(file=file, user=self.change.user,
+                                   log=self.change.log, diffstat=diffstat,
+                                   commit_time=self.start +
+                                               timedelta(seconds=seconds)),
+                            commitid, lines)
+
+   def testWindow(self):
+      # a change joins a changeset of the same user and log up to the
+      # window before its first or after its last change
+      from scanner.repscanner import ChangesetGrouper
+      grouper = ChangesetGrouper(self.change.file.repository, 300)
+      cs = self.assign(grouper, 0, './a')
+      self.assert_(self.assign(grouper, 300, './b') is cs)
+      self.assert_(self.assign(grouper, -300, './c') is cs)
+      self.assert_(self.assign(grouper, 600, './d') is cs)
+      self.assert_(self.assign(grouper, 901, './e') is not cs)
+      self.assert_(self.assign(grouper, -601, './f') is not cs)
+      self.assertEqual((cs.files, cs.start_time, cs.commit_time),
+                       (4, self.start - timedelta(seconds=300),
+                        self.start + timedelta(seconds=600)))
+
+   def testCommitid(self):
+      # the commitid decides, regardless of the window
+      from scanner.repscanner import ChangesetGrouper
+      grouper = ChangesetGrouper(self.change.file.repository, 300)
+      cs = self.assign(grouper, 0, './a', 'c1')
+      self.assert_(self.assign(grouper, 3600, './b', 'c1') is cs)
+      self.assert_(self.assign(grouper, 10, './c') is not cs)
+      self.assert_(self.assign(grouper, 10, './d', 'c2') is not cs)
+      self.assertEqual(cs.files, 2)
+
+   def testSameFile(self):
+      # a file committed twice within the window makes two changesets
+      from scanner.repscanner import ChangesetGrouper
+      grouper = ChangesetGrouper(self.change.file.repository, 300)
+      cs = self.assign(grouper, 0, './a')
+      self.assert_(self.assign(grouper, 10, './b') is cs)
+      other = self.assign(grouper, 20, './a')
+      self.assert_(other is not cs)
+      self.assert_(self.assign(grouper, 30, './b') is other)
+
+   def testTotals(self):
+      # the lines of new files count as added
+      from scanner.repscanner import ChangesetGrouper
+      grouper = ChangesetGrouper(self.change.file.repository, 300)
+      self.assign(grouper, 0, './a', diffstat='+2 -1')
+      cs = self.assign(grouper, 0, './b', diffstat='new', lines=5)
+      self.assertEqual((cs.files, cs.added, cs.removed), (2, 7, 1))
+
+   def testPrune(self):
+      # only the changesets within the window of the newest one are kept
+      from scanner.repscanner import ChangesetGrouper
+      change = self.change
+      grouper = ChangesetGrouper(change.file.repository, 300)
+      start = change.commit_time + timedelta(days=1)
+      for (minutes, commitid) in ((0, None), (0, 'c1'), (60, None),
+                                  (62, 'c2')):
+         grouper.assign(Change(file=change.file, user=change.user,
+                               log=change.log, diffstat='',
+                               commit_time=start +
+                                           timedelta(minutes=minutes)),
+                        commitid)
+      grouper.prune()
+      self.assertEqual(grouper.commitids.keys(), ['c2'])
+      self.assertEqual([[cs.commit_time for cs in css]
+                        for css in grouper.logs.values()],
+                       [[start + timedelta(minutes=60)]])
+
+class ScanTest(TestCase):
+   """ Scans a repository the test writes RCS files and history into """
+   def setUp(self):
+      self.directory = os.path.realpath(tempfile.mkdtemp())
+      self.history = os.path.join(self.directory, 'CVSROOT', 'history')
+      os.makedirs(os.path.dirname(self.history))
+      os.makedirs(os.path.join(self.directory, 'module'))
+      open(self.history, 'w').close()
+      self.repository = Repository.objects.create(name='module',
+                           path=os.path.join(self.directory, 'module'))
+      # the scanner keeps no caches of the site
+      self.settings = (settings.RCS_CACHE_DIR, settings.DIFF_CACHE_DIR,
+                       settings.BLAME_CACHE_DIR)
+      settings.RCS_CACHE_DIR = None
+      settings.DIFF_CACHE_DIR = None
+      settings.BLAME_CACHE_DIR = None
+
+   def tearDown(self):
+      (settings.RCS_CACHE_DIR, settings.DIFF_CACHE_DIR,
+       settings.BLAME_CACHE_DIR) = self.settings
+      shutil.rmtree(self.directory)
+
+   def commit(self, name, revisions, author='oliver', log='log', record=True):
+      """ Writes the RCS file of module/name with revisions 1.1 to
+          1.<revisions>, one a day, revision 1.n has n lines. With record
+          the commit of the last one goes into the history. """
+      fp = open(os.path.join(self.directory, 'module', name + ',v'), 'w')
+      fp.write('head\t1.%d;\naccess;\nsymbols;\nlocks; strict;\n'
+               'comment\t@# @;\n\n' % revisions)
+      for r in range(revisions, 0, -1):
+         fp.write('\n1.%d\ndate\t2010.01.%02d.00.00.00;\tauthor %s;\t'
+                  'state Exp;\nbranches;\nnext\t%s;\n'
+                  % (r, r, author, r > 1 and '1.%d' % (r - 1) or ''))
+      fp.write('\n\ndesc\n@@\n')
+      fp.write('\n\n1.%d\nlog\n@%s@\ntext\n@%s@\n' % (revisions, log,
+               ''.join(['line %d\n' % i for i in range(revisions)])))
+      for r in range(revisions - 1, 0, -1):
+         fp.write('\n\n1.%d\nlog\n@%s@\ntext\n@d%d 1\n@\n' % (r, log, r + 1))
+      fp.close()
+      if record:
+         open(self.history, 'a').write('M4b000000|%s|~/*0|module|1.%d|%s\n'
+                                       % (author, revisions, name))
+
+   def quiet(self, function, *args, **kwargs):
+      """ Calls function, returns what it printed instead of printing """
+      stdout = sys.stdout
+      sys.stdout = StringIO()
+      try:
+         function(*args, **kwargs)
+         return sys.stdout.getvalue()
+      finally:
+         sys.stdout = stdout
+
+   def scan(self, *args, **kwargs):
+      """ Runs a scan of the repository """
+      from scanner.repscanner import RepositoryScanner
+      self.quiet(RepositoryScanner(self.repository).run, *args, **kwargs)
+      self.repository = Repository.objects.get(id=self.repository.id)
+
+   def revisions(self, name):
+      return sorted([change.rev_new for change in
+                     Change.objects.filter(file__name='./' + name)])
+
+   def testIncremental(self):
+      # after a full scan only the files in the new history records are
+      # scanned, and the history is read from where it was left
+      self.commit('a', 2)
+      self.commit('b', 1)
+      self.scan()
+      self.assertEqual(self.revisions('a'), ['1.1', '1.2'])
+      self.assertEqual(self.revisions('b'), ['1.1'])
+      offset = os.path.getsize(self.history)
+      self.assertEqual(self.repository.history_offset, offset)
+      self.commit('a', 3)
+      self.commit('b', 2, record=False)
+      self.scan()
+      self.assertEqual(self.revisions('a'), ['1.1', '1.2', '1.3'])
+      self.assertEqual(self.revisions('b'), ['1.1'])
+      self.assert_(self.repository.history_offset > offset)
+      self.assertEqual(self.repository.history_offset,
+                       os.path.getsize(self.history))
+
+   def testSameLog(self):
+      # changes with the same message share it
+      self.commit('a', 1, log='same')
+      self.commit('b', 1, log='same')
+      self.scan()
+      self.assertEqual(len(self.revisions('a') + self.revisions('b')), 2)
+      self.assertEqual(LogMessage.objects.filter(text='same').count(), 1)
+
+   def testNewFile(self):
+      # the lines of the first revision count as added
+      self.commit('a', 3)
+      self.scan()
+      self.assertEqual([(cs.added, cs.removed) for cs in
+                        Changeset.objects.order_by('commit_time')],
+                       [(1, 0), (1, 0), (1, 0)])
+
+   def testJobs(self):
+      # parsing in worker processes stores what a serial scan does
+      from scanner.repscanner import scanRepositories
+      repositories = [Repository.objects.create(name=name,
+                         path=os.path.join(settings.SITE_ROOT, 'test',
+                                           'repo', name))
+                      for name in ('module1', 'module2')]
+      def stored():
+         return sorted([(c.file.repository.name, c.file.name, c.rev_old,
+                         c.rev_new, c.user.name, c.log.text, c.diffstat,
+                         c.commit_time, c.changeset.start_time,
+                         c.changeset.commit_time, c.changeset.files,
+                         c.changeset.added, c.changeset.removed)
+                        for c in Change.objects.all()])
+      output = self.quiet(scanRepositories, repositories)
+      serial = stored()
+      self.assert_(len(serial) > 5)
+      # the caches shared by the repositories are summed up once
+      self.assertEqual(output.count('log cache'), 1)
+      Change.objects.all().delete()
+      Changeset.objects.all().delete()
+      File.objects.all().delete()
+      for repository in repositories:
+         repository.history_offset = None
+         repository.save()
+      output = self.quiet(scanRepositories, repositories, jobs=2)
+      self.assertEqual(stored(), serial)
+      self.assertEqual(output.count('log cache'), 1)
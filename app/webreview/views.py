@@ -3,99 +3,395 @@
 # vim:set autoindent smarttab nowrap:
 
 import vclib.ccvs
+import cStringIO
 import django.http as http
+from datetime import datetime
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
 from django.shortcuts import render_to_response
-from webreview.models import File, Repository, Change, User, Comment, Category
+from webreview.models import File, Repository, Change, Changeset, User, \
+                             Comment, Category
+import webreview.search
+from vclib.ccvs.rcscache import RCSCache
+from vclib.ccvs.blamecache import BlameCache
+from vclib.ccvs.snapshots import SnapshotCache
+from webreview.diffcache import DiffCache, source
+
+if settings.RCS_CACHE_DIR:
+    rcscache = RCSCache(settings.RCS_CACHE_DIR, settings.RCS_CACHE_SIZE)
+else:
+    rcscache = None
+
+if settings.DIFF_CACHE_DIR:
+    diffcache = DiffCache(settings.DIFF_CACHE_DIR, settings.DIFF_CACHE_SIZE,
+                          settings.DIFF_CACHE_MEMORY)
+else:
+    diffcache = None
+
+if settings.BLAME_CACHE_DIR:
+    blamecache = BlameCache(settings.BLAME_CACHE_DIR, settings.BLAME_CACHE_SIZE)
+else:
+    blamecache = None
+
+if settings.SNAPSHOT_DIR:
+    snapshots = SnapshotCache(settings.SNAPSHOT_DIR, settings.SNAPSHOT_INTERVAL,
+                              settings.SNAPSHOT_SIZE)
+else:
+    snapshots = None
 
 class Navigation:
-    def __init__(self, max, offset):
-        self.max = max
-        self.limit = 100
-        self.offset = offset
-        self.nextoffset = self.offset + self.limit
-        self.prevoffset = self.offset - self.limit
-        if self.prevoffset < 0:
-            self.prevoffset = 0
-        self.hasprev = (self.offset > 0)
-        self.hasnext = (self.max >= self.limit)
-
-def getchangesets(category=None, module=None, skip=0):
-    limit = 100 + int(skip)
-    order = '-commit_time'
+    def __init__(self, limit, prev, next, hasprev):
+        """ prev and next are the cursors of the neighbouring pages, prev
+            is None when the previous page is the first one """
+        self.limit = limit
+        self.prev = prev
+        self.next = next
+        self.hasprev = hasprev
+        self.hasnext = (next is not None)
+
+def makecursor(change):
+    """ Returns the position after a change in the feed, as used in the
+        /after/ URLs """
+    cursor = change.commit_time.strftime('%Y%m%d%H%M%S')
+    if change.commit_time.microsecond:
+        cursor += '.%06d' % change.commit_time.microsecond
+    return '%s-%d' % (cursor, change.id)
+
+def parsecursor(cursor):
+    """ Returns the (commit_time, id) key of a cursor """
+    time, id = cursor.split('-')
+    time, _, micro = time.partition('.')
+    commit_time = datetime.strptime(time, '%Y%m%d%H%M%S')
+    if micro:
+        commit_time = commit_time.replace(microsecond=int(micro))
+    return commit_time, int(id)
+
+def keyset(rows, key=None, reverse=False):
+    """ Returns the rows after the (commit_time, id) key in feed order,
+        newest first, or the other way round with reverse. Uses a
+        condition on the key rather than an OFFSET, which stays fast on
+        deep pages. """
+    if reverse:
+        rows = rows.order_by('commit_time', 'id')
+    else:
+        rows = rows.order_by('-commit_time', '-id')
+    if key:
+        time, id = key
+        if reverse:
+            rows = rows.filter(Q(commit_time__gt=time) |
+                               Q(commit_time=time, id__gt=id))
+        else:
+            rows = rows.filter(Q(commit_time__lt=time) |
+                               Q(commit_time=time, id__lt=id))
+    return rows
+
+def fetchrows(rows, key, count, reverse=False, parts=None):
+    """ Returns the first count rows after the key in feed order. With
+        parts, a list of filters such as one per module, the rows
+        matching any of them are found in a single query which reads a
+        range of an index for each part and merges them, then they are
+        loaded by id. Without parts the rows are read directly. """
+    if parts is None:
+        return list(keyset(rows, key, reverse)[:count])
+    if not parts:
+        return []
+    selects = []
+    params = []
+    for i in range(len(parts)):
+        part = keyset(rows.filter(**parts[i]), key, reverse)
+        sql, partparams = part.values_list('commit_time', 'id')[:count] \
+                              .query.as_sql()
+        selects.append('SELECT * FROM (%s) part%d' % (sql, i))
+        params.extend(partparams)
+    order = reverse and 'ASC' or 'DESC'
+    cursor = connection.cursor()
+    cursor.execute('%s ORDER BY 1 %s, 2 %s LIMIT %d' % (
+                       ' UNION ALL '.join(selects), order, order, count),
+                   params)
+    ids = [id for (time, id) in cursor.fetchall()]
+    found = rows.in_bulk(ids)
+    return [found[id] for id in ids if id in found]
+
+def getchangesets(category=None, module=None, after=None, limit=100):
+    """ Returns the changesets of the page after the cursor, each with
+        its changes, and the Navigation to the neighbouring pages. """
+    changesets = Changeset.objects.select_related('user')
+    parts = None
     if category:
+        # merging the modules is cheaper than letting the database sort
+        # all changesets of the category
         mods = Repository.objects.filter(category=category)
-        changes = Change.objects.filter(file__repository__in=mods).order_by(order)[skip:limit]
+        parts = [{'repository': mod.id} for mod in mods]
     elif module:
-        changes = Change.objects.filter(file__repository=module).order_by(order)[skip:limit]
-    else:
-        changes = Change.objects.all().order_by(order)[skip:limit]
+        changesets = changesets.filter(repository=module)
+    key = after and parsecursor(after)
+    page = fetchrows(changesets, key, limit+1, parts=parts)
+    next = None
+    if len(page) > limit:
+        page = page[:limit]
+        next = makecursor(page[-1])
+    prev = None
+    if key:
+        # the previous page ends with the changeset at the cursor and
+        # starts after the one found beyond it, or is the first page
+        time, id = key
+        back = fetchrows(changesets, (time, id - 1), limit+1, reverse=True,
+                         parts=parts)
+        if len(back) > limit:
+            prev = makecursor(back[limit])
+    nav = Navigation(limit, prev, next, key is not None)
+    addchanges(page)
+    return page, nav
+
+def searchchangesets(query, after=None, limit=100):
+    """ Returns the page of changesets matching the query after the
+        changeset id after, like getchangesets(). Matches are ordered
+        by id, newest first. """
+    after = after and int(after)
+    ids = webreview.search.search(query, after, limit+1)
+    next = None
+    if len(ids) > limit:
+        ids = ids[:limit]
+        next = str(ids[-1])
+    prev = None
+    if after:
+        back = webreview.search.search(query, after - 1, limit+1,
+                                       reverse=True)
+        if len(back) > limit:
+            prev = str(back[limit])
+    nav = Navigation(limit, prev, next, bool(after))
+    changesets = Changeset.objects.select_related('user').in_bulk(ids)
+    page = [changesets[id] for id in ids if id in changesets]
+    addchanges(page)
+    return page, nav
+
+def addchanges(page):
+    """ Sets the changes of the changesets, loaded in one query """
+    changes = Change.objects.filter(changeset__in=[cs.id for cs in page])
+    changes = changes.select_related('file__repository', 'user', 'log')
+    bychangeset = {}
+    for change in changes:
+        bychangeset.setdefault(change.changeset_id, []).append(change)
     lastday = None
-    # mark date borders
+    for cs in page:
+        cs.changes = bychangeset.get(cs.id, [])
+        cs.changes.sort(key=lambda c: (c.commit_time, c.id), reverse=True)
+        # mark date borders
+        cs.newday = (cs.commit_time.day != lastday)
+        lastday = cs.commit_time.day
+
+def diffhtml(request, change_id):
+    """ The diff of a change as a table. With an offset only the rows of
+        the diff after that byte offset, which are added to the table
+        by "load more". """
+    offset = request.GET.get('offset', '0')
+    if not offset.isdigit():
+        return http.HttpResponseBadRequest('offset must be a byte offset',
+                                           mimetype='text/plain')
+    offset = int(offset)
+    change = Change.objects.select_related('file__repository') \
+                           .get(id=change_id)
+    if diffcache:
+        diff = diffcache.open(change, rcscache, snapshots)
+        diff.seek(offset, 1)
+    else:
+        module = change.file.repository.getmodule(rcscache,
+                                                  snapshots=snapshots)
+        diff = module.rawdiff(
+                    [change.file.name], change.rev_old,
+                    [change.file.name], change.rev_new, 1)
+        skip = offset
+        while skip > 0:
+            skipped = len(diff.read(min(skip, 65536)))
+            if not skipped:
+                break
+            skip -= skipped
+    return http.HttpResponse(diffrows(change.id, diff, offset),
+                             mimetype='text/html')
+
+def escape(line):
+    return line.replace('&', '&amp;').replace('<', '&lt;') \
+               .replace('>', '&gt;').replace(' ', '&nbsp;')
+
+def diffrows(change_id, diff, offset=0):
+    """ Yields the HTML of a diff read from the file object diff, whose
+        position is the byte offset in the diff. At the start of the
+        diff it is a table, otherwise only its rows. Stops after
+        settings.DIFF_LINE_LIMIT lines or settings.DIFF_BYTE_LIMIT
+        bytes with a row to load the rest. """
+    start = offset
+    if not start:
+        yield '<table style="border: 1px solid #789DB3; ' \
+              'border-spacing: 0px;">\n'
+    rows = []
+    size = 0
+    lines = 0
+    try:
+        line = diff.readline()
+        while line:
+            if lines >= settings.DIFF_LINE_LIMIT or \
+               offset - start >= settings.DIFF_BYTE_LIMIT:
+                rows.append('<tr id="diffmore%d"><td class="code">'
+                            '<a href="javascript:loaddiff(%d, %d)">'
+                            'load more</a></td></tr>\n'
+                            % (change_id, change_id, offset))
+                break
+            # the file names and the first hunk are no changed lines
+            if (start or lines > 2) and line[0] == '+':
+                css = 'diffin'
+            elif (start or lines > 2) and line[0] == '-':
+                css = 'diffout'
+            else:
+                css = 'code'
+            rows.append('<tr><td class="%s">%s</td></tr>\n'
+                        % (css, escape(line)))
+            lines += 1
+            offset += len(line)
+            size += len(line)
+            # sent in pieces of about 64k
+            if size >= 65536:
+                yield ''.join(rows)
+                rows = []
+                size = 0
+            line = diff.readline()
+    finally:
+        diff.close()
+    yield ''.join(rows)
+    if not start:
+        yield '</table>\n'
+
+def blamehtml(request, change_id):
+    """ The file of a change at its new revision as a table, each line
+        with the revision, author and date it was last changed in """
+    change = Change.objects.select_related('file__repository') \
+                           .get(id=change_id)
+    module = change.file.repository.getmodule(rcscache, blamecache)
+    try:
+        blame, revision = module.annotate([change.file.name], change.rev_new)
+    except vclib.Error:
+        return http.HttpResponse('<i>no blame</i>', mimetype='text/html')
+    return http.HttpResponse(blamerows(blame), mimetype='text/html')
+
+def blamerows(blame):
+    """ Yields the HTML of the annotated lines of a file. The revision,
+        author and date are shown on the first of the lines which
+        come from the same revision. """
+    yield '<table style="border: 1px solid #789DB3; ' \
+          'border-spacing: 0px;">\n'
+    rows = []
+    last = None
+    for line in blame:
+        if line.rev != last:
+            date = datetime.fromtimestamp(line.date)
+            rows.append('<tr><td class="blame">%s</td>'
+                        '<td class="blame">%s</td>'
+                        '<td class="blame">%s</td>'
+                        % (line.rev, escape(line.author),
+                           date.strftime('%Y-%m-%d %H:%M')))
+            last = line.rev
+        else:
+            rows.append('<tr><td class="blame" colspan="3"></td>')
+        rows.append('<td class="code">%s</td></tr>\n'
+                    % (escape(line.text) or '&nbsp;'))
+        # sent in pieces of about 1000 lines
+        if len(rows) >= 2000:
+            yield ''.join(rows)
+            rows = []
+    yield ''.join(rows)
+    yield '</table>\n'
+
+def getdiffs(changes):
+    """ Yields (change, diff text) for the changes in their order, the
+        text is None for changes without a diff. The changes of one file
+        are diffed together, in a single pass over the RCS file. """
+    texts = {}
+    failed = set()
+    if diffcache:
+        for change in changes:
+            texts[change.id] = diffcache.get(change.id, source(change))
+    modules = {}
     for change in changes:
-        change.newday = (change.commit_time.day != lastday)
-        lastday = change.commit_time.day
-    # group changes by commit message
-    i = 0
-    changesets = [[c] for c in changes]
-    while i < len(changesets)-1:
-        if changesets[i][0].sameset(changesets[i+1][0]):
-            changesets[i] += changesets.pop(i+1)
+        if texts.get(change.id) is None:
+            repository = change.file.repository
+            if repository.id not in modules:
+                modules[repository.id] = repository.getmodule(rcscache,
+                                                   snapshots=snapshots)
+            module = modules[repository.id]
+            group = [c for c in changes if c.file_id == change.file_id and
+                                           texts.get(c.id) is None]
+            try:
+                fps = module.rawdiffs([change.file.name],
+                            [(c.rev_old, c.rev_new) for c in group], 1)
+            except vclib.Error:
+                # e.g. the first revision, try the others on their own
+                fps = []
+                for c in group:
+                    try:
+                        fps.append(module.rawdiff([c.file.name], c.rev_old,
+                                                  [c.file.name], c.rev_new, 1))
+                    except vclib.Error:
+                        fps.append(None)
+            for (c, fp) in zip(group, fps):
+                if fp is None:
+                    failed.add(c.id)
+                    texts[c.id] = ''
+                    continue
+                texts[c.id] = fp.read()
+                fp.close()
+                if diffcache:
+                    diffcache.put(c.id, source(c), texts[c.id])
+        if change.id in failed:
+            yield change, None
         else:
-            i += 1
-    return changesets
+            yield change, texts[change.id]
 
-def diffhtml(request, change_id):
-    class Line: pass
-    change = Change.objects.get(id=change_id)
-    module = vclib.ccvs.CCVSRepository("foo", change.file.repository.path)
-    diff = module.rawdiff(
-                [change.file.name], change.rev_old,
-                [change.file.name], change.rev_new, 1)
-    difflines = []
-    line = diff.readline()
-    while line != '':
-        l = Line()
-        l.str=line
-        if line[0] == '+' and len(difflines)>2:
-            l.diffin = True
-        if line[0] == '-' and len(difflines)>2:
-            l.diffout = True
-        difflines.append(l)
-        line = diff.readline().replace(" ", "&nbsp;").replace("<", "&lt;")
-        
-    vars = {
-        'difflines': difflines,
-    }
-    return render_to_response('diff.html', vars)
+def changesetdiffs(request, changeset_id):
+    """ The diffs of all changes of a changeset, each in a div with the
+        id diffset<change id>. Streamed as the diffs are made. """
+    changeset = Changeset.objects.get(id=changeset_id)
+    changes = Change.objects.filter(changeset=changeset) \
+                            .select_related('file__repository')
+    changes = list(changes.order_by('-commit_time', '-id'))
+    def render():
+        for (change, text) in getdiffs(changes):
+            yield '<div id="diffset%d">' % change.id
+            if text is None:
+                yield '<i>no diff</i>'
+            else:
+                for html in diffrows(change.id, cStringIO.StringIO(text)):
+                    yield html
+            yield '</div>\n'
+    return http.HttpResponse(render(), mimetype='text/html')
 
 def getcategories():
-    categories = Category.objects.all().order_by('name')
+    """ Returns the categories with their modules, in two queries """
+    categories = list(Category.objects.all().order_by('name'))
+    modules = {}
+    for mod in Repository.objects.order_by('name'):
+        modules.setdefault(mod.category_id, []).append(mod)
     for cat in categories:
-        mods = Repository.objects.filter(category=cat).order_by('name')
-        cat.modules = mods
+        cat.modules = modules.get(cat.id, [])
     return categories
 
-def index(request, skip=0):
-    return changes(request, skip=skip)
+def index(request, after=None):
+    return changes(request, after=after)
 
-def changes(request, filter=None, filter_id=None, skip=0):
-    skip = int(skip)
+def changes(request, filter=None, filter_id=None, after=None):
     module = None
     category = None
     if filter == 'module':
         module = Repository.objects.get(id=filter_id)
-        changesets = getchangesets(module=module, skip=skip)
+        changesets, nav = getchangesets(module=module, after=after)
         url = '/changes/module/%d' % module.id
     elif filter == 'category':
         category = Category.objects.get(id=filter_id)
-        changesets = getchangesets(category=category, skip=skip)
+        changesets, nav = getchangesets(category=category, after=after)
         url = '/changes/category/%d' % category.id
     else:
         url = '/changes/all'
-        changesets = getchangesets(skip=skip)
+        changesets, nav = getchangesets(after=after)
     categories = getcategories()
-    # the reduce clause returns the total number of changes in the changesets
-    nav = Navigation(reduce(lambda x, y: x+len(y), changesets, 0), skip)
     vars = {
         'category_list': categories,
         'changesets': changesets,
@@ -106,6 +402,18 @@ def changes(request, filter=None, filter_id=None, skip=0):
     }
     return render_to_response('index.html', vars )
 
+def search(request, after=None):
+    query = request.GET.get('q', '')
+    changesets, nav = searchchangesets(query, after)
+    vars = {
+        'category_list': getcategories(),
+        'changesets': changesets,
+        'navigation': nav,
+        'url': '/search',
+        'query': query,
+    }
+    return render_to_response('index.html', vars)
+
 def addmodule(request):
     name = ''
     path = ''
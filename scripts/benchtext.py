@@ -0,0 +1,171 @@
+#!/usr/bin/python2.5
+# vim:set tabstop=3 shiftwidth=3 expandtab:
+# vim:set autoindent smarttab nowrap:
+
+""" Compares the time vclib.ccvs.StreamText takes to check out the oldest
+    revision of synthetic RCS files with the list based StreamText it
+    replaced. The files have a long trunk of random deltas, by default
+    100000 lines with many small, some medium and a few large deltas. """
+
+import os
+import sys
+import re
+import time
+import random
+import shutil
+import string
+import tempfile
+from optparse import OptionParser
+
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__),
+                                              '..', 'app')))
+
+import vclib.ccvs
+from vclib.ccvs import rcsparse
+
+# lines, revisions, commands per delta
+CONFIGURATIONS = ((100000, 1000, 10), (100000, 100, 500), (100000, 20, 5000))
+
+class ListText:
+   """ StreamText as it was, inserting and deleting in a list line by
+       line for every command """
+   d_command = re.compile('^d(\d+)\\s(\\d+)')
+   a_command = re.compile('^a(\d+)\\s(\\d+)')
+
+   def __init__(self, text):
+      self.text = string.split(text, "\n")
+
+   def command(self, cmd):
+      adjust = 0
+      add_lines_remaining = 0
+      diffs = string.split(cmd, "\n")
+      if diffs[-1] == "":
+         del diffs[-1]
+      if len(diffs) == 0:
+         return
+      if diffs[0] == "":
+         del diffs[0]
+      for command in diffs:
+         if add_lines_remaining > 0:
+            self.text.insert(start_line + adjust, command)
+            add_lines_remaining = add_lines_remaining - 1
+            adjust = adjust + 1
+            continue
+         dmatch = self.d_command.match(command)
+         amatch = self.a_command.match(command)
+         if dmatch:
+            start_line = string.atoi(dmatch.group(1))
+            count = string.atoi(dmatch.group(2))
+            begin = start_line + adjust - 1
+            del self.text[begin:begin + count]
+            adjust = adjust - count
+         elif amatch:
+            start_line = string.atoi(amatch.group(1))
+            count = string.atoi(amatch.group(2))
+            add_lines_remaining = count
+         else:
+            raise RuntimeError, 'Error parsing diff commands'
+
+def randomDelta(length, commands, revision, rand):
+   """ Returns a random ed script for a text of length lines and the
+       length of the text it makes """
+   original = length
+   positions = rand.sample(xrange(1, original + 1), min(commands, original))
+   positions.sort()
+   script = []
+   end = 0
+   for pos in positions:
+      # the commands must not overlap
+      if pos <= end:
+         continue
+      count = min(rand.randint(1, 3), original - pos + 1)
+      kind = rand.random()
+      if kind < 0.6:
+         script.append('d%d %d' % (pos, count))
+         length -= count
+         end = pos + count - 1
+      if kind < 0.3 or kind >= 0.6:
+         added = rand.randint(1, 3)
+         script.append('a%d %d' % (max(pos, end), added))
+         script.extend(['revision %d line %d.%d' % (revision, pos, i)
+                        for i in range(added)])
+         length += added
+         end = max(pos, end)
+   return ''.join([line + '\n' for line in script]), length
+
+def writeRCS(path, lines, revisions, commands, seed=1):
+   """ Writes an RCS file with revisions 1.1 to 1.<revisions> on the trunk,
+       the head with the given number of lines """
+   rand = random.Random(seed)
+   deltas = []
+   length = lines
+   for r in range(revisions - 1, 0, -1):
+      delta, length = randomDelta(length, commands, r, rand)
+      deltas.append(delta)
+   fp = open(path, 'w')
+   fp.write('head\t1.%d;\naccess;\nsymbols;\nlocks; strict;\n'
+            'comment\t@# @;\n\n' % revisions)
+   for r in range(revisions, 0, -1):
+      fp.write('\n1.%d\ndate\t2009.01.01.00.00.00;\tauthor bench;\t'
+               'state Exp;\nbranches;\nnext\t%s;\n'
+               % (r, r > 1 and '1.%d' % (r - 1) or ''))
+   fp.write('\n\ndesc\n@@\n')
+   fp.write('\n\n1.%d\nlog\n@@\ntext\n@' % revisions)
+   for i in range(lines):
+      fp.write('line %d\n' % i)
+   fp.write('@\n')
+   for r, delta in zip(range(revisions - 1, 0, -1), deltas):
+      fp.write('\n\n1.%d\nlog\n@@\ntext\n@%s@\n' % (r, delta))
+   fp.close()
+
+class TextSink(rcsparse.Sink):
+   def __init__(self):
+      self.texts = []
+
+   def set_revision_info(self, revision, log, text):
+      self.texts.append(text)
+
+def checkout(textclass, texts):
+   """ Returns the text of the oldest revision and the seconds it took """
+   start = time.time()
+   text = textclass(texts[0])
+   for delta in texts[1:]:
+      text.command(delta)
+   return text.text, time.time() - start
+
+def bench(directory, lines, revisions, commands):
+   path = os.path.join(directory, 'bench,v')
+   writeRCS(path, lines, revisions, commands)
+   sink = TextSink()
+   rcsparse.Parser().parse(open(path, 'rb'), sink)
+   old, oldtime = checkout(ListText, sink.texts)
+   new, newtime = checkout(vclib.ccvs.StreamText, sink.texts)
+   if old != new:
+      raise RuntimeError, 'different texts'
+   repository = vclib.ccvs.CCVSRepository('bench', directory)
+   start = time.time()
+   repository.openfile(['bench'], '1.1')
+   opentime = time.time() - start
+   print "%7d lines %5d revisions %5d commands: list %7.3fs  " \
+         "StreamText %7.3fs  openfile %7.3fs" % (lines, revisions, commands,
+                                                 oldtime, newtime, opentime)
+
+if __name__ == '__main__':
+   parser = OptionParser()
+   parser.add_option("-l", "--lines", type="int",
+                     help="lines of the head revision")
+   parser.add_option("-r", "--revisions", type="int",
+                     help="number of revisions")
+   parser.add_option("-c", "--commands", type="int",
+                     help="commands per delta")
+   (options, args) = parser.parse_args()
+   configurations = CONFIGURATIONS
+   if options.lines or options.revisions or options.commands:
+      configurations = [(options.lines or 100000, options.revisions or 1000,
+                         options.commands or 10)]
+   directory = tempfile.mkdtemp()
+   try:
+      for (lines, revisions, commands) in configurations:
+         bench(directory, lines, revisions, commands)
+   finally:
+      shutil.rmtree(directory)
@@ -4,6 +4,7 @@
 
 import os
 import sys
+from optparse import OptionParser
 
 sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__),'..')))
 
@@ -13,11 +14,18 @@ import app.settings
 from django.core.management import setup_environ
 setup_environ(app.settings)
 from app.webreview.models import Repository
-from app.scanner.repscanner import RepositoryScanner
+from app.scanner.repscanner import scanRepositories
 
 if __name__ == '__main__':
-   for r in Repository.objects.all():
-      print "Scanning %s" % r.name
-      RepositoryScanner(r).run()
+   parser = OptionParser()
+   parser.add_option("-f", "--full", action="store_true", default=False,
+                     help="scan all files instead of reading CVSROOT/history")
+   parser.add_option("-j", "--jobs", type="int", default=1,
+                     help="number of processes parsing RCS files")
+   parser.add_option("-b", "--batch-size", type="int", default=1000,
+                     help="number of rows written per transaction")
+   (options, args) = parser.parse_args()
+   scanRepositories(Repository.objects.all(), options.full, options.jobs,
+                    options.batch_size)
 
 
@@ -0,0 +1,201 @@
+#!/usr/bin/python2.5
+# vim:set tabstop=3 shiftwidth=3 expandtab:
+# vim:set autoindent smarttab nowrap:
+
+""" Brings the database of an older installation up to date: creates new
+    tables, adds new columns and indexes, moves log messages into their
+    own table, drops old columns, groups the changes stored before
+    changesets existed and builds the search index. Running it again
+    does no harm. """
+
+import os
+import sys
+from optparse import OptionParser
+
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__),'..')))
+
+import app.settings
+
+# import the django environment first before using any local modules
+from django.core.management import setup_environ, call_command
+setup_environ(app.settings)
+from django.conf import settings
+from django.core.management.color import no_style
+from django.core.management.sql import custom_sql_for_model
+from django.db import connection, transaction, models, DatabaseError
+from app.webreview.models import Repository, Change, Changeset
+from app.scanner.repscanner import ChangesetGrouper, ChangeWriter, LogCache
+from app.webreview import search
+
+def tableColumns(model):
+   cursor = connection.cursor()
+   return [row[0] for row in connection.introspection.get_table_description(
+                                 cursor, model._meta.db_table)]
+
+def addColumns(model):
+   """ Adds the columns of fields that are missing in the table. """
+   qn = connection.ops.quote_name
+   cursor = connection.cursor()
+   table = model._meta.db_table
+   columns = tableColumns(model)
+   for field in model._meta.local_fields:
+      if field.column in columns:
+         continue
+      sql = "ALTER TABLE %s ADD COLUMN %s %s" % (qn(table), qn(field.column),
+                                                field.db_type())
+      if field.null:
+         sql += " NULL"
+      elif field.has_default():
+         default = field.get_db_prep_save(field.get_default())
+         if isinstance(default, basestring):
+            default = "'%s'" % default.replace("'", "''")
+         sql += " NOT NULL DEFAULT %s" % default
+      else:
+         print "Cannot add column %s.%s without a default" % (table,
+                                                               field.column)
+         continue
+      print "Adding column %s.%s" % (table, field.column)
+      cursor.execute(sql)
+      transaction.commit_unless_managed()
+
+def internLogs(model, logs, batchsize=1000):
+   """ Moves the texts of the old logmessage column into LogMessage. """
+   columns = tableColumns(model)
+   if 'logmessage' not in columns:
+      return
+   qn = connection.ops.quote_name
+   table = qn(model._meta.db_table)
+   field = model._meta.get_field('log')
+   log = qn(field.column)
+   cursor = connection.cursor()
+   if field.column not in columns:
+      # NULL until the rows are done, the table is recreated afterwards
+      cursor.execute("ALTER TABLE %s ADD COLUMN %s %s NULL" % (table, log,
+                                                         field.db_type()))
+   print "Moving log messages of %s" % model._meta.db_table
+   while True:
+      cursor.execute("SELECT %s, logmessage FROM %s WHERE %s IS NULL "
+                     "LIMIT %d" % (qn(model._meta.pk.column), table, log,
+                                   batchsize))
+      rows = cursor.fetchall()
+      if not rows:
+         break
+      cursor.executemany("UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+                           table, log, qn(model._meta.pk.column)),
+                         [(logs.intern(text), id) for (id, text) in rows])
+      transaction.commit_unless_managed()
+
+def dropColumns(model):
+   """ Removes the columns no field of the model uses any more. """
+   qn = connection.ops.quote_name
+   table = model._meta.db_table
+   fields = [f.column for f in model._meta.local_fields]
+   columns = tableColumns(model)
+   dropped = [c for c in columns if c not in fields]
+   if not dropped:
+      return
+   print "Dropping columns %s of %s" % (", ".join(dropped), table)
+   cursor = connection.cursor()
+   if settings.DATABASE_ENGINE == 'sqlite3':
+      # SQLite can't drop columns, the table is copied instead. The
+      # references of other tables must keep pointing to the new table.
+      cursor.execute("PRAGMA legacy_alter_table = ON")
+      cursor.execute("ALTER TABLE %s RENAME TO %s" % (qn(table),
+                                                       qn(table + '_old')))
+      for sql in connection.creation.sql_create_model(model, no_style())[0]:
+         cursor.execute(sql)
+      columns = ", ".join([qn(c) for c in fields if c in columns])
+      cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s" % (
+                        qn(table), columns, columns, qn(table + '_old')))
+      cursor.execute("DROP TABLE %s" % qn(table + '_old'))
+   else:
+      for column in dropped:
+         cursor.execute("ALTER TABLE %s DROP COLUMN %s" % (qn(table),
+                                                           qn(column)))
+   transaction.commit_unless_managed()
+
+def createIndexes(model, verbosity=1):
+   """ Creates the indexes of a model, those of its fields and those in
+       the sql/ directory of the app. Existing ones are left alone. """
+   style = no_style()
+   statements = connection.creation.sql_indexes_for_model(model, style) + \
+                custom_sql_for_model(model, style)
+   cursor = connection.cursor()
+   for sql in statements:
+      try:
+         cursor.execute(sql)
+      except DatabaseError, e:
+         # most likely it exists already
+         transaction.rollback_unless_managed()
+         if verbosity > 1:
+            print "Skipped %s: %s" % (sql.strip(), e)
+      else:
+         transaction.commit_unless_managed()
+         print "Created %s" % sql.strip()
+
+def groupChanges(repository, batchsize=1000):
+   """ Assigns changes without a changeset to changesets, like the scanner
+       does for new changes. """
+   changes = Change.objects.filter(file__repository=repository,
+                                   changeset__isnull=True)
+   count = changes.count()
+   if not count:
+      return
+   print "%s: grouping %d changes" % (repository.name, count)
+   qn = connection.ops.quote_name
+   sql = "UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+            qn(Change._meta.db_table),
+            qn(Change._meta.get_field('changeset').column),
+            qn(Change._meta.pk.column))
+   grouper = ChangesetGrouper(repository, settings.CHANGESET_WINDOW)
+   writer = ChangeWriter(batchsize)
+   writer.begin()
+   try:
+      while True:
+         # each batch leaves the changes without a changeset
+         batch = list(changes.select_related('file', 'user')
+                             .order_by('commit_time', 'id')[:batchsize])
+         if not batch:
+            break
+         for change in batch:
+            writer.updateChangeset(grouper.assign(change))
+         connection.cursor().executemany(sql,
+               [(change.changeset.id, change.id) for change in batch])
+         writer.flush()
+   finally:
+      writer.end()
+
+def indexChangesets(batchsize=1000):
+   """ Adds the changesets to a new search index, the scanner keeps it
+       up to date from then on. """
+   if not search.getindex().empty():
+      return
+   ids = list(Changeset.objects.order_by('id').values_list('id', flat=True))
+   if not ids:
+      return
+   print "Indexing %d changesets for search" % len(ids)
+   for i in range(0, len(ids), batchsize):
+      search.update(ids[i:i+batchsize])
+      transaction.commit_unless_managed()
+
+if __name__ == '__main__':
+   parser = OptionParser()
+   parser.add_option("-v", "--verbosity", type="int", default=1,
+                     help="1 for normal output, 2 to list skipped indexes")
+   (options, args) = parser.parse_args()
+   # new tables come with all their indexes
+   call_command('syncdb', interactive=False, verbosity=options.verbosity)
+   webreview = models.get_models(models.get_app('webreview'))
+   logs = LogCache()
+   for model in webreview:
+      if 'log' in [f.name for f in model._meta.local_fields]:
+         internLogs(model, logs)
+   for model in webreview:
+      addColumns(model)
+   for model in webreview:
+      # dropping columns may recreate the table without its indexes
+      dropColumns(model)
+      createIndexes(model, options.verbosity)
+   indexChangesets()
+   for repository in Repository.objects.all():
+      groupChanges(repository)
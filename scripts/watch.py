@@ -0,0 +1,35 @@
+#!/usr/bin/python2.5
+# vim:set tabstop=3 shiftwidth=3 expandtab:
+# vim:set autoindent smarttab nowrap:
+
+import os
+import sys
+from optparse import OptionParser
+
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__),'..')))
+
+import app.settings
+
+# import the django environment first before using any local modules
+from django.core.management import setup_environ
+setup_environ(app.settings)
+from app.webreview.models import Repository
+from app.scanner.repscanner import watchRepositories
+
+if __name__ == '__main__':
+   parser = OptionParser(description="Scans the repositories and then "
+                         "every file committed to, until interrupted. "
+                         "Repositories added later are scanned after a "
+                         "restart.")
+   parser.add_option("-d", "--delay", type="float", default=2,
+                     help="seconds a file must be left alone before it "
+                          "is scanned")
+   parser.add_option("-i", "--interval", type="float", default=5,
+                     help="seconds between polls where inotify is not "
+                          "available")
+   (options, args) = parser.parse_args()
+   try:
+      watchRepositories(Repository.objects.all(), options.delay,
+                        options.interval)
+   except KeyboardInterrupt:
+      pass
@@ -13,6 +13,62 @@ function showdiff(show, change_id) {
    if (show) {
       $("#diffview"+change_id).load("/diff/"+change_id+"/html");
    }
+   togglediff(change_id);
+}
+
+function showalldiffs(changeset_id) {
+   // the response is streamed, each diff is shown as soon as its div
+   // is complete rather than after the last one
+   var xhr = new XMLHttpRequest();
+   var shown = 0;
+   function show() {
+      var html;
+      try {
+         html = xhr.responseText;
+      } catch (e) {
+         // not readable before the end in some browsers
+         return;
+      }
+      var end = html.lastIndexOf("</div>\n");
+      if (end < shown) {
+         return;
+      }
+      end += "</div>\n".length;
+      $("<div>").html(html.substring(shown, end)).children().each(function() {
+         var change_id = this.id.substring("diffset".length);
+         $("#diffview"+change_id).html($(this).html());
+         if ($("#diffview"+change_id).css('display') == 'none') {
+            togglediff(change_id);
+         }
+      });
+      shown = end;
+   }
+   xhr.onprogress = show;
+   xhr.onreadystatechange = function() {
+      if (xhr.readyState >= 3) {
+         show();
+      }
+   };
+   xhr.open("GET", "/changeset/"+changeset_id+"/diffs", true);
+   xhr.send(null);
+}
+
+function loaddiff(change_id, offset) {
+   $.get("/diff/"+change_id+"/html?offset="+offset, function(html) {
+      $("#diffmore"+change_id).replaceWith(html);
+   });
+}
+
+function showblame(show, change_id) {
+   if (show) {
+      $("#blameview"+change_id).load("/blame/"+change_id+"/html");
+   }
+   $("#showblame"+change_id).toggle();
+   $("#hideblame"+change_id).toggle();
+   $("#blameview"+change_id).toggle();
+}
+
+function togglediff(change_id) {
    $("#showdiff"+change_id).toggle();
    $("#hidediff"+change_id).toggle();
    $("#bhidediff"+change_id).toggle();